@@ -0,0 +1,895 @@
+import os
+import sys
+import json
+import html
+import time
+import pickle
+import random
+import platform
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+from BookCollections import BookCollection
+from TextMatchers import TagMatcher
+
+
+WORDS = (
+    'origin species brief history time silent spring selfish gene cosmos dune foundation '
+    'snowball earth cretaceous extinction machine learning deep sapiens guns germs steel '
+    'structure scientific revolutions order chaos emperor maladies gene double helix'
+).split()
+
+
+def synthetic_book_names(n_books, seed=0):
+    ''' returns (book file names, note file names) following the PocketBook naming of books and notes '''
+    rng = random.Random(seed)
+    book_names, note_names = [], []
+    for i in range(n_books):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title() + f' {i:05d}'
+        author = f'{rng.choice(WORDS).title()}, {rng.choice(WORDS).title()}'
+        book_names.append(f'{author} - {title} - {rng.choice(WORDS).title()} Press ({rng.randint(1900, 2023)}).epub')
+        if rng.random() < 0.8:
+            note_names.append(f'{title}.html')
+    return sorted(book_names), sorted(note_names)
+
+
+def make_book_collection(book_names, note_names, match_threshold=0.8, suggest_threshold=0.5):
+    ''' a BookCollection over in-memory paths, without listing directories '''
+    collection = BookCollection.__new__(BookCollection)
+    collection.books = []
+    collection.normalized = {}
+    collection.match_threshold = match_threshold
+    collection.suggest_threshold = suggest_threshold
+    collection.book_paths = [Path(el) for el in book_names]
+    collection.note_paths = [Path(el) for el in note_names]
+    return collection
+
+
+def map_book_notes_naive(collection):
+    ''' the original O(books x notes) matching, used as reference for pairings and timing '''
+    def match(to_search_for, to_search_in):
+        book_str = collection.strip_punctuation(to_search_for.stem).lower()
+        for note_fn in to_search_in:
+            if collection.strip_punctuation(note_fn.stem).lower() in book_str:
+                return (to_search_for, note_fn)
+        return None
+
+    book_notes = {}
+    no_note_books = collection.book_paths.copy()
+    no_book_notes = collection.note_paths.copy()
+    book_i = 0
+    for book_fn in collection.book_paths:
+        amatch = match(book_fn, collection.note_paths)
+        if amatch:
+            book_notes[book_i] = {'book_fn':amatch[0], 'note_fn':amatch[1]}
+            no_book_notes.remove(amatch[1])
+            no_note_books.remove(amatch[0])
+            book_i +=1
+    for note_fn in no_book_notes:
+        amatch = match(note_fn, no_note_books)
+        if amatch:
+            book_notes[book_i] = {'book_fn':amatch[1], 'note_fn':amatch[0]}
+            no_book_notes.remove(amatch[0])
+            no_note_books.remove(amatch[1])
+            book_i +=1
+    return book_notes
+
+
+def bench_map_book_notes(sizes=(100, 500, 1000, 2000, 5000), naive_max=2000):
+    ''' time indexed vs naive book-note matching as the library grows, checking both give the same pairings '''
+    results = []
+    for n_books in sizes:
+        book_names, note_names = synthetic_book_names(n_books)
+        collection = make_book_collection(book_names, note_names)
+        start = time.perf_counter()
+        collection.map_book_notes()
+        indexed = time.perf_counter() - start
+
+        naive = None
+        if n_books <= naive_max:
+            start = time.perf_counter()
+            reference = map_book_notes_naive(make_book_collection(book_names, note_names))
+            naive = time.perf_counter() - start
+            assert reference == collection.book_notes, f'pairings differ for {n_books} books'
+        results.append(dict(books=n_books, notes=len(note_names), indexed_s=indexed, naive_s=naive))
+
+    print(f'{"books":>8} {"notes":>8} {"indexed (s)":>12} {"naive (s)":>12}')
+    for r in results:
+        naive = f'{r["naive_s"]:.3f}' if r['naive_s'] is not None else '-'
+        print(f'{r["books"]:>8} {r["notes"]:>8} {r["indexed_s"]:>12.3f} {naive:>12}')
+    return results
+
+
+def misnamed_note_names(n_books, seed=0):
+    '''
+    (book file names, note file names, book of each note name) where no note name is contained in its book name:
+    titles drawn from a large vocabulary, and each note name altered by an edition suffix, curly apostrophe,
+    dropped letter or accents, the differences substring matching misses
+    '''
+    rng = random.Random(seed)
+    vocabulary = [tag for tag in synthetic_tags(3 * n_books, seed) if ' ' not in tag]
+    book_names, note_names, note_books = [], [], {}
+    for i in range(n_books):
+        title = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(2, 6))).title()
+        author = f'{rng.choice(vocabulary).title()}, {rng.choice(vocabulary).title()}'
+        book_name = f'{author} - {title} - {rng.choice(vocabulary).title()} Press ({rng.randint(1900, 2023)}).epub'
+        alteration = rng.randrange(4)
+        if alteration == 0:
+            note_name = title + ' (2nd Edition)'
+        elif alteration == 1:
+            note_name = title.replace(' ', '\u2019 ', 1) if ' ' in title else title + '\u2019s'
+        elif alteration == 2:
+            j = rng.randrange(len(title))
+            note_name = title[:j] + title[j + 1:]
+        else:
+            note_name = title.replace('e', '\u00e9').replace('a', '\u00e0')
+        book_names.append(book_name)
+        note_names.append(note_name + '.html')
+        note_books[note_name + '.html'] = book_name
+    return book_names, note_names, note_books
+
+
+def bench_similar_matching(sizes=(500, 1000, 3000), brute_force_max=1000):
+    '''
+    time matching notes to books when substring matching fails, checking that every similar match is right,
+    and that the n-gram index finds the same matches as scoring every note against every book
+    '''
+    from TextMatchers import NgramIndex, get_ngrams, dice_similarity
+    results = []
+    for n_books in sizes:
+        book_names, note_names, note_books = misnamed_note_names(n_books)
+        collection = make_book_collection(book_names, note_names)
+        start = time.perf_counter()
+        collection.map_book_notes()
+        match_s = time.perf_counter() - start
+        for note_fn, book_fn, score in collection.similar_matches:
+            assert note_books[note_fn.name] == book_fn.name, f'{note_fn.name} matched to {book_fn.name} ({score:.2f})'
+        suggested = sum(
+            any(book_fn.name == note_books[note_fn.name] for book_fn, _ in suggestions)
+            for note_fn, suggestions in collection.suggestions.items()
+        )
+
+        brute_force_s = None
+        if n_books <= brute_force_max:
+            stems = [collection.similarity_stem(Path(el).stem) for el in book_names]
+            queries = [collection.similarity_stem(Path(el).stem) for el in note_names]
+            index = NgramIndex(stems)
+            start = time.perf_counter()
+            indexed = [index.search(query, 0.5) for query in queries]
+            index_s = time.perf_counter() - start
+            start = time.perf_counter()
+            stem_grams = [get_ngrams(stem) for stem in stems]
+            brute_force = []
+            for query in queries:
+                grams = get_ngrams(query)
+                scores = [(dice_similarity(grams, other), text_id) for text_id, other in enumerate(stem_grams)]
+                brute_force.append(sorted(((s, i) for s, i in scores if s >= 0.5), key=lambda m: (-m[0], m[1])))
+            brute_force_s = time.perf_counter() - start
+            assert indexed == brute_force, f'n-gram index misses matches for {n_books} books'
+        results.append(dict(
+            books=n_books, similar=len(collection.similar_matches), suggested=suggested,
+            unmatched=len(collection.no_book_notes), match_s=match_s,
+            search_s=index_s if brute_force_s is not None else None, brute_force_s=brute_force_s,
+        ))
+
+    print(f'{"books":>6} {"similar":>8} {"suggested":>10} {"unmatched":>10} {"match (s)":>10} {"search (s)":>11} {"brute force (s)":>16}')
+    for r in results:
+        search = f'{r["search_s"]:.3f}' if r['search_s'] is not None else '-'
+        brute_force = f'{r["brute_force_s"]:.3f}' if r['brute_force_s'] is not None else '-'
+        print(f'{r["books"]:>6} {r["similar"]:>8} {r["suggested"]:>10} {r["unmatched"]:>10} {r["match_s"]:>10.3f} {search:>11} {brute_force:>16}')
+    return results
+
+
+def synthetic_tags(n_tags, seed=0):
+    ''' concept-like tag names, a mix of vocabulary words and made up multi-word names '''
+    rng = random.Random(seed)
+    tags = set(WORDS[:min(n_tags, len(WORDS))])
+    while len(tags) < n_tags:
+        tags.add(' '.join(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+                          for _ in range(rng.randint(1, 3))))
+    return sorted(tags)
+
+
+def synthetic_highlights(n_highlights, tags, seed=0):
+    rng = random.Random(seed)
+    highlights = []
+    for _ in range(n_highlights):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(10, 60))]
+        if rng.random() < 0.3:
+            words.insert(rng.randrange(len(words)), rng.choice(tags))
+        highlights.append(' '.join(words))
+    return highlights
+
+
+def bench_infer_tags(tag_counts=(10, 1000, 10000), n_highlights=500):
+    ''' time the compiled tag matcher against one `in` scan per tag, checking both find the same tags '''
+    results = []
+    for n_tags in tag_counts:
+        tags = synthetic_tags(n_tags)
+        highlights = synthetic_highlights(n_highlights, tags)
+
+        start = time.perf_counter()
+        naive = [{tag for tag in tags if tag in text} for text in highlights]
+        naive_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        matcher = TagMatcher(tags)
+        compile_s = time.perf_counter() - start
+        start = time.perf_counter()
+        compiled = [matcher.find_tags(text) for text in highlights]
+        matcher_s = time.perf_counter() - start
+        assert naive == compiled, f'tags differ for {n_tags} tags'
+        results.append(dict(tags=n_tags, highlights=n_highlights, naive_s=naive_s, compile_s=compile_s, matcher_s=matcher_s))
+
+    print(f'{"tags":>8} {"highlights":>10} {"naive (s)":>10} {"compile (s)":>12} {"matcher (s)":>12}')
+    for r in results:
+        print(f'{r["tags"]:>8} {r["highlights"]:>10} {r["naive_s"]:>10.3f} {r["compile_s"]:>12.3f} {r["matcher_s"]:>12.3f}')
+    return results
+
+
+def synthetic_note_batches(n_books, notes_per_book, seed=0):
+    ''' (book name, batch) pairs in the format NoteCollection.bookmarks_to_batch returns '''
+    rng = random.Random(seed)
+    colors = ['key_idea', 'standard', 'look_into', 'summary', 'none']
+    book_names, _ = synthetic_book_names(n_books, seed)
+    result = []
+    for book_name in book_names:
+        rows = []
+        for _ in range(notes_per_book):
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(10, 40)))
+            note = ' '.join(rng.choice(WORDS) for _ in range(5)) if rng.random() < 0.3 else None
+            tags = {tag for tag in ('machine learning', 'selfish gene', 'double helix') if tag in text} or None
+            # strings are rebuilt so they are not shared between notes, like after unpickling a parse cache
+            rows.append((''.join(list(rng.choice(colors))), rng.randint(1, 500), text, note, tags))
+        result.append((book_name, (True, rows)))
+    return result
+
+
+def bench_note_memory(n_books=200, notes_per_book=500):
+    ''' memory, pickle size and pickle load time of a collection of n_books x notes_per_book notes '''
+    import gc
+    import pickle
+    import tracemalloc
+    from BookCollections import Book
+    from NoteCollections import NoteCollection
+
+    batches = synthetic_note_batches(n_books, notes_per_book)
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    note_collection = NoteCollection([], [], {})
+    # measure the notes only, the index is rebuilt on demand and never pickled
+    note_collection.index = None
+    books = []
+    for book_id, (book_name, batch) in enumerate(batches):
+        book = Book(book_id, Path('books', book_name), Path('notes', book_name + '.html'))
+        note_collection.add_note_batch(batch, book)
+        books.append(book)
+    build_s = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    data = pickle.dumps((books, note_collection))
+    start = time.perf_counter()
+    pickle.loads(data)
+    load_s = time.perf_counter() - start
+    result = dict(
+        notes=len(note_collection), build_s=build_s, memory_mb=memory / 1e6,
+        pickle_mb=len(data) / 1e6, pickle_load_s=load_s,
+    )
+    print(f'{result["notes"]} notes: built in {build_s:.2f}s, {result["memory_mb"]:.1f} MB in memory, '
+          f'pickle {result["pickle_mb"]:.1f} MB loaded in {load_s:.2f}s')
+    return result
+
+
+HIGHLIGHT_SEMANTIC_MAPPING = {
+    'bm-color-magenta' : 'key_idea',
+    'bm-color-red' : 'key_idea',
+    'bm-color-yellow': 'standard',
+    'bm-color-green': 'look_into',
+    'bm-color-cian': 'summary',
+    'bm-color-blue': 'summary',
+    'bm-color-note': 'none',
+}
+
+
+def synthetic_note_html(title, author, n_highlights, rng, tags=()):
+    ''' a note file as exported by PocketBook, the first two bookmarks hold the book title and author '''
+    out = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8"/>\n'
+        f'<title>{html.escape(title)}</title>\n</head>\n<body>\n',
+        f'<div class="bookmark bm-color-none" id="title"><div class="bm-text">{html.escape(title)}</div></div>\n',
+        f'<div class="bookmark bm-color-none" id="author"><div class="bm-text">{html.escape(author)}</div></div>\n',
+    ]
+    out.append(synthetic_bookmarks_html(n_highlights, rng, tags))
+    out.append('</body>\n</html>\n')
+    return ''.join(out)
+
+
+def synthetic_bookmarks_html(n_highlights, rng, tags=(), first_id=0):
+    ''' the bookmark divs of n_highlights highlights, numbered from first_id '''
+    out = []
+    colors = list(HIGHLIGHT_SEMANTIC_MAPPING)
+    for i in range(first_id, first_id + n_highlights):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(10, 60))]
+        if tags and rng.random() < 0.2:
+            words.insert(rng.randrange(len(words)), rng.choice(tags))
+        out.append(
+            f'<div class="bookmark {rng.choice(colors)}" id="bm{i}">\n'
+            f'<p class="bm-page">{rng.randint(1, 500)}</p>\n'
+            f'<div class="bm-text"><p>{html.escape(" ".join(words))}</p></div>\n'
+        )
+        if rng.random() < 0.3:
+            note = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+            out.append(f'<div class="bm-note"><p>{html.escape(note)}</p></div>\n')
+        out.append('</div>\n')
+    return ''.join(out)
+
+
+def append_synthetic_highlights(note_path, n_highlights, rng, first_id, tags=()):
+    ''' add highlights to the end of a note file, before </body>, the way PocketBook does '''
+    with open(note_path, 'r', encoding='utf-8') as f:
+        contents = f.read()
+    end = contents.rfind('</body>')
+    with open(note_path, 'w', encoding='utf-8') as f:
+        f.write(contents[:end] + synthetic_bookmarks_html(n_highlights, rng, tags, first_id) + contents[end:])
+
+
+def write_synthetic_library(root, n_books, highlights_per_book, seed=0, tags=()):
+    '''
+    writes a library of n_books book files (named Author - Title - Publisher (Year)) and their note files
+    into root/books and root/PBcloud_files, the directories MyCollection uses. Returns (book_dir, note_dir).
+    '''
+    rng = random.Random(seed)
+    book_dir, note_dir = os.path.join(root, 'books'), os.path.join(root, 'PBcloud_files')
+    for adir in [book_dir, note_dir]:
+        os.makedirs(adir, exist_ok=True)
+    book_names, note_names = synthetic_book_names(n_books, seed)
+    for book_name in book_names:
+        with open(os.path.join(book_dir, book_name), 'wb') as f:
+            f.write(rng.randbytes(1024))
+    for note_name in note_names:
+        title = note_name[:-len('.html')]
+        with open(os.path.join(note_dir, note_name), 'w', encoding='utf-8') as f:
+            f.write(synthetic_note_html(title, 'Author', highlights_per_book, rng, tags))
+    return book_dir, note_dir
+
+
+def get_git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_library(root='benchmark_library', n_books=100, highlights_per_book=200, parser='bs4', results_path='benchmark_results.json', seed=0):
+    '''
+    times each stage of loading and exporting a synthetic library of n_books x highlights_per_book highlights:
+    BookCollection, NoteCollection, get_notes_where, pickle load and export_to_obsidian (first and unchanged re-export).
+    The run is appended to the json list in results_path, so results can be compared across versions.
+    '''
+    from PocketBookNoteExtractor import MyCollection
+    from NoteCollections import NoteCollection
+
+    # made up tags, so only the highlights they were inserted in are tagged
+    tags = [tag for tag in synthetic_tags(len(WORDS) + 20, seed) if tag not in WORDS]
+    book_dir, note_dir = write_synthetic_library(root, n_books, highlights_per_book, seed, tags)
+    timings = {}
+
+    start = time.perf_counter()
+    book_collection = BookCollection(note_dir, book_dir)
+    timings['book_collection_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    note_collection = NoteCollection(book_collection, tags, HIGHLIGHT_SEMANTIC_MAPPING, parser=parser)
+    timings['note_collection_s'] = time.perf_counter() - start
+
+    # a collection without a device, holding the collections built above
+    collection = MyCollection.__new__(MyCollection)
+    collection.base_dir = root
+    collection.BookCollection = book_collection
+    collection.NoteCollection = note_collection
+
+    start = time.perf_counter()
+    n_results = len(collection.get_notes_where(tags=tags[:3], highlight_color='key_idea'))
+    timings['get_notes_where_s'] = time.perf_counter() - start
+
+    pickle_path = os.path.join(root, 'PocketBookCollection')
+    with open(pickle_path, 'wb') as p:
+        pickle.dump(collection, p)
+    start = time.perf_counter()
+    with open(pickle_path, 'rb') as p:
+        pickle.load(p)
+    timings['pickle_load_s'] = time.perf_counter() - start
+
+    export_dir = os.path.join(root, 'vault')
+    os.makedirs(export_dir, exist_ok=True)
+    for f in os.listdir(export_dir):
+        os.remove(os.path.join(export_dir, f))
+    start = time.perf_counter()
+    collection.export_to_obsidian(export_dir)
+    timings['export_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    collection.export_to_obsidian(export_dir)
+    timings['export_unchanged_s'] = time.perf_counter() - start
+
+    result = dict(
+        date=datetime.now().isoformat(timespec='seconds'),
+        revision=get_git_revision(),
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        books=len(book_collection.books),
+        notes=len(note_collection),
+        highlights_per_book=highlights_per_book,
+        parser=parser,
+        get_notes_where_results=n_results,
+        pickle_mb=os.path.getsize(pickle_path) / 1e6,
+        **timings,
+    )
+
+    runs = []
+    if results_path is not None:
+        if os.path.exists(results_path):
+            with open(results_path, 'r', encoding='utf-8') as f:
+                runs = json.load(f)
+        runs.append(result)
+        with open(results_path, 'w', encoding='utf-8') as f:
+            json.dump(runs, f, indent=1)
+
+    print(f'{result["books"]} books, {result["notes"]} notes ({parser} parser):')
+    for k, v in timings.items():
+        print(f'\t{k[:-2]:<20} {v:>8.3f}s')
+    return result
+
+
+QUERIES = (
+    'origin', 'gen*', '"selfish gene"', 'deep -learning', 'cosmos OR dune', 'machine learning NOT deep',
+    '"double helix" OR spring*', 'café', 'cafe', 'au_lait', 'naïve', "don't*", 'dont', 'C:\\notes', 'gene* -"selfish gene"',
+)
+
+
+def check_query_backends(root='benchmark_query', n_books=50, highlights_per_book=100, queries=QUERIES, seed=0):
+    '''
+    check MyCollection.query finds the same notes in the sqlite store (FTS5) as in a pickled collection
+    (NoteIndex), over a synthetic library with a few highlights with accents, underscores and apostrophes added
+    '''
+    from PocketBookNoteExtractor import MyCollection
+    from NoteCollections import NoteCollection
+    from CollectionStore import CollectionStore, StoredBookCollection, StoredNoteCollection
+
+    book_dir, note_dir = write_synthetic_library(root, n_books, highlights_per_book, seed)
+    book_collection = BookCollection(note_dir, book_dir)
+    note_collection = NoteCollection(book_collection, [], HIGHLIGHT_SEMANTIC_MAPPING)
+    extra = ['café au lait', 'cafe_au_lait and au_lait', 'a naïve reading', "don't panic, dont worry"]
+    note_collection.add_note_batch((True, [('standard', 1, text, None, None) for text in extra]), book_collection.books[0])
+
+    memory = MyCollection.__new__(MyCollection)
+    memory.BookCollection, memory.NoteCollection = book_collection, note_collection
+    store_path = os.path.join(root, 'PocketBookCollection.sqlite')
+    if os.path.exists(store_path):
+        os.remove(store_path)
+    store = CollectionStore(store_path)
+    store.save_collection(book_collection)
+    stored = MyCollection.__new__(MyCollection)
+    stored.BookCollection, stored.NoteCollection = StoredBookCollection(store), StoredNoteCollection(store)
+
+    for query in queries:
+        for book_id in (None, 0):
+            in_memory = {note.uid for note in memory.query(query, book_id=book_id)}
+            in_store = {note.uid for note in stored.query(query, book_id=book_id)}
+            assert in_memory == in_store, f'{query!r} (book_id={book_id}): {len(in_memory)} notes in memory, {len(in_store)} in the store'
+    store.close()
+    print(f'{len(queries)} queries find the same notes in the sqlite store and in memory')
+
+
+def time_command(args, repeats=5, cwd=None):
+    ''' best wall time of running a command, in seconds '''
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=cwd)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_startup(root='benchmark_library', n_books=50, highlights_per_book=100, repeats=5):
+    '''
+    startup time of the command line interface: a query against an existing collection (pickle and sqlite)
+    compared to a bare interpreter and to importing every module and heavy dependency up front
+    '''
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    cli = os.path.join(module_dir, 'cli.py')
+    write_synthetic_library(root, n_books, highlights_per_book)
+    for store in ('pickle', 'sqlite'):
+        subprocess.run(
+            [sys.executable, cli, 'parse', '--base-dir', root, '--store', store, '--no-sync', '--parser', 'stream'],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    full_import = (
+        'import PocketBookNoteExtractor, NoteCollections, DeviceSync, PocketBookDevice, ObsidianExport, '
+        'CollectionStore, Watcher, bs4, concurrent.futures.process, pprint'
+    )
+    commands = {
+        'interpreter': [sys.executable, '-c', 'pass'],
+        'import_all': [sys.executable, '-c', full_import],
+        'cli_help': [sys.executable, cli, '--help'],
+        'query_pickle': [sys.executable, cli, 'query', '--base-dir', root, 'gene'],
+        'query_sqlite': [sys.executable, cli, 'query', '--base-dir', root, '--store', 'sqlite', 'gene'],
+    }
+    result = {name: time_command(args, repeats, cwd=module_dir) for name, args in commands.items()}
+    for name, seconds in result.items():
+        print(f'{name:<14} {seconds * 1000:>8.1f} ms')
+    return result
+
+
+class SlowDevice:
+    ''' simulates copying from a slow USB device, each transfer sleeps as long as mb_per_s would take '''
+
+    def __init__(self, mb_per_s=5.0):
+        self.mb_per_s = mb_per_s
+
+    def __enter__(self):
+        from DeviceSync import TransferPool
+        self.transfer = TransferPool.transfer
+        mb_per_s, transfer = self.mb_per_s, self.transfer
+
+        def slow_transfer(pool, src_file, dst_file):
+            time.sleep(os.path.getsize(src_file) / 1e6 / mb_per_s)
+            return transfer(pool, src_file, dst_file)
+        TransferPool.transfer = slow_transfer
+        return self
+
+    def __exit__(self, *exc):
+        from DeviceSync import TransferPool
+        TransferPool.transfer = self.transfer
+
+
+def bench_pipeline(root='benchmark_pipeline', n_books=60, highlights_per_book=200, book_kb=512, mb_per_s=10.0, parse_workers=1):
+    '''
+    wall time of loading a library from a (simulated, mb_per_s) device into an empty base_dir, staged vs pipelined,
+    next to the time of copying only and of parsing only. A pipelined load should take about as long
+    as the slower of the two instead of their sum. Checks both loads give the same notes.
+    '''
+    import shutil
+    from PocketBookNoteExtractor import MyCollection
+
+    device_dir = os.path.join(root, 'device')
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    book_dir, note_dir = write_synthetic_library(os.path.join(root, 'library'), n_books, highlights_per_book)
+    os.makedirs(device_dir)
+    shutil.copytree(book_dir, os.path.join(device_dir, 'Downloads'))
+    shutil.copytree(note_dir, os.path.join(device_dir, 'Notes'))
+    # book files large enough for copying to matter
+    for el in os.listdir(os.path.join(device_dir, 'Downloads')):
+        with open(os.path.join(device_dir, 'Downloads', el), 'ab') as f:
+            f.write(bytes(book_kb * 1024))
+
+    def load(mode, **kwargs):
+        base_dir = os.path.join(root, mode)
+        os.makedirs(base_dir)
+        options = dict(
+            base_dir=base_dir, device_backend='directory', device_path=device_dir, note_parser='stream',
+            parse_workers=parse_workers, use_parse_cache=False,
+        )
+        options.update(kwargs)
+        start = time.perf_counter()
+        with SlowDevice(mb_per_s):
+            collection = MyCollection(**options)
+        return time.perf_counter() - start, collection
+
+    timings, notes = {}, {}
+    for mode, kwargs in (('staged', {}), ('pipelined', dict(pipelined=True))):
+        timings[mode], collection = load(mode, **kwargs)
+        notes[mode] = [(n.book_name, n.page_number, n.text, n.note, n.tags) for n in collection.NoteCollection]
+    assert notes['staged'] == notes['pipelined'], 'pipelined load gave different notes'
+
+    # the stages on their own, copying into an empty base_dir and parsing the copied files
+    base_dir = os.path.join(root, 'copy_only')
+    os.makedirs(base_dir)
+    start = time.perf_counter()
+    collection = MyCollection(
+        base_dir=base_dir, device_backend='directory', device_path=device_dir, note_parser='stream',
+        parse_workers=parse_workers, use_parse_cache=False, autoload=False,
+    )
+    collection.init_note_directories()
+    with SlowDevice(mb_per_s):
+        collection.update_collection_from_device()
+    timings['copy_only'] = time.perf_counter() - start
+    start = time.perf_counter()
+    collection.build_collections()
+    timings['parse_only'] = time.perf_counter() - start
+
+    print(f'{n_books} books, {len(notes["staged"])} notes, device at {mb_per_s} MB/s:')
+    for k, v in timings.items():
+        print(f'\t{k:<12} {v:>8.2f}s')
+    return timings
+
+
+def bench_streaming_memory(root='benchmark_streaming', library_sizes=(1, 10, 40), highlights_per_book=1000, per_book_kb=4):
+    '''
+    peak traced memory of loading and exporting libraries of growing size with streaming=True, against loading
+    the whole collection. Asserts the streaming peak stays within twice the peak of a library of one book
+    (the largest book, all books have the same size) plus per_book_kb for the Book objects kept for every book.
+    '''
+    import gc
+    import shutil
+    import tracemalloc
+    from PocketBookNoteExtractor import MyCollection
+
+    def peak_memory(base_dir, streaming):
+        collection = MyCollection(
+            base_dir=base_dir, device_backend='directory', device_path=os.path.join(base_dir, 'no_device'),
+            store='sqlite', streaming=streaming, use_parse_cache=False, autoload=False,
+        )
+        collection.init_note_directories()
+        export_dir = os.path.join(base_dir, 'vault')
+        os.makedirs(export_dir, exist_ok=True)
+        gc.collect()
+        tracemalloc.start()
+        if streaming:
+            collection.stream_collection(export_dir)
+        else:
+            collection.build_collections()
+            collection.save_store()
+            collection.export_to_obsidian(export_dir)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    results = []
+    for n_books in library_sizes:
+        base_dir = os.path.join(root, f'library_{n_books}')
+        if os.path.exists(base_dir):
+            shutil.rmtree(base_dir)
+        write_synthetic_library(base_dir, n_books, highlights_per_book)
+        streaming_mb = peak_memory(base_dir, True) / 1e6
+        for el in ('vault', 'PocketBookCollection.sqlite'):
+            shutil.rmtree(os.path.join(base_dir, el), ignore_errors=True)
+            if os.path.isfile(os.path.join(base_dir, el)):
+                os.remove(os.path.join(base_dir, el))
+        results.append(dict(books=n_books, streaming_mb=streaming_mb, in_memory_mb=peak_memory(base_dir, False) / 1e6))
+
+    single_book = results[0]['streaming_mb']
+    print(f'{"books":>6} {"streaming (MB)":>15} {"in memory (MB)":>15}')
+    for r in results:
+        print(f'{r["books"]:>6} {r["streaming_mb"]:>15.1f} {r["in_memory_mb"]:>15.1f}')
+        bound = 2 * single_book + r['books'] * per_book_kb / 1e3
+        assert r['streaming_mb'] <= bound, f'streaming peak {r["streaming_mb"]:.1f} MB exceeds {bound:.1f} MB for {r["books"]} books'
+    return results
+
+
+def bench_groupby(n_books=200, notes_per_book=600, repeats=5):
+    '''
+    time NoteTable.groupby summaries over n_books x notes_per_book notes against counting with a python loop
+    over the notes, checking both give the same counts
+    '''
+    from collections import Counter
+    from datetime import timedelta
+    from BookCollections import Book
+    from NoteCollections import NoteCollection
+    from NoteTable import NoteTable
+
+    rng = random.Random(0)
+    note_collection = NoteCollection([], [], {})
+    note_collection.index = None
+    for book_id, (book_name, batch) in enumerate(synthetic_note_batches(n_books, notes_per_book)):
+        book = Book(book_id, Path('books', book_name), Path('notes', book_name + '.html'))
+        note_collection.add_note_batch(batch, book)
+    # spread the notes over a few years and give some of them a second tag
+    start_date = datetime(2020, 1, 1)
+    for note in note_collection:
+        note.date_created = start_date + timedelta(days=rng.randrange(1500))
+        if rng.random() < 0.2:
+            note.tags = (note.tags or set()) | {rng.choice(WORDS)}
+    notes = note_collection.notes
+
+    start = time.perf_counter()
+    table = NoteTable(notes)
+    build_s = time.perf_counter() - start
+
+    def loop_summary(grouper):
+        if grouper == 'highlight_color':
+            return Counter(note.highlight_color for note in notes)
+        if grouper == ('book', 'tag'):
+            return Counter((note.book.book_name, tag) for note in notes for tag in (note.tags or ()))
+        if grouper == 'page':
+            return Counter(note.page_number // 25 * 25 for note in notes)
+        return Counter(note.date_created.strftime('%Y-%m') for note in notes)
+
+    def table_summary(grouper):
+        if isinstance(grouper, tuple):
+            summary = table.groupby(list(grouper))
+            keys = list(zip(*(summary[g].tolist() for g in grouper)))
+        else:
+            summary = table.groupby(grouper, page_bin=25)
+            keys = summary[grouper]
+            if grouper == 'month':
+                # months as YYYY-MM strings like strftime
+                keys = keys.astype(str)
+            keys = keys.tolist()
+        return dict(zip(keys, summary['notes'].tolist()))
+
+    results = []
+    for grouper in ('highlight_color', ('book', 'tag'), 'page', 'month'):
+        timings = {}
+        for name, summarize in (('loop', loop_summary), ('table', table_summary)):
+            best = None
+            for _ in range(repeats):
+                start = time.perf_counter()
+                summary = summarize(grouper)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = (best, summary)
+        assert dict(timings['loop'][1]) == timings['table'][1], f'summaries differ for {grouper}'
+        results.append(dict(
+            grouper='/'.join(grouper) if isinstance(grouper, tuple) else grouper, groups=len(timings['table'][1]),
+            loop_ms=timings['loop'][0] * 1e3, table_ms=timings['table'][0] * 1e3,
+        ))
+
+    print(f'{len(notes)} notes, table built in {build_s:.2f}s')
+    print(f'{"grouper":>16} {"groups":>8} {"loop (ms)":>10} {"table (ms)":>11}')
+    for r in results:
+        print(f'{r["grouper"]:>16} {r["groups"]:>8} {r["loop_ms"]:>10.1f} {r["table_ms"]:>11.1f}')
+    return dict(notes=len(notes), build_s=build_s, summaries=results)
+
+
+def bench_tail_parse(root='benchmark_tail', sizes=(1000, 5000, 20000), appended=20, parser='bs4'):
+    '''
+    time parsing a note file of each size, then only the highlights appended to it with the parse cache,
+    checking the result equals parsing the whole file again, and that editing a highlight falls back to a full parse
+    '''
+    import shutil
+    from BookCollections import Book
+    from NoteCollections import NoteCollection
+    from ParseCache import ParseCache
+
+    tags = ['machine learning']
+    results = []
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+    for n_highlights in sizes:
+        rng = random.Random(n_highlights)
+        note_path = Path(root, f'Book {n_highlights}.html')
+        with open(note_path, 'w', encoding='utf-8') as f:
+            f.write(synthetic_note_html(f'Book {n_highlights}', 'Author', n_highlights, rng, tags))
+        book = Book(0, Path(root, f'Author - Book {n_highlights} - Press (2000).epub'), note_path)
+        cache_path = os.path.join(root, f'cache_{n_highlights}')
+
+        def load_cache():
+            # a new ParseCache per load, like separate runs
+            cache = ParseCache(cache_path, tags, HIGHLIGHT_SEMANTIC_MAPPING)
+            return cache, NoteCollection([], tags, HIGHLIGHT_SEMANTIC_MAPPING, parser=parser, cache=cache)
+
+        cache, note_collection = load_cache()
+        start = time.perf_counter()
+        batch = note_collection.read_book_note_batch(book)
+        full_s = time.perf_counter() - start
+        cache.put(note_path, batch)
+        cache.save()
+
+        append_synthetic_highlights(note_path, appended, rng, n_highlights, tags)
+        cache, note_collection = load_cache()
+        start = time.perf_counter()
+        tail_batch = note_collection.get_cached_batch(book)
+        tail_s = time.perf_counter() - start
+        assert cache.stats['tail_hits'] == 1, 'appended highlights were not parsed from the tail'
+        assert tail_batch == note_collection.read_note_batch(note_path), f'tail parse differs for {n_highlights} highlights'
+        cache.save()
+
+        # an edited highlight changes the start of the file
+        with open(note_path, 'r', encoding='utf-8') as f:
+            contents = f.read()
+        with open(note_path, 'w', encoding='utf-8') as f:
+            f.write(contents.replace('id="bm1">', 'id="bm1" data-edited="1">', 1).replace('<p class="bm-page">', '<p class="bm-page">1', 3))
+        cache, note_collection = load_cache()
+        assert note_collection.get_cached_batch(book) is None, 'an edited note file was not parsed again'
+        results.append(dict(highlights=n_highlights, appended=appended, full_s=full_s, tail_s=tail_s))
+
+    print(f'{"highlights":>10} {"appended":>9} {"full parse (s)":>15} {"tail parse (s)":>15}')
+    for r in results:
+        print(f'{r["highlights"]:>10} {r["appended"]:>9} {r["full_s"]:>15.3f} {r["tail_s"]:>15.4f}')
+    return results
+
+
+def synthetic_export_books(n_books, notes_per_book):
+    ''' (note collection, books) of synthetic notes, the same in every process '''
+    from BookCollections import Book
+    from NoteCollections import NoteCollection
+
+    note_collection = NoteCollection([], [], {})
+    note_collection.index = None
+    books = []
+    for book_id, (book_name, batch) in enumerate(synthetic_note_batches(n_books, notes_per_book)):
+        book = Book(book_id, Path('books', book_name + '.epub'), Path('notes', book_name + '.html'))
+        book.extracted_info = False
+        note_collection.add_note_batch(batch, book)
+        books.append(book)
+    return note_collection, books
+
+
+def export_synthetic_obsidian(export_dir, n_books, notes_per_book):
+    ''' export synthetic books to markdown without the fragment cache, printing how many files were written '''
+    from ObsidianExport import export_books
+
+    _, books = synthetic_export_books(n_books, notes_per_book)
+    report = export_books(books, export_dir)
+    print(json.dumps(dict(written=len(report['written']), unchanged=len(report['unchanged']))))
+
+
+def export_in_new_process(export_dir, n_books, notes_per_book, hash_seed):
+    ''' export_synthetic_obsidian in a new interpreter with PYTHONHASHSEED=hash_seed, returns its counts '''
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    code = f'from Benchmarks import export_synthetic_obsidian; export_synthetic_obsidian({os.path.abspath(export_dir)!r}, {n_books}, {notes_per_book})'
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed))
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True, cwd=module_dir, env=env).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_export_formats(root='benchmark_export', n_books=100, notes_per_book=500, formats=('obsidian', 'jsonl', 'csv', 'anki')):
+    '''
+    time exporting to every format with one walk per format, with one walk for all formats, and again with one walk
+    once the fragment cache is warm, checking the walks write the same files.
+    Also checks a markdown export of unchanged notes in a new process (another hash seed) writes no files
+    '''
+    import shutil
+    from Exporters import export_collection
+
+    note_collection, books = synthetic_export_books(n_books, notes_per_book)
+
+    def export(export_dir, walks):
+        if os.path.exists(export_dir):
+            shutil.rmtree(export_dir)
+        os.makedirs(export_dir)
+        start = time.perf_counter()
+        for walk_formats in walks:
+            export_collection(books, export_dir, formats=walk_formats)
+        return time.perf_counter() - start
+
+    separate_dir, single_dir = os.path.join(root, 'separate'), os.path.join(root, 'single')
+    separate_s = export(separate_dir, [(f,) for f in formats])
+    single_s = export(single_dir, [formats])
+    start = time.perf_counter()
+    report = export_collection(books, single_dir, formats=formats)
+    cached_s = time.perf_counter() - start
+    assert report['fragments']['rendered'] == 0, 'unchanged notes were rendered again'
+    for file_name in os.listdir(single_dir):
+        if not file_name.startswith('.'):
+            with open(os.path.join(separate_dir, file_name), 'rb') as a, open(os.path.join(single_dir, file_name), 'rb') as b:
+                assert a.read() == b.read(), f'{file_name} differs'
+    process_dir = os.path.join(root, 'process')
+    if os.path.exists(process_dir):
+        shutil.rmtree(process_dir)
+    os.makedirs(process_dir)
+    first = export_in_new_process(process_dir, n_books, notes_per_book, hash_seed=1)
+    for hash_seed in (2, 3):
+        counts = export_in_new_process(process_dir, n_books, notes_per_book, hash_seed=hash_seed)
+        assert counts['written'] == 0, f'{counts["written"]} of {first["written"]} unchanged files were written again in a new process'
+
+    result = dict(notes=len(note_collection), formats=len(formats), separate_s=separate_s, single_s=single_s, cached_s=cached_s)
+    print(f'{result["notes"]} notes to {len(formats)} formats: {separate_s:.2f}s with a walk per format, '
+          f'{single_s:.2f}s in one walk, {cached_s:.2f}s in one walk with cached fragments')
+    return result
+
+
+if __name__ == '__main__':
+    from Instrumentation import setup_logging
+    setup_logging()
+    bench_map_book_notes()
+    bench_similar_matching()
+    bench_infer_tags()
+    bench_note_memory()
+    bench_library()
+    check_query_backends()
+    bench_startup()
+    bench_pipeline()
+    bench_streaming_memory()
+    bench_groupby()
+    bench_tail_parse()
+    bench_export_formats()
@@ -1,8 +1,20 @@
 
 import string
 import re
+import unicodedata
+from bisect import bisect_right
 
-from utils import get_dir_contents, clean_text
+from utils import get_dir_contents, clean_text, OutdatedPickleError
+from CollectionSnapshot import get_book_uid
+from TextMatchers import AhoCorasick, NgramIndex
+from Instrumentation import log, get_instrumentation
+
+
+PUNCTUATION_RE = re.compile('[%s]' % re.escape(string.punctuation))
+YEAR_RE = re.compile(r'\d{4}')
+NON_ALNUM_RE = re.compile(r'[\W_]+')
+# lower scoring books listed for each unmatched note by print_no_matches
+MAX_SUGGESTIONS = 3
 
 class BookCollection():
     '''
@@ -10,15 +22,27 @@ class BookCollection():
     Description
     ~~~~~~~~~~~
         Stores all book-note mappings. Stores ref to book and notes.
+        note_paths/book_paths: paths to match instead of listing note_dir and book_dir,
+        e.g. the local paths files on the device will be copied to.
+        Notes and books are paired when the normalized name of one contains the other. The ones left over
+        are paired by the similarity of their names (dice coefficient of character trigrams, see match_similar):
+        pairs scoring match_threshold or more are matched, lower scores down to suggest_threshold are only
+        suggested, see print_no_matches. match_threshold=None turns this off.
 
     ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
     '''
 
-    def __init__(self, note_dir, book_dir):
+    def __init__(self, note_dir, book_dir, note_paths=None, book_paths=None, match_threshold=0.8, suggest_threshold=0.5):
         self.note_dir = note_dir
         self.book_dir = book_dir
+        self.note_paths = note_paths
+        self.book_paths = book_paths
+        self.match_threshold = match_threshold
+        self.suggest_threshold = suggest_threshold
         
         self.books = []
+        # normalized stem of every book and note path, see normalize_stem
+        self.normalized = {}
         self.get_collection()
 
 
@@ -27,10 +51,13 @@ class BookCollection():
 
     def get_collection(self):
         # get paths to books and notes
-        self.note_paths = get_dir_contents(self.note_dir)
-        self.book_paths = get_dir_contents(self.book_dir)
+        if self.note_paths is None:
+            self.note_paths = get_dir_contents(self.note_dir)
+        if self.book_paths is None:
+            self.book_paths = get_dir_contents(self.book_dir)
         # merge into dict, match book name to 
-        self.map_book_notes()
+        with get_instrumentation().stage('match_books'):
+            self.map_book_notes()
         # create book and note objects
         self.init_book_objs()
 
@@ -41,43 +68,142 @@ class BookCollection():
 
     def map_book_notes(self):
         self.book_notes = {}
-        self.no_note_books = self.book_paths.copy()
-        self.no_book_notes = self.note_paths.copy()
+        # normalize every stem once
+        for p in self.book_paths + self.note_paths:
+            self.normalize_stem(p)
         book_i = 0
-        for book_fn in self.book_paths:
-            amatch = self.match_note_str_to_book(book_fn, self.note_paths)
-            if amatch:
-                self.book_notes[book_i] = {'book_fn':amatch[0], 'note_fn':amatch[1]}
-                self.no_book_notes.remove(amatch[1])
-                self.no_note_books.remove(amatch[0])
+
+        # first pass: books whose name contains a note name, first note in sorted order wins
+        note_index = AhoCorasick([self.normalized[p] for p in self.note_paths])
+        matched_notes, matched_books = set(), set()
+        for book_id, book_fn in enumerate(self.book_paths):
+            note_ids = note_index.find_all(self.normalized[book_fn])
+            if note_ids:
+                note_id = min(note_ids)
+                if note_id in matched_notes:
+                    raise ValueError(f'note file {self.note_paths[note_id]} matches more than one book')
+                self.book_notes[book_i] = {'book_fn':book_fn, 'note_fn':self.note_paths[note_id]}
+                matched_notes.add(note_id)
+                matched_books.add(book_id)
                 book_i +=1
-        
-        for note_fn in self.no_book_notes:
-            amatch = self.match_note_str_to_book(note_fn, self.no_note_books)
-            if amatch:
-                self.book_notes[book_i] = {'book_fn':amatch[1], 'note_fn':amatch[0]}
-                self.no_book_notes.remove(amatch[0])
-                self.no_note_books.remove(amatch[1])
+        unmatched_notes = [p for i, p in enumerate(self.note_paths) if i not in matched_notes]
+        candidate_books = [p for i, p in enumerate(self.book_paths) if i not in matched_books]
+
+        # second pass: unmatched notes whose name contains the name of a still unmatched book
+        book_index = AhoCorasick([self.normalized[p] for p in candidate_books])
+        paired_notes, paired_books = set(), set()
+        skip_next = False
+        for note_id, note_fn in enumerate(unmatched_notes):
+            # matching used to remove notes from the list being iterated, which skipped the next note
+            if skip_next:
+                skip_next = False
+                continue
+            book_ids = book_index.find_all(self.normalized[note_fn]) - paired_books
+            if book_ids:
+                book_id = min(book_ids)
+                self.book_notes[book_i] = {'book_fn':candidate_books[book_id], 'note_fn':note_fn}
+                paired_notes.add(note_id)
+                paired_books.add(book_id)
+                skip_next = True
                 book_i +=1
+        self.no_book_notes = [p for i, p in enumerate(unmatched_notes) if i not in paired_notes]
+        self.no_note_books = [p for i, p in enumerate(candidate_books) if i not in paired_books]
+
+        # third pass: pair what is left by the similarity of the names
+        self.match_similar()
 
-        print(f'found {len(self.book_notes)} books and note matches')
-        print(f'{len(self.no_book_notes)} notes were not matched')
-        print(f'{len(self.no_note_books)} books were not matched')
+        counts = dict(
+            books_matched=len(self.book_notes), books_matched_similar=len(self.similar_matches),
+            notes_unmatched=len(self.no_book_notes), books_unmatched=len(self.no_note_books),
+        )
+        instrumentation = get_instrumentation()
+        for k, v in counts.items():
+            instrumentation.count(k, v)
+        log.info(f'found {len(self.book_notes)} books and note matches', extra=dict(stage='match_books', **counts))
+        if self.similar_matches:
+            log.info(f'{len(self.similar_matches)} books were matched to notes with similar names')
+        log.info(f'{len(self.no_book_notes)} notes were not matched')
+        log.info(f'{len(self.no_note_books)} books were not matched')
+
+    def match_similar(self):
+        '''
+        pair unmatched notes and books whose names are similar, best score first and each note and book once.
+        Sets similar_matches to (note path, book path, score) of the pairs scoring match_threshold or more,
+        and suggestions to {note path: [(book path, score)]} for the notes still unmatched
+        '''
+        self.similar_matches = []
+        self.suggestions = {}
+        notes, books = self.no_book_notes, self.no_note_books
+        thresholds = [t for t in (self.match_threshold, self.suggest_threshold) if t is not None]
+        if not notes or not books or self.match_threshold is None:
+            return
+        # books are found by their whole name and by their title, a note scores the best of the two
+        texts, text_books = [], []
+        for book_id, book_fn in enumerate(books):
+            for text in {self.similarity_stem(book_fn.stem), self.similarity_stem(get_book_title(book_fn.stem))}:
+                if text:
+                    texts.append(text)
+                    text_books.append(book_id)
+        book_index = NgramIndex(texts)
+        pairs = []
+        for note_id, note_fn in enumerate(notes):
+            scores = {}
+            for score, text_id in book_index.search(self.similarity_stem(note_fn.stem), min_score=min(thresholds)):
+                book_id = text_books[text_id]
+                scores[book_id] = max(score, scores.get(book_id, 0.0))
+            pairs.extend((score, note_id, book_id) for book_id, score in scores.items())
+        pairs.sort(key=lambda pair: (-pair[0], pair[1], pair[2]))
+
+        paired_notes, paired_books = set(), set()
+        for score, note_id, book_id in pairs:
+            if score < self.match_threshold:
+                break
+            if note_id in paired_notes or book_id in paired_books:
+                continue
+            self.book_notes[len(self.book_notes)] = {'book_fn':books[book_id], 'note_fn':notes[note_id]}
+            self.similar_matches.append((notes[note_id], books[book_id], score))
+            paired_notes.add(note_id)
+            paired_books.add(book_id)
+        if self.suggest_threshold is not None:
+            for score, note_id, book_id in pairs:
+                if score < self.suggest_threshold:
+                    break
+                if note_id in paired_notes or book_id in paired_books:
+                    continue
+                suggestions = self.suggestions.setdefault(notes[note_id], [])
+                if len(suggestions) < MAX_SUGGESTIONS:
+                    suggestions.append((books[book_id], score))
+        self.no_book_notes = [p for i, p in enumerate(notes) if i not in paired_notes]
+        self.no_note_books = [p for i, p in enumerate(books) if i not in paired_books]
+
+    @staticmethod
+    def similarity_stem(stem):
+        ''' name compared by match_similar: accents removed, lowercase letters and digits only '''
+        if not stem:
+            return ''
+        stem = unicodedata.normalize('NFKD', stem)
+        stem = ''.join(ch for ch in stem if not unicodedata.combining(ch))
+        return NON_ALNUM_RE.sub('', stem.lower())
     
     
     def match_note_str_to_book(self, to_search_for, to_search_in):
-        book_str = self.strip_punctuation(to_search_for.stem).lower()
+        book_str = self.normalize_stem(to_search_for)
         for note_fn in to_search_in:
-            note_str = self.strip_punctuation(note_fn.stem).lower()
+            note_str = self.normalize_stem(note_fn)
             if note_str in book_str:
                 return (to_search_for, note_fn)
 
         # print(f'no notes found for book: {book_str}')
         return None
+
+    def normalize_stem(self, path):
+        ''' normalized stem used to match books to notes, computed once per path '''
+        if path not in self.normalized:
+            self.normalized[path] = self.strip_punctuation(path.stem).lower()
+        return self.normalized[path]
     
     def strip_punctuation(self, s):
-        regex = re.compile('[%s]' % re.escape(string.punctuation))
-        result = regex.sub('', s.lower())
+        result = PUNCTUATION_RE.sub('', s.lower())
         result = result.replace('the', '')
         result = result.replace(' a ', '')
         result = result.replace('novel', '')
@@ -85,13 +211,30 @@ class BookCollection():
         return(result)
 
     def print_no_matches(self):
+        suggestions = getattr(self, 'suggestions', {})
         for el in self.no_book_notes:
             print(el.stem)
+            # books with similar names that scored below match_threshold
+            for book_fn, score in suggestions.get(el, ()):
+                print(f'\t{score:.2f} {book_fn.stem}')
         print()
         for el in self.no_note_books:
             print(el.stem)
 
 
+def get_book_title(book_name):
+    ''' title of a book named 'authors - title - publisher (year)' as Book.extract_book_info reads it, None for other names '''
+    auth_ind = book_name.find('-')
+    remaining = book_name[auth_ind + 1:]
+    if auth_ind == -1 or '(' not in remaining:
+        return None
+    remaining = remaining[:remaining.rfind('(')]
+    publisher_ind = remaining.rfind('-')
+    if publisher_ind != -1:
+        remaining = remaining[:publisher_ind]
+    return remaining.strip() or None
+
+
 class Book:
     '''
     ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
@@ -101,12 +244,21 @@ class Book:
 
     ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
     '''
+    __slots__ = (
+        'book_id', 'book_path', 'note_path', 'file_type', 'notes', 'extracted_info',
+        'book_name', 'author', 'publisher', 'year', 'has_page_numbers',
+        'notes_by_page', 'page_keys',
+    )
+
     def __init__(self, book_id, book_path, note_path):
         self.book_id = book_id
         self.book_path = book_path
         self.note_path = note_path
         self.file_type = clean_text(self.book_path.suffix).replace('_', '')
         self.notes = []
+        # notes kept in page order as they are added, ties stay in the order they were added
+        self.notes_by_page = []
+        self.page_keys = []
         self.extracted_info = False
 
         extracted = self.extract_book_info(book_path.stem)
@@ -149,13 +301,61 @@ class Book:
             result_dict['book_name'] = remaining.strip()
             result_dict['author'] = authors
             result_dict['publisher'] = publisher
-            result_dict['year'] = int(year)
+            # e.g. '(2nd edition)' or '(1999) [epub]' used to crash int(year)
+            m = YEAR_RE.search(year)
+            result_dict['year'] = int(m.group(0)) if m else None
             self.extracted_info = True
         
         return result_dict
+
+    @property
+    def book_uid(self):
+        ''' stable id of the book, from its file name, see CollectionSnapshot.get_book_uid '''
+        return get_book_uid(self.book_path)
+
+    def set_metadata(self, metadata):
+        ''' replace the info extracted from the file name by the metadata read from the book file, see BookMetadata '''
+        from BookMetadata import clean_title
+        if not metadata or not (metadata.get('title') or metadata.get('authors')):
+            return
+        if metadata.get('title'):
+            self.book_name = clean_title(metadata['title'])
+        if metadata.get('authors'):
+            self.author = list(metadata['authors'])
+        elif self.author is None:
+            self.author = []
+        for k in ('publisher', 'year'):
+            if metadata.get(k) is not None:
+                setattr(self, k, metadata[k])
+        self.extracted_info = True
     
     def add_note(self, anote):
         self.notes.append(anote)
+        i = bisect_right(self.page_keys, anote.page_number)
+        self.page_keys.insert(i, anote.page_number)
+        self.notes_by_page.insert(i, anote)
+
+    def clear_notes(self):
+        self.notes = []
+        self.notes_by_page = []
+        self.page_keys = []
+
+    def __setstate__(self, state):
+        # slotted books are pickled as (None, {slot: value}), books pickled before __slots__ as a dict
+        if isinstance(state, dict):
+            raise OutdatedPickleError('Book was pickled by an older version without __slots__')
+        for attr, val in state[1].items():
+            setattr(self, attr, val)
+
+    def get_notes_in_page_order(self):
+        ''' notes sorted by page number if the note file had them, otherwise in the order they were added '''
+        if not getattr(self, 'has_page_numbers', False):
+            return self.notes
+        notes_by_page = getattr(self, 'notes_by_page', None)
+        if notes_by_page is None or len(notes_by_page) != len(self.notes):
+            # e.g. books loaded from a CollectionStore
+            return sorted(self.notes, key=lambda x: int(x.page_number))
+        return notes_by_page
     
     def get_book_info_as_export_str(self, export_to='obsidian'):
         if export_to == 'obsidian':
@@ -0,0 +1,435 @@
+import os
+import re
+import json
+import zlib
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+
+from Instrumentation import log
+
+
+'''
+reads title, authors, publisher and year from the metadata of book files, reading only the parts of a file that hold them:
+    epub: the zip central directory, the container and the OPF package document
+    pdf:  the cross-reference table or stream at the end of the file, then the Info dictionary it points to
+'''
+
+YEAR_RE = re.compile(r'(\d{4})')
+# characters that can not be used in the file name of an exported book
+FILE_NAME_RE = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+DC = '{http://purl.org/dc/elements/1.1/}'
+OPF = '{http://www.idpf.org/2007/opf}'
+CONTAINER = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+
+
+def metadata_dict(title=None, authors=None, publisher=None, year=None):
+    ''' the fields set by Book.set_metadata, fields that were not found are None '''
+    return dict(title=title or None, authors=authors or None, publisher=publisher or None, year=year)
+
+
+def parse_year(s):
+    if not s:
+        return None
+    m = YEAR_RE.search(s)
+    return int(m.group(1)) if m else None
+
+
+def clean_title(title):
+    ''' a title usable as the name of the exported markdown file '''
+    return ' '.join(FILE_NAME_RE.sub(' ', title).split())
+
+
+###################################################################################################
+# epub
+
+def read_epub_metadata(path):
+    ''' metadata from the OPF package document, zipfile only reads the central directory and the two members '''
+    with zipfile.ZipFile(path) as zf:
+        container = ET.fromstring(zf.read('META-INF/container.xml'))
+        rootfile = container.find(f'.//{CONTAINER}rootfile')
+        if rootfile is None:
+            return None
+        opf = ET.fromstring(zf.read(rootfile.get('full-path')))
+    metadata = opf.find(f'{OPF}metadata')
+    if metadata is None:
+        return None
+
+    def texts(tag):
+        return [el.text.strip() for el in metadata.iter(f'{DC}{tag}') if el.text and el.text.strip()]
+
+    titles, dates = texts('title'), texts('date')
+    publishers = texts('publisher')
+    return metadata_dict(
+        title=titles[0] if titles else None,
+        authors=texts('creator'),
+        publisher=publishers[0] if publishers else None,
+        year=parse_year(dates[0]) if dates else None,
+    )
+
+
+###################################################################################################
+# pdf
+
+class PdfInfoReader:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Finds the Info dictionary of a pdf without reading the whole file: startxref at the end of the file gives
+        the offset of the last cross-reference section, either a classic xref table followed by a trailer,
+        or (pdf 1.5+) a compressed xref stream. Sections are followed through /Prev until one holds the Info
+        reference, then the Info object is read at the offset the cross-reference gives for it,
+        from inside a compressed object stream if needed.
+        Encrypted pdfs are skipped, their strings can not be read without decrypting them.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    TAIL_SIZE = 4096
+    CHUNK_SIZE = 64 * 1024
+    MAX_SECTIONS = 32
+
+    def __init__(self, f):
+        self.f = f
+        self.f.seek(0, os.SEEK_END)
+        self.size = self.f.tell()
+        # object number -> ('offset', offset) or ('stream', object stream number, index)
+        self.xref = {}
+
+    def read_at(self, offset, size):
+        self.f.seek(offset)
+        return self.f.read(size)
+
+    def read_info(self):
+        tail = self.read_at(max(0, self.size - self.TAIL_SIZE), self.TAIL_SIZE)
+        m = list(re.finditer(rb'startxref\s+(\d+)', tail))
+        if not m:
+            return None
+        offset = int(m[-1].group(1))
+        info_ref, visited = None, set()
+        while offset is not None and offset not in visited and len(visited) < self.MAX_SECTIONS:
+            visited.add(offset)
+            trailer = self.read_xref_section(offset)
+            if trailer is None or b'/Encrypt' in trailer:
+                return None
+            if info_ref is None:
+                ref = re.search(rb'/Info\s+(\d+)\s+\d+\s+R', trailer)
+                if ref:
+                    info_ref = int(ref.group(1))
+            if info_ref is not None and info_ref in self.xref:
+                break
+            prev = re.search(rb'/Prev\s+(\d+)', trailer)
+            offset = int(prev.group(1)) if prev else None
+        if info_ref is None or info_ref not in self.xref:
+            return None
+        info = self.read_object(info_ref)
+        return parse_pdf_dict(info) if info is not None else None
+
+    def read_xref_section(self, offset):
+        ''' adds the entries of the section at offset to self.xref (newer sections win), returns its trailer dict '''
+        data = self.read_at(offset, self.CHUNK_SIZE)
+        if data.startswith(b'xref'):
+            return self.read_xref_table(offset)
+        if re.match(rb'\s*\d+\s+\d+\s+obj', data):
+            return self.read_xref_stream(offset, data)
+        return None
+
+    def read_xref_table(self, offset):
+        self.f.seek(offset)
+        self.f.readline()
+        while True:
+            line = self.f.readline()
+            if not line:
+                return None
+            header = line.split()
+            if not header:
+                continue
+            if header[0].startswith(b'trailer'):
+                rest = line[line.index(b'trailer') + len(b'trailer'):] + self.f.read(self.CHUNK_SIZE)
+                return get_dict_source(rest)
+            start, count = int(header[0]), int(header[1])
+            # entries are 20 bytes long, skip the ones that were already found in a newer section
+            entries = self.f.read(20 * count)
+            for i in range(count):
+                entry = entries[20 * i: 20 * i + 20].split()
+                if len(entry) == 3 and entry[2] == b'n' and start + i not in self.xref:
+                    self.xref[start + i] = ('offset', int(entry[0]))
+
+    def read_xref_stream(self, offset, data):
+        source = get_dict_source(data)
+        if source is None:
+            return None
+        widths = [int(w) for w in re.search(rb'/W\s*\[([^\]]*)\]', source).group(1).split()]
+        index = re.search(rb'/Index\s*\[([^\]]*)\]', source)
+        if index:
+            numbers = [int(n) for n in index.group(1).split()]
+            ranges = list(zip(numbers[::2], numbers[1::2]))
+        else:
+            ranges = [(0, int(re.search(rb'/Size\s+(\d+)', source).group(1)))]
+        rows = self.read_stream(offset, data, source)
+        row_size = sum(widths)
+        i = 0
+        for start, count in ranges:
+            for number in range(start, start + count):
+                row = rows[i * row_size: (i + 1) * row_size]
+                i += 1
+                if len(row) < row_size:
+                    return source
+                fields, pos = [], 0
+                for w in widths:
+                    fields.append(int.from_bytes(row[pos:pos + w], 'big') if w else None)
+                    pos += w
+                entry_type = 1 if fields[0] is None else fields[0]
+                if number in self.xref:
+                    continue
+                if entry_type == 1:
+                    self.xref[number] = ('offset', fields[1])
+                elif entry_type == 2:
+                    self.xref[number] = ('stream', fields[1], fields[2])
+        return source
+
+    def read_stream(self, offset, data, source):
+        ''' decoded contents of the stream object at offset, data holds the start of the object '''
+        length = re.search(rb'/Length\s+(\d+)(\s+\d+\s+R)?', source)
+        start = re.search(rb'stream\r?\n', data)
+        if length is None or start is None or length.group(2):
+            return b''
+        n = int(length.group(1))
+        raw = data[start.end(): start.end() + n]
+        if len(raw) < n:
+            raw = self.read_at(offset + start.end(), n)
+        if b'/FlateDecode' in source:
+            raw = zlib.decompress(raw)
+        predictor = re.search(rb'/Predictor\s+(\d+)', source)
+        if predictor and int(predictor.group(1)) >= 10:
+            columns = re.search(rb'/Columns\s+(\d+)', source)
+            raw = undo_png_predictor(raw, int(columns.group(1)) if columns else 1)
+        return raw
+
+    def read_object(self, number):
+        ''' the source of an object's dictionary '''
+        entry = self.xref[number]
+        if entry[0] == 'offset':
+            data = self.read_at(entry[1], self.CHUNK_SIZE)
+            m = re.match(rb'\s*\d+\s+\d+\s+obj\s*', data)
+            return get_dict_source(data[m.end():]) if m else None
+        # compressed in an object stream: a header of (object number, offset) pairs, then the objects
+        _, stream_number, _ = entry
+        if self.xref.get(stream_number, ('stream',))[0] != 'offset':
+            return None
+        stream_offset = self.xref[stream_number][1]
+        data = self.read_at(stream_offset, self.CHUNK_SIZE)
+        source = get_dict_source(data)
+        if source is None:
+            return None
+        contents = self.read_stream(stream_offset, data, source)
+        n = int(re.search(rb'/N\s+(\d+)', source).group(1))
+        first = int(re.search(rb'/First\s+(\d+)', source).group(1))
+        header = [int(x) for x in contents[:first].split()[:2 * n]]
+        for obj_number, obj_offset in zip(header[::2], header[1::2]):
+            if obj_number == number:
+                return get_dict_source(contents[first + obj_offset:])
+        return None
+
+
+def undo_png_predictor(data, columns):
+    ''' rows of columns bytes, each prefixed by its PNG filter type, xref streams use None (0) or Up (2) '''
+    rows, prev = [], bytes(columns)
+    for i in range(0, len(data), columns + 1):
+        filter_type, row = data[i], bytearray(data[i + 1: i + 1 + columns])
+        if filter_type == 2:
+            for j in range(len(row)):
+                row[j] = (row[j] + prev[j]) & 0xFF
+        elif filter_type != 0:
+            raise ValueError(f'unsupported png predictor {filter_type}')
+        rows.append(bytes(row))
+        prev = row
+    return b''.join(rows)
+
+
+def get_dict_source(data):
+    ''' the bytes of the first << ... >> dictionary in data, nested dictionaries and strings included '''
+    start = data.find(b'<<')
+    if start == -1:
+        return None
+    depth, i, n = 0, start, len(data)
+    while i < n:
+        c = data[i:i + 1]
+        if data.startswith(b'<<', i):
+            depth += 1
+            i += 2
+            continue
+        if data.startswith(b'>>', i):
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return data[start:i]
+            continue
+        if c == b'(':
+            i = skip_literal_string(data, i)
+            continue
+        i += 1
+    return None
+
+
+def skip_literal_string(data, i):
+    ''' index after the literal string starting at data[i] == "(" '''
+    depth = 0
+    while i < len(data):
+        c = data[i]
+        if c == 0x5C: # backslash escapes the next character
+            i += 2
+            continue
+        if c == 0x28:
+            depth += 1
+        elif c == 0x29:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
+
+
+PDF_ESCAPES = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b', ord('f'): b'\f'}
+PDF_STRING_KEY_RE = re.compile(rb'/(Title|Author|CreationDate)\s*(\(|<(?!<))')
+
+
+def parse_pdf_dict(source):
+    ''' text values of the Info dictionary keys we use '''
+    values = {}
+    for m in PDF_STRING_KEY_RE.finditer(source):
+        key = m.group(1).decode('ascii')
+        if key in values:
+            continue
+        start = m.end() - 1
+        if m.group(2) == b'(':
+            raw = unescape_literal_string(source[start + 1: skip_literal_string(source, start) - 1])
+        else:
+            end = source.find(b'>', start)
+            hex_digits = re.sub(rb'\s', b'', source[start + 1:end])
+            raw = bytes.fromhex((hex_digits + b'0' * (len(hex_digits) % 2)).decode('ascii'))
+        values[key] = decode_pdf_text(raw)
+    return values
+
+
+def unescape_literal_string(s):
+    out, i = bytearray(), 0
+    while i < len(s):
+        c = s[i]
+        if c != 0x5C:
+            out.append(c)
+            i += 1
+            continue
+        i += 1
+        if i >= len(s):
+            break
+        c = s[i]
+        if c in PDF_ESCAPES:
+            out += PDF_ESCAPES[c]
+            i += 1
+        elif 0x30 <= c <= 0x37:
+            octal = re.match(rb'[0-7]{1,3}', s[i:i + 3]).group(0)
+            out.append(int(octal, 8) & 0xFF)
+            i += len(octal)
+        elif c in (0x0A, 0x0D):
+            # a backslash at the end of a line continues the string
+            i += 2 if s[i:i + 2] == b'\r\n' else 1
+        else:
+            out.append(c)
+            i += 1
+    return bytes(out)
+
+
+def decode_pdf_text(raw):
+    ''' text strings are UTF-16BE with a byte order mark, otherwise PDFDocEncoding (close to latin-1) '''
+    if raw.startswith(b'\xfe\xff'):
+        return raw[2:].decode('utf-16-be', errors='replace').strip()
+    if raw.startswith(b'\xef\xbb\xbf'):
+        return raw[3:].decode('utf-8', errors='replace').strip()
+    return raw.decode('latin-1').strip()
+
+
+def read_pdf_metadata(path):
+    with open(path, 'rb') as f:
+        info = PdfInfoReader(f).read_info()
+    if not info:
+        return None
+    authors = [a.strip() for a in re.split(r';|&| and ', info.get('Author', '')) if a.strip()]
+    # pdfs have no publisher or publication year, CreationDate is when the file was made
+    return metadata_dict(title=info.get('Title'), authors=authors)
+
+
+METADATA_READERS = {
+    '.epub': read_epub_metadata,
+    '.pdf': read_pdf_metadata,
+}
+
+
+def read_book_metadata(path):
+    ''' metadata of a book file, None if its type is not supported or its metadata can not be read '''
+    reader = METADATA_READERS.get(os.path.splitext(str(path))[1].lower())
+    if reader is None:
+        return None
+    try:
+        return reader(path)
+    # zipfile raises NotImplementedError for unsupported compression and RuntimeError for encrypted members
+    except (
+        OSError, ValueError, KeyError, IndexError, AttributeError, NotImplementedError, RuntimeError,
+        zipfile.BadZipFile, ET.ParseError, zlib.error,
+    ) as e:
+        log.info(f'could not read the metadata of {os.path.basename(str(path))}: {e}')
+        return None
+
+
+class BookMetadataCache:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Persistent cache of the metadata read from book files, keyed by path and validated by size and mtime,
+        so a book file is only read again after it changed. Books that could not be read are cached too.
+        Entries of books that were not looked up are evicted on save.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.used = set()
+        self.stats = dict(hits=0, misses=0)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (ValueError, OSError):
+            self.entries = {}
+
+    def save(self):
+        self.entries = {k: v for k, v in self.entries.items() if k in self.used}
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def get(self, path, read_path=None):
+        '''
+        metadata of the book at path, read from read_path if given (e.g. the file on the device the book
+        is being copied from, which has the same size and mtime)
+        '''
+        key = str(path)
+        read_path = read_path if read_path is not None else path
+        st = os.stat(read_path)
+        self.used.add(key)
+        entry = self.entries.get(key)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            self.stats['hits'] += 1
+            return entry['metadata']
+        self.stats['misses'] += 1
+        metadata = read_book_metadata(read_path)
+        self.entries[key] = dict(size=st.st_size, mtime_ns=st.st_mtime_ns, metadata=metadata)
+        return metadata
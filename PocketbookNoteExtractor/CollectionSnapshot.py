@@ -0,0 +1,144 @@
+import os
+import re
+import json
+import hashlib
+import unicodedata
+from datetime import datetime
+
+
+'''
+stable identities of books and notes, and snapshots of a collection to find the highlights that changed between loads
+    book uid:     hash of the normalized file name and extension of the book, the same across rebuilds.
+                  The extension is part of it, so X.epub and X.pdf in one library are two books
+    note uid:     hash of the book uid, page, highlighted text and the occurrence of that text on the page,
+                  so identical highlights on a page are told apart. Editing the note of a highlight or changing
+                  its color keeps its uid and changes its content hash instead
+'''
+
+UID_LENGTH = 16
+# the text of a note is only kept to describe removed notes
+TEXT_EXCERPT_LENGTH = 200
+SPACE_RE = re.compile(r'\s+')
+
+
+def hash_fields(*fields):
+    content = '\x1f'.join('' if f is None else str(f) for f in fields)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()[:UID_LENGTH]
+
+
+def get_book_uid(book_path):
+    ''' uid of a book from its file name and extension, ignoring case, unicode normalization form and repeated whitespace '''
+    stem, extension = os.path.splitext(os.path.basename(str(book_path)))
+    stem = SPACE_RE.sub(' ', unicodedata.normalize('NFC', stem)).strip().lower()
+    return hash_fields(stem, extension.lower())
+
+
+def get_note_uid(book_uid, page_number, text, occurrence):
+    return hash_fields(book_uid, page_number, text, occurrence)
+
+
+def assign_note_uids(book):
+    ''' set the uid of every note of a book from the order of its notes, e.g. for notes unpickled without uids '''
+    book_uid = book.book_uid
+    occurrences = {}
+    for note in book.notes:
+        key = (note.page_number, note.text)
+        occurrence = occurrences.get(key, 0)
+        occurrences[key] = occurrence + 1
+        note.uid = get_note_uid(book_uid, note.page_number, note.text, occurrence)
+
+
+def get_content_hash(note):
+    ''' what can change about a highlight without it becoming another highlight, tags are excluded since they depend on the tag list '''
+    return hash_fields(note.note, note.highlight_color)
+
+
+class CollectionSnapshot:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        The uid, book, page, text, content hash and first seen date of every note of a collection, saved as json.
+        diff(previous) compares two snapshots in O(n) with dict lookups and returns the uids of the notes
+        that were added, removed and edited (same uid, different content hash).
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    # 2: book uids include the file extension
+    VERSION = 2
+
+    def __init__(self, books=None, notes=None, created=None):
+        # book uid -> book name
+        self.books = books or {}
+        # note uid -> [book uid, page number, start of the text, content hash, first seen (iso date)]
+        self.notes = notes or {}
+        self.created = created or datetime.now().isoformat(timespec='seconds')
+
+    @classmethod
+    def from_books(cls, books):
+        snapshot = cls()
+        # notes of a batch share their date_created, format each date once
+        dates = {}
+        for book in books:
+            book_uid = book.book_uid
+            snapshot.books[book_uid] = book.book_name
+            if any(note.uid is None for note in book.notes):
+                assign_note_uids(book)
+            for note in book.notes:
+                date_created = note.date_created
+                if date_created not in dates:
+                    dates[date_created] = date_created.isoformat()
+                snapshot.notes[note.uid] = [
+                    book_uid, note.page_number, (note.text or '')[:TEXT_EXCERPT_LENGTH], get_content_hash(note),
+                    dates[date_created],
+                ]
+        return snapshot
+
+    @classmethod
+    def load(cls, path):
+        ''' the snapshot saved at path, an empty snapshot if there is none (or it can not be read) '''
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (ValueError, OSError):
+            return cls()
+        if data.get('version') != cls.VERSION:
+            return cls()
+        return cls(data['books'], data['notes'], data['created'])
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        # json.dumps uses the C encoder, json.dump does not
+        content = json.dumps(
+            dict(version=self.VERSION, created=self.created, books=self.books, notes=self.notes), separators=(',', ':'),
+        )
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def diff(self, previous):
+        ''' uids of the notes added, removed and edited since the previous snapshot '''
+        added, edited = [], []
+        for uid, entry in self.notes.items():
+            previous_entry = previous.notes.get(uid)
+            if previous_entry is None:
+                added.append(uid)
+            elif previous_entry[3] != entry[3]:
+                edited.append(uid)
+        removed = [uid for uid in previous.notes if uid not in self.notes]
+        return dict(added=added, removed=removed, edited=edited)
+
+    def first_seen(self, uid):
+        ''' iso date the note was first seen, None if it is not in this snapshot '''
+        entry = self.notes.get(uid)
+        return entry[4] if entry is not None else None
+
+    def describe(self, uid):
+        ''' book name, page and start of the text of a note in this snapshot, e.g. of a removed note '''
+        book_uid, page_number, text, _, first_seen = self.notes[uid]
+        return dict(
+            uid=uid, book_uid=book_uid, book_name=self.books.get(book_uid), page_number=page_number,
+            text=text, first_seen=first_seen,
+        )
@@ -0,0 +1,350 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime
+
+from BookCollections import Book
+from NoteCollections import Note
+from NoteIndex import NoteIndex
+from CollectionSnapshot import assign_note_uids
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (
+    book_key TEXT PRIMARY KEY,
+    book_id INTEGER,
+    book_name TEXT,
+    book_path TEXT,
+    note_path TEXT,
+    file_type TEXT,
+    author TEXT,
+    publisher TEXT,
+    year INTEGER,
+    extracted_info INTEGER,
+    has_page_numbers INTEGER
+);
+CREATE TABLE IF NOT EXISTS notes (
+    note_key TEXT PRIMARY KEY,
+    book_key TEXT NOT NULL,
+    position INTEGER,
+    highlight_color TEXT,
+    page_number INTEGER,
+    text TEXT,
+    note TEXT,
+    tags TEXT,
+    date_created TEXT
+);
+CREATE INDEX IF NOT EXISTS notes_by_book ON notes (book_key, position);
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5 (
+    text, note, content='notes', content_rowid='rowid', tokenize="unicode61 remove_diacritics 0 tokenchars '_'"
+);
+CREATE TRIGGER IF NOT EXISTS notes_ai AFTER INSERT ON notes BEGIN
+    INSERT INTO notes_fts (rowid, text, note) VALUES (new.rowid, new.text, new.note);
+END;
+CREATE TRIGGER IF NOT EXISTS notes_ad AFTER DELETE ON notes BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, text, note) VALUES ('delete', old.rowid, old.text, old.note);
+END;
+CREATE TRIGGER IF NOT EXISTS notes_au AFTER UPDATE ON notes BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, text, note) VALUES ('delete', old.rowid, old.text, old.note);
+    INSERT INTO notes_fts (rowid, text, note) VALUES (new.rowid, new.text, new.note);
+END;
+'''
+
+BOOK_COLUMNS = (
+    'book_key', 'book_id', 'book_name', 'book_path', 'note_path', 'file_type',
+    'author', 'publisher', 'year', 'extracted_info', 'has_page_numbers',
+)
+NOTE_COLUMNS = (
+    'note_key', 'book_key', 'position', 'highlight_color', 'page_number', 'text', 'note', 'tags', 'date_created',
+)
+# splits text into the same words as NoteIndex.tokenize: letters, digits and _, lowercased, accents kept
+FTS_TOKENIZE = "unicode61 remove_diacritics 0 tokenchars '_'"
+
+
+class CollectionStore:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        SQLite store of books and notes, with an FTS5 index over highlight text and notes.
+        The index tokenizes like NoteIndex and its matches are checked against NoteIndex (see search),
+        so a query returns the same notes from the store as from a pickled collection.
+        Books and notes are keyed by their uids (see CollectionSnapshot), which are the same across rebuilds,
+        so saving a collection again only upserts what changed and removes what disappeared.
+
+        Reading is lazy: StoredBookCollection/StoredNoteCollection only query the rows they need.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # books may load their notes from export worker threads, reads are serialized by self.lock
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        row = self.conn.execute("SELECT sql FROM sqlite_master WHERE name = 'notes_fts'").fetchone()
+        rebuild = row is not None and FTS_TOKENIZE not in row[0]
+        if rebuild:
+            # stores created before the index tokenized like NoteIndex
+            self.conn.execute('DROP TABLE notes_fts')
+        self.conn.executescript(SCHEMA)
+        if rebuild:
+            with self.conn:
+                self.conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def get_book_key(book):
+        return book.book_uid
+
+    ###################################################################################################
+    # writing
+
+    def save_collection(self, book_collection):
+        '''
+        upsert every book and note, and delete books and notes that are no longer in the collection.
+        Books are saved one at a time, book_collection can be a generator that releases each book's notes once saved.
+        '''
+        with self.conn:
+            book_keys = []
+            for book in book_collection:
+                book_keys.append(self.save_book(book))
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS current_books (book_key TEXT PRIMARY KEY)')
+            self.conn.execute('DELETE FROM current_books')
+            self.conn.executemany('INSERT OR IGNORE INTO current_books VALUES (?)', [(k,) for k in book_keys])
+            self.conn.execute('DELETE FROM notes WHERE book_key NOT IN (SELECT book_key FROM current_books)')
+            self.conn.execute('DELETE FROM books WHERE book_key NOT IN (SELECT book_key FROM current_books)')
+
+    def save_book(self, book):
+        book_key = self.get_book_key(book)
+        row = (
+            book_key, book.book_id, book.book_name, str(book.book_path), str(book.note_path), book.file_type,
+            json.dumps(book.author), book.publisher, book.year, int(book.extracted_info),
+            int(getattr(book, 'has_page_numbers', True)),
+        )
+        self.upsert('books', BOOK_COLUMNS, [row])
+
+        if any(note.uid is None for note in book.notes):
+            assign_note_uids(book)
+        rows = []
+        for position, note in enumerate(book.notes):
+            rows.append((
+                note.uid, book_key, position,
+                note.highlight_color, note.page_number, note.text, note.note,
+                json.dumps(sorted(note.tags)) if note.tags else None, note.date_created.isoformat(),
+            ))
+        self.upsert('notes', NOTE_COLUMNS, rows)
+        # highlights deleted on the device
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS current_notes (note_key TEXT PRIMARY KEY)')
+        self.conn.execute('DELETE FROM current_notes')
+        self.conn.executemany('INSERT OR IGNORE INTO current_notes VALUES (?)', [(r[0],) for r in rows])
+        self.conn.execute(
+            'DELETE FROM notes WHERE book_key = ? AND note_key NOT IN (SELECT note_key FROM current_notes)', (book_key,),
+        )
+        return book_key
+
+    def upsert(self, table, columns, rows):
+        key = columns[0]
+        # only touch rows whose values changed, so unchanged notes are not rewritten in the fts index
+        updates = ', '.join(f'{c} = excluded.{c}' for c in columns[1:] if c != 'date_created')
+        changed = ' OR '.join(f'{c} IS NOT excluded.{c}' for c in columns[1:] if c != 'date_created')
+        self.conn.executemany(
+            f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT ({key}) DO UPDATE SET {updates} WHERE {changed}',
+            rows,
+        )
+
+    ###################################################################################################
+    # reading
+
+    def count_notes(self):
+        return self.conn.execute('SELECT COUNT(*) FROM notes').fetchone()[0]
+
+    def iter_books(self, book_names=None):
+        query = f'SELECT {", ".join(BOOK_COLUMNS)} FROM books'
+        params = []
+        if book_names is not None:
+            book_names = list(book_names)
+            query += f' WHERE book_name IN ({",".join("?" * len(book_names))})'
+            params = book_names
+        for row in self.conn.execute(query + ' ORDER BY book_id', params):
+            yield StoredBook(self, dict(zip(BOOK_COLUMNS, row)))
+
+    def get_book_notes(self, book):
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT {", ".join(NOTE_COLUMNS)} FROM notes WHERE book_key = ? ORDER BY position', (book.book_key,),
+            ).fetchall()
+        return [self.row_to_note(dict(zip(NOTE_COLUMNS, row)), book) for row in rows]
+
+    def iter_notes(self):
+        books = {book.book_key: book for book in self.iter_books()}
+        cursor = self.conn.execute(
+            f'SELECT {", ".join("n." + c for c in NOTE_COLUMNS)} FROM notes n '
+            'JOIN books b ON b.book_key = n.book_key ORDER BY b.book_id, n.position'
+        )
+        for row in cursor:
+            row = dict(zip(NOTE_COLUMNS, row))
+            yield self.row_to_note(row, books[row['book_key']])
+
+    def search(self, fts_query, book_id=None, highlight_color=None, limit=None, query=None):
+        '''
+        full text search with an FTS5 MATCH expression, best matches (bm25) first.
+        query: the MyCollection.query string fts_query was made from (see to_fts_query), the notes FTS5 finds
+               are kept only if NoteIndex matches them too, so both backends return the same notes
+        '''
+        sql = (
+            f'SELECT {", ".join("n." + c for c in NOTE_COLUMNS)} FROM notes_fts f '
+            'JOIN notes n ON n.rowid = f.rowid JOIN books b ON b.book_key = n.book_key '
+            'WHERE notes_fts MATCH ?'
+        )
+        params = [fts_query]
+        for column, val in (('b.book_id', book_id), ('n.highlight_color', highlight_color)):
+            if val is None:
+                continue
+            val = [val] if isinstance(val, (str, int)) else list(val)
+            sql += f' AND {column} IN ({",".join("?" * len(val))})'
+            params.extend(val)
+        sql += ' ORDER BY bm25(notes_fts)'
+        if limit is not None and query is None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        books = {}
+        notes = []
+        for row in self.conn.execute(sql, params).fetchall():
+            row = dict(zip(NOTE_COLUMNS, row))
+            if row['book_key'] not in books:
+                books[row['book_key']] = next(self.iter_books_by_key([row['book_key']]))
+            notes.append(self.row_to_note(row, books[row['book_key']]))
+        if query is not None:
+            matched = {id(note) for note in NoteIndex(notes).search(query)}
+            notes = [note for note in notes if id(note) in matched][:limit]
+        return notes
+
+    def iter_books_by_key(self, book_keys):
+        query = f'SELECT {", ".join(BOOK_COLUMNS)} FROM books WHERE book_key IN ({",".join("?" * len(book_keys))})'
+        for row in self.conn.execute(query, list(book_keys)):
+            yield StoredBook(self, dict(zip(BOOK_COLUMNS, row)))
+
+    @staticmethod
+    def row_to_note(row, book):
+        return Note(
+            highlight_color = row['highlight_color'],
+            page_number = row['page_number'],
+            text = row['text'],
+            note = row['note'],
+            tags = set(json.loads(row['tags'])) if row['tags'] else None,
+            book = book,
+            date_created = datetime.fromisoformat(row['date_created']),
+            uid = row['note_key'],
+        )
+
+    @staticmethod
+    def to_fts_query(query):
+        '''
+        translate a MyCollection.query string to an FTS5 expression finding the candidates of its matches,
+        returns None if it cannot be expressed (a clause without any positive term).
+        Exclusions are left out, search applies them with NoteIndex
+        '''
+        clauses = []
+        for clause in NoteIndex.parse_query(query):
+            positives = [CollectionStore.fts_term(term) for negate, term in clause if not negate]
+            if not positives:
+                return None
+            clauses.append('(' + ' AND '.join(positives) + ')')
+        return ' OR '.join(clauses) if clauses else None
+
+    @staticmethod
+    def fts_term(term):
+        kind, val = term
+        if kind == 'prefix':
+            return f'"{val}" *'
+        return '"' + ' '.join(val) + '"'
+
+
+class StoredBook(Book):
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        A book read from a CollectionStore, its notes are only loaded when first accessed.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, store, row):
+        self.store = store
+        self.book_key = row['book_key']
+        self.book_id = row['book_id']
+        self.book_name = row['book_name']
+        self.book_path = Path(row['book_path'])
+        self.note_path = Path(row['note_path'])
+        self.file_type = row['file_type']
+        self.author = json.loads(row['author'])
+        self.publisher = row['publisher']
+        self.year = row['year']
+        self.extracted_info = bool(row['extracted_info'])
+        self.has_page_numbers = bool(row['has_page_numbers'])
+        self._notes = None
+
+    @property
+    def notes(self):
+        if self._notes is None:
+            self._notes = self.store.get_book_notes(self)
+        return self._notes
+
+    def add_note(self, anote):
+        self.notes.append(anote)
+
+
+class StoredBookCollection:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Iterates the books of a CollectionStore without loading their notes.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, store):
+        self.store = store
+
+    def __iter__(self):
+        yield from self.store.iter_books()
+
+    def get_books(self, book_names):
+        return list(self.store.iter_books(book_names))
+
+
+class StoredNoteCollection:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Streams the notes of a CollectionStore. The in-memory NoteIndex and NoteTable are only built if a query needs them.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, store):
+        self.store = store
+        self.index = None
+        self.table = None
+
+    def __iter__(self):
+        yield from self.store.iter_notes()
+
+    def __len__(self):
+        return self.store.count_notes()
+
+    def get_index(self):
+        if self.index is None:
+            self.index = NoteIndex(self)
+        return self.index
+
+    def get_table(self):
+        if self.table is None:
+            from NoteTable import NoteTable
+            self.table = NoteTable(self)
+        return self.table
@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import get_dir_contents
+from Instrumentation import log, get_instrumentation
+
+
+class SyncManifest:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Stores the size, mtime and (optionally) content hash of every file copied from the device.
+        Keys are '<content type>/<file name>' so books and notes with the same name do not collide.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.files = {}
+        self.load()
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.files = json.load(f).get('files', {})
+        except (ValueError, OSError):
+            # a corrupt manifest only costs a full re-copy
+            self.files = {}
+
+    def save(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'files': self.files}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def get(self, key):
+        return self.files.get(key)
+
+    def update(self, key, size, mtime, content_hash=None):
+        self.files[key] = {'size': size, 'mtime': mtime, 'hash': content_hash}
+
+    def remove(self, key):
+        self.files.pop(key, None)
+
+    def keys_for(self, ctype):
+        prefix = f'{ctype}/'
+        return [k for k in self.files if k.startswith(prefix)]
+
+
+def hash_file(path, chunk_size=1024*1024):
+    ''' sha1 of a file's contents, read in chunks '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class TransferPool:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Copies files concurrently with a bounded thread pool.
+        Each file is written to a temp file next to its destination and atomically renamed into place,
+        so an interrupted transfer never leaves a half-written file under the final name.
+        Uses copy_file_range/sendfile where the OS supports it, otherwise large buffered copies.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    TEMP_SUFFIX = '.pbpart'
+
+    def __init__(self, workers=4, buffer_size=8*1024*1024, hash_files=False):
+        self.workers = max(1, workers)
+        self.buffer_size = buffer_size
+        self.hash_files = hash_files
+
+    def run(self, jobs):
+        ''' copy (src, dst) pairs, returns a list of per-file stats in job order and the aggregate stats '''
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(lambda job: self.transfer(*job), jobs))
+        elapsed = time.perf_counter() - start
+        n_bytes = sum(r['bytes'] for r in results)
+        aggregate = dict(files=len(results), bytes=n_bytes, seconds=elapsed, mb_per_s=self.throughput(n_bytes, elapsed))
+        return results, aggregate
+
+    def transfer(self, src_file, dst_file):
+        tmp_file = self.temp_path(dst_file)
+        start = time.perf_counter()
+        try:
+            with open(src_file, 'rb') as fsrc, open(tmp_file, 'wb') as fdst:
+                n_bytes = self.copy_fileobj(fsrc, fdst)
+            shutil.copystat(src_file, tmp_file)
+            os.replace(tmp_file, dst_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        elapsed = time.perf_counter() - start
+        content_hash = hash_file(dst_file) if self.hash_files else None
+        return dict(
+            src=str(src_file), dst=str(dst_file), bytes=n_bytes, seconds=elapsed,
+            mb_per_s=self.throughput(n_bytes, elapsed), hash=content_hash,
+        )
+
+    def copy_fileobj(self, fsrc, fdst):
+        size = os.fstat(fsrc.fileno()).st_size
+        for zero_copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+            if zero_copy is None:
+                continue
+            try:
+                return self.copy_zero_copy(zero_copy, fsrc, fdst, size)
+            except OSError:
+                # not supported between these filesystems, restart with the next method
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        n_bytes = 0
+        for chunk in iter(lambda: fsrc.read(self.buffer_size), b''):
+            fdst.write(chunk)
+            n_bytes += len(chunk)
+        return n_bytes
+
+    def copy_zero_copy(self, zero_copy, fsrc, fdst, size):
+        in_fd, out_fd = fsrc.fileno(), fdst.fileno()
+        n_bytes = 0
+        while n_bytes < size:
+            if zero_copy is os.sendfile:
+                sent = os.sendfile(out_fd, in_fd, n_bytes, self.buffer_size)
+            else:
+                sent = zero_copy(in_fd, out_fd, self.buffer_size, n_bytes)
+            if sent == 0:
+                break
+            n_bytes += sent
+        return n_bytes
+
+    def temp_path(self, dst_file):
+        head, tail = os.path.split(dst_file)
+        return os.path.join(head, f'.{tail}{self.TEMP_SUFFIX}')
+
+    @classmethod
+    def remove_stale_temp_files(cls, local_dir):
+        ''' clean up temp files left behind by an interrupted sync '''
+        for el in os.listdir(local_dir):
+            if el.endswith(cls.TEMP_SUFFIX):
+                os.remove(os.path.join(local_dir, el))
+
+    @staticmethod
+    def throughput(n_bytes, seconds):
+        if seconds <= 0:
+            return 0.0
+        return n_bytes / seconds / 1e6
+
+
+class DeviceSync:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Incrementally copies files from device directories to local directories.
+        A file is only copied if it is new or its size/mtime differ from the manifest entry,
+        or the local copy went missing. Files that disappeared from the device are reported.
+
+        If verify_hash is set, files whose size/mtime changed are hashed and skipped when the content is the same
+        (e.g. the device touched the file without changing it).
+        Changed files are copied concurrently by a TransferPool with `workers` threads.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, manifest_path, verify_hash=False, workers=4):
+        self.manifest = SyncManifest(manifest_path)
+        self.verify_hash = verify_hash
+        self.pool = TransferPool(workers=workers, hash_files=verify_hash)
+        self.reset_report()
+
+    def reset_report(self):
+        self.report = dict(
+            copied=[], skipped=[], removed=[], transfers=[],
+            bytes_transferred=0, bytes_skipped=0, throughput=None,
+        )
+
+    def sync(self, content_dict):
+        ''' sync each {'device_dir':..., 'local_dir':...} entry of content_dict, keyed by content type '''
+        self.reset_report()
+        with get_instrumentation().stage('sync'):
+            jobs = [job for ctype_jobs in self.plan(content_dict).values() for job in ctype_jobs]
+            results, self.report['throughput'] = self.pool.run([(src_file, dst_file) for _, _, src_file, dst_file in jobs])
+            for (key, st, _, dst_file), result in zip(jobs, results):
+                self.record_copy(key, st, dst_file, result)
+        return self.finish()
+
+    def plan(self, content_dict):
+        ''' the transfer jobs of each content type of content_dict, nothing is copied yet '''
+        return {
+            ctype: self.sync_dir(ctype, dir_dict['device_dir'], dir_dict['local_dir'])
+            for ctype, dir_dict in content_dict.items()
+        }
+
+    def finish(self):
+        ''' save the manifest once every job was copied and recorded, returns the report '''
+        self.manifest.save()
+        instrumentation = get_instrumentation()
+        for k in ('copied', 'skipped', 'removed'):
+            instrumentation.count(f'files_{k}', len(self.report[k]))
+        instrumentation.count('bytes_skipped', self.report['bytes_skipped'])
+        self.print_summary()
+        return self.report
+
+    def sync_dir(self, ctype, device_dir, local_dir):
+        ''' returns the (key, stat, src, dst) transfer jobs for files that are new or changed '''
+        TransferPool.remove_stale_temp_files(local_dir)
+        jobs = []
+        seen = set()
+        for src_file in get_dir_contents(device_dir):
+            if not src_file.is_file():
+                continue
+            key = f'{ctype}/{src_file.name}'
+            seen.add(key)
+            dst_file = os.path.join(local_dir, src_file.name)
+            st = src_file.stat()
+
+            if self.is_unchanged(key, src_file, st, dst_file):
+                self.report['skipped'].append(dst_file)
+                self.report['bytes_skipped'] += st.st_size
+                continue
+
+            if os.path.exists(dst_file) and os.path.samefile(src_file, dst_file):
+                # src and dst are the same file, nothing to copy. It is recorded so the next sync finds it unchanged
+                self.manifest.update(key, st.st_size, int(st.st_mtime))
+                self.report['skipped'].append(dst_file)
+                self.report['bytes_skipped'] += st.st_size
+                continue
+            jobs.append((key, st, src_file, dst_file))
+
+        # files that were synced before but are no longer on the device
+        for key in self.manifest.keys_for(ctype):
+            if key not in seen:
+                self.report['removed'].append(key.split('/', 1)[1])
+                self.manifest.remove(key)
+        return jobs
+
+    def is_unchanged(self, key, src_file, st, dst_file):
+        entry = self.manifest.get(key)
+        if entry is None or not os.path.exists(dst_file):
+            return False
+        if os.path.getsize(dst_file) != entry['size']:
+            return False # local copy was modified or truncated
+        if entry['size'] == st.st_size and entry['mtime'] == int(st.st_mtime):
+            return True
+        if self.verify_hash and entry['hash'] and entry['size'] == st.st_size:
+            if hash_file(src_file) == entry['hash']:
+                self.manifest.update(key, st.st_size, int(st.st_mtime), entry['hash'])
+                return True
+        return False
+
+    def record_copy(self, key, st, dst_file, result):
+        # FAT volumes only store mtime with 2s resolution, so compare whole seconds
+        self.manifest.update(key, st.st_size, int(st.st_mtime), result['hash'])
+        self.report['copied'].append(dst_file)
+        self.report['transfers'].append(result)
+        self.report['bytes_transferred'] += result['bytes']
+        # per file timings of the transfers, which ran in the pool
+        instrumentation = get_instrumentation()
+        instrumentation.add_time('copy', result['seconds'], book=os.path.basename(dst_file))
+        instrumentation.count('bytes_copied', result['bytes'], book=os.path.basename(dst_file))
+
+    def print_summary(self):
+        r = self.report
+        for t in r['transfers']:
+            log.info(f'\t{os.path.basename(t["dst"])}: {t["bytes"]} bytes in {t["seconds"]:.2f}s ({t["mb_per_s"]:.1f} MB/s)', extra=dict(transfer=t))
+        log.info(
+            f'copied {len(r["copied"])} files ({r["bytes_transferred"]} bytes transferred, {r["throughput"]["mb_per_s"]:.1f} MB/s)',
+            extra=dict(stage='sync', files_copied=len(r['copied']), bytes_copied=r['bytes_transferred'], throughput=r['throughput']),
+        )
+        log.info(f'skipped {len(r["skipped"])} unchanged files ({r["bytes_skipped"]} bytes skipped)')
+        if r['removed']:
+            log.info(f'{len(r["removed"])} files were removed from the device:')
+            for fn in r['removed']:
+                log.info(f'\t{fn}')
@@ -0,0 +1,348 @@
+import io
+import os
+import csv
+import json
+import html
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ObsidianExport import ExportManifest, get_md_file_names, iter_book_markdown
+from CollectionSnapshot import assign_note_uids
+from Instrumentation import log, get_instrumentation
+
+
+'''
+exporters of a collection to several formats in one walk over its books and notes, e.g.
+    export_collection(books, export_dir, formats=('obsidian', 'jsonl', 'csv', 'anki'))
+    obsidian: one markdown file per book, the same files ObsidianExport.export_books writes
+    jsonl:    one json object per note, for search indexing
+    csv:      one row per note, for spreadsheets
+    anki:     tab separated front/back/tags rows that Anki imports as flashcards
+Exporters are registered by name with register_exporter, see Exporter.
+'''
+
+# name -> Exporter class
+EXPORTERS = {}
+
+
+def register_exporter(cls):
+    ''' class decorator adding an Exporter to the formats export_collection knows '''
+    EXPORTERS[cls.name] = cls
+    return cls
+
+
+def get_exporter(name):
+    if name not in EXPORTERS:
+        raise ValueError(f'format: \'{name}\' is not supported, use one of {tuple(EXPORTERS)}')
+    return EXPORTERS[name]
+
+
+def get_note_key(note):
+    ''' what a rendered note depends on: its uid (book, page, text) and the parts of a highlight that can change '''
+    return (note.uid, note.highlight_color, note.note, frozenset(note.tags) if note.tags else None, note.date_created)
+
+
+class Exporter:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        A format notes are exported to. start gets every book before any is exported. render_note renders the part of the output that only depends on a note,
+        it is cached per note (see FragmentCache) so it must not use the note's book. export_book gets the
+        rendered notes of a book in page order and is called on worker threads, finish gets what export_book
+        returned for every book in book order and returns the names of the files it exported.
+        VERSION is part of the cache key, bump it when render_note changes.
+        PER_BOOK formats write a file per book, so an export of some books only renders those books.
+        Other formats write one file holding every book and always get all of them.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    name = None
+    VERSION = 1
+    PER_BOOK = True
+
+    def __init__(self, export_dir, manifest):
+        self.export_dir = export_dir
+        self.manifest = manifest
+
+    def start(self, books):
+        pass
+
+    def render_note(self, note):
+        raise NotImplementedError
+
+    def export_book(self, book, fragments):
+        raise NotImplementedError
+
+    def finish(self, book_results):
+        raise NotImplementedError
+
+    @classmethod
+    def get_file_names(cls, books):
+        ''' names of the files this format exports for all the books of a collection '''
+        raise NotImplementedError
+
+
+@register_exporter
+class ObsidianExporter(Exporter):
+    ''' one markdown file per book, written as soon as the book is rendered '''
+    name = 'obsidian'
+
+    def start(self, books):
+        self.file_names = get_md_file_names(books)
+
+    def render_note(self, note):
+        return note.export_str(export_to='obsidian')
+
+    def export_book(self, book, fragments):
+        file_name = self.file_names[id(book)]
+        # one string is encoded and hashed faster than many small fragments
+        self.manifest.write_if_changed(file_name, ''.join(iter_book_markdown(book, fragments)), exporter=self.name)
+        return file_name
+
+    def finish(self, book_results):
+        return book_results
+
+    @classmethod
+    def get_file_names(cls, books):
+        return list(get_md_file_names(books).values())
+
+
+class FlatExporter(Exporter):
+    '''
+    one file with a line per note of every book. A line is the book's part (render_book) joined with the note's
+    cached part (render_note), the file is written once every book is rendered, with \n line endings on every platform
+    '''
+    PER_BOOK = False
+    FILE_NAME = None
+    HEADER = ''
+
+    def render_book(self, book):
+        raise NotImplementedError
+
+    def join(self, book_part, fragment):
+        return book_part + fragment
+
+    def export_book(self, book, fragments):
+        book_part = self.render_book(book)
+        return ''.join([self.join(book_part, fragment) for fragment in fragments])
+
+    def finish(self, book_results):
+        self.manifest.write_if_changed(self.FILE_NAME, [self.HEADER] + book_results, newline='\n', exporter=self.name)
+        return [self.FILE_NAME]
+
+    @classmethod
+    def get_file_names(cls, books):
+        return [cls.FILE_NAME]
+
+
+def get_authors(book):
+    return list(book.author) if book.author else []
+
+
+@register_exporter
+class JsonlExporter(FlatExporter):
+    name = 'jsonl'
+    FILE_NAME = 'PocketBookNotes.jsonl'
+
+    def render_book(self, book):
+        # the book's fields opening the object, the note's fields close it
+        book_fields = dict(book=book.book_name, authors=get_authors(book), year=book.year)
+        return '{' + json.dumps(book_fields, ensure_ascii=False)[1:-1] + ','
+
+    def render_note(self, note):
+        note_fields = dict(
+            uid=note.uid, page=note.page_number, color=note.highlight_color, text=note.text, note=note.note,
+            tags=sorted(note.tags) if note.tags else [], added=note.date_created.isoformat(timespec='seconds'),
+        )
+        return json.dumps(note_fields, ensure_ascii=False)[1:] + '\n'
+
+
+def csv_fields(fields, end):
+    ''' fields written by csv.writer followed by end, a row is split between the book's and the note's part '''
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator=end).writerow(fields)
+    return buffer.getvalue()
+
+
+@register_exporter
+class CsvExporter(FlatExporter):
+    name = 'csv'
+    FILE_NAME = 'PocketBookNotes.csv'
+    HEADER = 'book,authors,year,page,color,text,note,tags,added,uid\n'
+
+    def render_book(self, book):
+        return csv_fields((book.book_name, '; '.join(get_authors(book)), book.year), end=',')
+
+    def render_note(self, note):
+        fields = (
+            note.page_number, note.highlight_color, note.text, note.note, '; '.join(sorted(note.tags)) if note.tags else None,
+            note.date_created.isoformat(timespec='seconds'), note.uid,
+        )
+        return csv_fields(fields, end='\n')
+
+
+def anki_field(value):
+    ''' html field of an Anki import, without tabs or line breaks '''
+    return html.escape(value or '').replace('\t', ' ').replace('\r\n', '<br>').replace('\n', '<br>')
+
+
+@register_exporter
+class AnkiExporter(FlatExporter):
+    '''
+    front: the highlight, back: the note and where the highlight is from, tags: highlight color and tags
+    (spaces replaced by underscores, Anki tags can not contain spaces)
+    '''
+    name = 'anki'
+    FILE_NAME = 'PocketBookNotes.tsv'
+    HEADER = '#separator:tab\n#html:true\n#tags column:3\n'
+
+    def render_book(self, book):
+        return anki_field(book.book_name)
+
+    def render_note(self, note):
+        back = anki_field(note.note) + '<br>' if note.note else ''
+        tags = [note.highlight_color] + sorted(note.tags or ())
+        return (anki_field(note.text), back, f' (pg. {note.page_number})', ' '.join(tag.replace(' ', '_') for tag in tags))
+
+    def join(self, book_part, fragment):
+        front, back, page, tags = fragment
+        return f'{front}\t{back}{book_part}{page}\t{tags}\n'
+
+
+class FragmentCache:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Rendered notes by format, kept in a hidden pickle file in the export directory so notes that did not change
+        are not rendered again on the next export. Keyed by the exporter's name and VERSION and get_note_key.
+        Fragments of the exported formats that were not used during an export are evicted on save.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    CACHE_FN = '.PocketBookExportFragments'
+
+    def __init__(self, export_dir):
+        self.cache_path = os.path.join(export_dir, self.CACHE_FN)
+        # (exporter name, version) -> {note key: fragment}
+        self.fragments = {}
+        self.used = {}
+        self.stats = dict(hits=0, rendered=0, evicted=0)
+        # books are rendered on several threads
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'rb') as p:
+                self.fragments = pickle.load(p)
+        except (pickle.UnpicklingError, EOFError, OSError, AttributeError):
+            self.fragments = {}
+
+    def save(self, evict=True):
+        '''
+        save the cache, evicting the fragments of the formats exported this time that were not used,
+        unless only some books were exported. Formats of an older VERSION are dropped
+        '''
+        for fmt in list(self.fragments):
+            if fmt in self.used:
+                if evict:
+                    self.stats['evicted'] += len(self.fragments[fmt]) - len(self.used[fmt])
+                    self.fragments[fmt] = self.used[fmt]
+            elif EXPORTERS.get(fmt[0]) is None or EXPORTERS[fmt[0]].VERSION != fmt[1]:
+                self.stats['evicted'] += len(self.fragments.pop(fmt))
+        if not self.stats['rendered'] and not self.stats['evicted'] and os.path.exists(self.cache_path):
+            return
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as p:
+            pickle.dump(self.fragments, p, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+
+    def get_formats(self, exporters):
+        ''' (cached fragments, used fragments) of each exporter '''
+        result = []
+        for exporter in exporters:
+            fmt = (exporter.name, exporter.VERSION)
+            result.append((self.fragments.setdefault(fmt, {}), self.used.setdefault(fmt, {})))
+        return result
+
+    def render_notes(self, notes, exporters, formats):
+        ''' [[fragment of each note] for each exporter], rendering the notes that are not cached '''
+        results = [[] for _ in exporters]
+        hits = rendered = 0
+        for note in notes:
+            key = get_note_key(note)
+            for exporter, (fragments, used), result in zip(exporters, formats, results):
+                fragment = fragments.get(key)
+                if fragment is None:
+                    fragment = fragments[key] = exporter.render_note(note)
+                    rendered += 1
+                else:
+                    hits += 1
+                used[key] = fragment
+                result.append(fragment)
+        with self.lock:
+            self.stats['hits'] += hits
+            self.stats['rendered'] += rendered
+        return results
+
+
+def export_collection(books, export_dir, formats=('obsidian',), workers=4, book_names=None):
+    '''
+    export books to every format in formats in one walk: each note is rendered (or taken from the FragmentCache)
+    for all formats at once, books are exported concurrently on workers threads and only changed files are written.
+    book_names: only export these books to the PER_BOOK formats, the other formats still get every book
+    since their file holds all of them (the notes of the other books mostly come from the FragmentCache).
+    Returns the report of the ExportManifest with the fragment cache stats
+    '''
+    exporter_classes = [get_exporter(name) for name in dict.fromkeys(formats)]
+    manifest = ExportManifest(export_dir)
+    exporters = [cls(export_dir, manifest) for cls in exporter_classes]
+    cache = FragmentCache(export_dir)
+    cache_formats = cache.get_formats(exporters)
+    instrumentation = get_instrumentation()
+
+    books = list(books)
+    for exporter in exporters:
+        exporter.start(books)
+    selected = [book_names is None or book.book_name in book_names for book in books]
+    flat = [i for i, exporter in enumerate(exporters) if not exporter.PER_BOOK]
+
+    def export_book(book, is_selected):
+        # (exporter index, result) of the formats the book is exported to
+        indexes = range(len(exporters)) if is_selected else flat
+        if not indexes:
+            return []
+        book_exporters = [exporters[i] for i in indexes]
+        with instrumentation.stage('export_book', book=book.book_name):
+            notes = book.get_notes_in_page_order()
+            if any(note.uid is None for note in notes):
+                assign_note_uids(book)
+            fragments = cache.render_notes(notes, book_exporters, [cache_formats[i] for i in indexes])
+            return [(i, exporter.export_book(book, book_fragments)) for i, exporter, book_fragments in zip(indexes, book_exporters, fragments)]
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(export_book, books, selected))
+    else:
+        results = [export_book(book, is_selected) for book, is_selected in zip(books, selected)]
+
+    book_results = [[] for _ in exporters]
+    for result in results:
+        for i, book_result in result:
+            book_results[i].append(book_result)
+    exported = {}
+    for exporter, exporter_results in zip(exporters, book_results):
+        exporter.finish(exporter_results)
+        # files of the books not exported this time are not orphans either
+        exported[exporter.name] = exporter.get_file_names(books)
+    cache.save(evict=book_names is None)
+    s = cache.stats
+    log.info(f'export fragments: {s["hits"]} cached, {s["rendered"]} rendered, {s["evicted"]} evicted', extra=dict(export_fragments=dict(s)))
+    report = manifest.finish(exported)
+    report['fragments'] = dict(s)
+    return report
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+
+
+# all modules log through this logger instead of printing, the application decides where records go
+log = logging.getLogger('PocketbookNoteExtractor')
+log.addHandler(logging.NullHandler())
+# the handler added by setup_logging, replaced when it is called again
+setup_handler = None
+
+PROFILE_MODES = (None, 'json', 'cprofile')
+
+
+class JsonFormatter(logging.Formatter):
+    ''' one json object per record, with the fields passed as extra={...} '''
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = dict(time=self.formatTime(record), level=record.levelname, message=record.getMessage())
+        entry.update({k: v for k, v in vars(record).items() if k not in self.RESERVED})
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level=logging.INFO, json_format=False, stream=None):
+    '''
+    log to stdout (or stream) like the previous print calls, for scripts and the command line interface.
+    Calling it again replaces the handler it added, e.g. to switch to json records. Does nothing if the
+    application added handlers of its own to the logger
+    '''
+    global setup_handler
+    own = (setup_handler,) if setup_handler is not None else ()
+    if any(h not in own and not isinstance(h, logging.NullHandler) for h in log.handlers):
+        return
+    if setup_handler is not None:
+        log.removeHandler(setup_handler)
+    setup_handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    setup_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter('%(message)s'))
+    log.addHandler(setup_handler)
+    log.setLevel(level)
+    log.propagate = False
+
+
+class Instrumentation:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Collects timers and counters for each stage of a run (sync, matching, parsing, tag inference, export),
+        in total and per book. Stages are timed with `with instrumentation.stage(name, book=...)`,
+        and counters are incremented with count(name, n, book=...). Thread safe.
+
+        Optionally runs cProfile for the whole run, see start_profiler/save.
+        When instrumentation is disabled NullInstrumentation is used, whose methods do nothing.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    enabled = True
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = defaultdict(lambda: {'seconds': 0.0, 'calls': 0})
+        self.counters = defaultdict(int)
+        self.books = defaultdict(lambda: {'seconds': defaultdict(float), 'counters': defaultdict(int)})
+        self.lock = threading.Lock()
+        self.profiler = None
+
+    @contextmanager
+    def stage(self, name, book=None):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - start, book)
+
+    def add_time(self, name, seconds, book=None):
+        with self.lock:
+            stage = self.stages[name]
+            stage['seconds'] += seconds
+            stage['calls'] += 1
+            if book is not None:
+                self.books[book]['seconds'][name] += seconds
+
+    def count(self, name, n=1, book=None):
+        with self.lock:
+            self.counters[name] += n
+            if book is not None:
+                self.books[book]['counters'][name] += n
+
+    def report(self):
+        with self.lock:
+            return dict(
+                started=self.started,
+                wall_seconds=time.time() - self.started,
+                stages={k: dict(v) for k, v in self.stages.items()},
+                counters=dict(self.counters),
+                books={
+                    book: {'seconds': dict(v['seconds']), 'counters': dict(v['counters'])}
+                    for book, v in self.books.items()
+                },
+            )
+
+    def log_summary(self):
+        for name, stage in self.report()['stages'].items():
+            log.info(f'{name}: {stage["seconds"]:.3f}s over {stage["calls"]} call(s)', extra=dict(stage=name, **stage))
+        if self.counters:
+            log.info(', '.join(f'{k}: {v}' for k, v in sorted(self.counters.items())), extra=dict(counters=dict(self.counters)))
+
+    def start_profiler(self):
+        import cProfile
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop_profiler(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler = None
+
+    def save(self, json_path=None, cprofile_path=None):
+        ''' write the report as json and/or dump the cProfile stats collected so far '''
+        if json_path is not None:
+            tmp_path = json_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.report(), f, indent=1)
+            os.replace(tmp_path, json_path)
+        if cprofile_path is not None and self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(cprofile_path)
+            self.profiler.enable()
+
+
+class NullInstrumentation(Instrumentation):
+    ''' used when instrumentation is disabled, records nothing '''
+    enabled = False
+
+    def __init__(self):
+        pass
+
+    def stage(self, name, book=None):
+        return NULL_STAGE
+
+    def add_time(self, name, seconds, book=None):
+        pass
+
+    def count(self, name, n=1, book=None):
+        pass
+
+    def report(self):
+        return {}
+
+    def log_summary(self):
+        pass
+
+    def start_profiler(self):
+        pass
+
+    def stop_profiler(self):
+        pass
+
+    def save(self, json_path=None, cprofile_path=None):
+        pass
+
+
+NULL_STAGE = nullcontext()
+_current = NullInstrumentation()
+
+
+def get_instrumentation():
+    ''' the instrumentation of the current run, NullInstrumentation unless a run enabled it '''
+    return _current
+
+
+def set_instrumentation(instrumentation):
+    global _current
+    # a profiler left running by the previous run would slow down this one
+    _current.stop_profiler()
+    _current = instrumentation if instrumentation is not None else NullInstrumentation()
+    return _current
@@ -1,9 +1,20 @@
 
+import sys
+import mmap
+import time
 from datetime import datetime
-from bs4 import BeautifulSoup
-from pprint import pprint
 
-from utils import get_dir_contents, clean_text
+from utils import get_dir_contents, clean_text, OutdatedPickleError
+from NoteParsers import parse_bookmarks_streaming, parse_bookmarks_fragment
+from TextMatchers import TagMatcher
+from NoteIndex import NoteIndex
+from Instrumentation import log, get_instrumentation
+from CollectionSnapshot import get_note_uid
+from ParseCache import BODY_END
+
+
+# backends that can be used to parse note files
+NOTE_PARSERS = ('bs4', 'stream')
 
 
 class NoteCollection:
@@ -13,49 +24,236 @@ class NoteCollection:
     ~~~~~~~~~~~
         Stores all notes as a query-able object. Contains functions to parse add new notes from a book.
         Parses raw HTML into a note object and appends it to database.
+        The parser is either 'bs4' (BeautifulSoup tree) or 'stream' (single pass, no tree), both give the same notes.
+        With workers > 1 note files are parsed in a process pool and merged back in book order.
+        If a ParseCache is given, only note files whose contents changed are parsed again,
+        and of a note file that bookmarks were appended to only the new bookmarks are parsed.
+        Tags are found with a TagMatcher compiled once from tag_list, tag_matching holds its options
+        (case_insensitive, whole_word).
+        Notes are added to a NoteIndex as they are created, see get_index.
+        A columnar NoteTable of the notes is built on demand for summaries, see get_table.
 
     ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
     '''
-    def __init__(self, book_collection, tag_list, highlight_semantic_mapping):
+    def __init__(self, book_collection, tag_list, highlight_semantic_mapping, parser='bs4', workers=1, cache=None,
+        tag_matching=None,
+    ):
+        if parser not in NOTE_PARSERS:
+            raise ValueError(f'parser: \'{parser}\' is not supported, use one of {NOTE_PARSERS}')
         self.notes = []
+        self.index = NoteIndex()
+        self.table = None
         self.tag_list = tag_list
+        self.tag_matching = tag_matching or {}
+        self.tag_matcher = TagMatcher(tag_list, **self.tag_matching)
         self.highlight_semantic_mapping = highlight_semantic_mapping
+        self.parser = parser
+        self.workers = workers
+        self.cache = cache
 
         self.add_book_collection(book_collection)
 
     
     def __iter__(self):
         yield from self.notes
+
+    def __getstate__(self):
+        # the compiled matcher, the index and the table are rebuilt instead of being pickled,
+        # and the parse cache is saved to its own file
+        state = self.__dict__.copy()
+        del state['tag_matcher']
+        state.pop('index', None)
+        state.pop('table', None)
+        state.pop('cache', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tag_matcher = TagMatcher(self.tag_list, **self.__dict__.get('tag_matching', {}))
+        self.index = None
+        self.table = None
+        self.cache = None
+
+    def get_index(self):
+        ''' returns the index of all notes, building it if the collection was unpickled '''
+        if self.index is None:
+            self.index = NoteIndex(self.notes)
+        return self.index
+
+    def get_table(self):
+        ''' returns a NoteTable of all notes, built on first use and again after notes were added '''
+        if self.table is None:
+            from NoteTable import NoteTable
+            self.table = NoteTable(self.notes)
+        return self.table
     
     def __len__(self):
         return len(self.notes)
 
 
     def add_book_collection(self, book_collection):
-        for book in book_collection:
-            soup = self.read_note_file(book.note_path)
-            self.parse_note_file(soup, book)
+        ''' parse the note file of every book, in a process pool if workers > 1 '''
+        books = list(book_collection)
+        if not books:
+            return
+        instrumentation = get_instrumentation()
+        start = time.perf_counter()
+        batches = [None] * len(books)
+        if self.cache is not None:
+            batches = [self.get_cached_batch(book) for book in books]
+        to_parse = [i for i, batch in enumerate(batches) if batch is None]
+
+        note_paths = [books[i].note_path for i in to_parse]
+        if self.workers > 1 and len(note_paths) > 1:
+            # per book timings are not available from the worker processes
+            with instrumentation.stage('parse'):
+                parsed = self.read_note_batches_parallel(note_paths)
+        else:
+            parsed = (self.read_book_note_batch(books[i]) for i in to_parse)
+        for i, batch in zip(to_parse, parsed):
+            batches[i] = batch
+            if self.cache is not None:
+                self.cache.put(books[i].note_path, batch)
+
+        # batches are in book order, so notes are added deterministically
+        with instrumentation.stage('add_notes'):
+            for book, batch in zip(books, batches):
+                self.add_note_batch(batch, book)
+                if instrumentation.enabled:
+                    rows = batch[1]
+                    instrumentation.count('notes_parsed', len(rows), book=book.book_name)
+                    instrumentation.count('tags_matched', sum(len(row[4]) for row in rows if row[4]), book=book.book_name)
+        instrumentation.count('note_files_parsed', len(to_parse))
+        seconds = time.perf_counter() - start
+        log.info(
+            f'parsed {len(to_parse)} of {len(books)} note files in {seconds:.2f}s using {self.workers} worker(s)',
+            extra=dict(stage='parse', files_parsed=len(to_parse), files=len(books), seconds=seconds, workers=self.workers),
+        )
+        if self.cache is not None:
+            self.cache.save()
+            self.cache.print_stats()
+
+    def read_note_batches_parallel(self, note_paths):
+        chunksize = max(1, len(note_paths) // (self.workers * 4))
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=init_parse_worker,
+            initargs=(self.tag_list, self.highlight_semantic_mapping, self.parser, self.tag_matching),
+        ) as executor:
+            return list(executor.map(parse_worker_batch, note_paths, chunksize=chunksize))
+
+    def reload_book(self, book):
+        ''' re-parse the note file of a book that changed, replacing its notes '''
+        if self.cache is not None:
+            self.cache.forget_file(book.note_path)
+        batch = self.get_cached_batch(book)
+        if batch is None:
+            batch = self.read_book_note_batch(book)
+            if self.cache is not None:
+                self.cache.put(book.note_path, batch)
+        self.notes = [note for note in self.notes if note.book is not book]
+        # the index is rebuilt on demand
+        self.index = None
+        book.clear_notes()
+        self.add_note_batch(batch, book)
+        get_instrumentation().count('notes_parsed', len(batch[1]), book=book.book_name)
+
+    def get_cached_batch(self, book):
+        '''
+        the batch of a book's note file from the parse cache, None if the file has to be parsed.
+        If bookmarks were only appended to the file since it was cached, just those are parsed
+        and the cache is updated with the whole batch
+        '''
+        if self.cache is None:
+            return None
+        batch = self.cache.get(book.note_path)
+        if batch is not None:
+            return batch
+        tail = self.cache.get_tail(book.note_path)
+        if tail is None:
+            return None
+        with get_instrumentation().stage('parse_tail', book=book.book_name):
+            batch = self.read_note_tail(book.note_path, *tail)
+        if batch is not None:
+            self.cache.put(book.note_path, batch)
+            get_instrumentation().count('note_files_tail_parsed', 1, book=book.book_name)
+        return batch
+
+    def read_note_tail(self, note_path, batch, offset):
+        '''
+        batch of a note file whose first offset bytes are those batch was parsed from: the bookmarks between offset
+        and </body> are parsed with the stream parser (whatever the parser) and added to a copy of batch.
+        None if the file has no </body> after offset
+        '''
+        with open(note_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+                end = contents.rfind(BODY_END, offset)
+                if end == -1:
+                    return None
+                fragment = contents[offset:end].decode('utf-8')
+        has_page_numbers, rows = self.bookmarks_to_batch(parse_bookmarks_fragment(fragment))
+        return batch[0] and has_page_numbers, batch[1] + rows
+
+    def read_book_note_batch(self, book):
+        with get_instrumentation().stage('parse', book=book.book_name):
+            return self.read_note_batch(book.note_path)
+
+    def read_note_batch(self, note_path):
+        ''' parse a note file into a compact batch, see bookmarks_to_batch '''
+        if self.parser == 'stream':
+            bookmarks = self.stream_note_file(note_path)
+        else:
+            bookmarks = self.soup_bookmarks(self.read_note_file(note_path))
+        return self.bookmarks_to_batch(bookmarks)
     
     def read_note_file(self, note_path):
+        from bs4 import BeautifulSoup
         with open(note_path, 'r', encoding='utf-8') as f:
             contents = f.read()
             soup = BeautifulSoup(contents, 'html.parser')
         return soup
 
-    def parse_note_file(self, soup, book):
-        ''' returns a list of notes from a book object '''
-        note_path, book_path, book_name, book_id = book.note_path, book.book_path, book.book_name, book.book_id
-        note_list = []
+    def stream_note_file(self, note_path):
+        ''' parse the raw bookmarks of a note file without building a tree '''
+        with open(note_path, 'r', encoding='utf-8') as f:
+            return parse_bookmarks_streaming(f.read())
+
+    def soup_bookmarks(self, soup):
+        ''' returns the raw (highlight color, page, text, note) bookmarks of a parsed note file '''
         body = soup.body
+        if body is None:
+            raise ValueError('note file has no <body>')
         note_tags = body.find_all('div', {"class": 'bookmark'})[2:] # first two tags are book name
-        has_page_numbers = True
+        bookmarks = []
         for note_tag in note_tags:
-            # parse highlight color and map to semantic tag
-            highlight_color = note_tag.get('class')[1]
+            bm_note_tag = note_tag.find('div', {'class': 'bm-note'})
+            bookmarks.append((
+                note_tag.get('class')[1],
+                note_tag.find('p', {'class': 'bm-page'}).text,
+                note_tag.find('div', {'class': 'bm-text'}).text,
+                bm_note_tag.text if bm_note_tag else None,
+            ))
+        return bookmarks
+
+    def parse_note_file(self, soup, book):
+        ''' adds the notes of a parsed note file to the collection and the book object '''
+        self.add_note_batch(self.bookmarks_to_batch(self.soup_bookmarks(soup)), book)
+
+    def bookmarks_to_batch(self, bookmarks):
+        '''
+        convert raw bookmarks into a batch (has_page_numbers, rows),
+        where each row is (highlight tag, page number, text, note, tags)
+        '''
+        rows = []
+        has_page_numbers = True
+        instrumentation = get_instrumentation()
+        tag_seconds = 0.0
+        for highlight_color, page_number, bm_text, bm_note in bookmarks:
+            # map highlight color to semantic tag
             highlight_tag = self.highlight_semantic_mapping[highlight_color]
 
             # parse page number
-            page_number = note_tag.find('p', {'class': 'bm-page'}).text
             try:
                 page_number = int(page_number)
             except:
@@ -64,48 +262,72 @@ class NoteCollection:
                 
 
             # parse bookmarked text
-            bm_text = clean_text(note_tag.find('div', {'class': 'bm-text'}).text)
+            bm_text = clean_text(bm_text)
             
             # parse note
-            bm_note_tag = note_tag.find('div', {'class': 'bm-note'})
-            if bm_note_tag:
-                bm_note = clean_text(bm_note_tag.text)
-            else:
-                bm_note = None
+            if bm_note is not None:
+                bm_note = clean_text(bm_note)
             
             # infer tags
-            tags = self.infer_tags(bm_text, bm_note)
-            
+            if instrumentation.enabled:
+                start = time.perf_counter()
+                tags = self.infer_tags(bm_text, bm_note)
+                tag_seconds += time.perf_counter() - start
+            else:
+                tags = self.infer_tags(bm_text, bm_note)
+            rows.append((highlight_tag, page_number, bm_text, bm_note, tags))
+        if instrumentation.enabled:
+            instrumentation.add_time('infer_tags', tag_seconds)
+        return has_page_numbers, rows
+
+    def add_note_batch(self, batch, book):
+        ''' create note objects from a batch and add them to the collection and the book '''
+        has_page_numbers, rows = batch
+        # notes of a batch are created together, so they share one timestamp
+        date_created = datetime.now()
+        book_uid = book.book_uid
+        # identical highlights on a page are told apart by how many came before them
+        occurrences = {}
+        for note in book.notes:
+            key = (note.page_number, note.text)
+            occurrences[key] = occurrences.get(key, 0) + 1
+        for highlight_tag, page_number, bm_text, bm_note, tags in rows:
+            key = (page_number, bm_text)
+            occurrence = occurrences.get(key, 0)
+            occurrences[key] = occurrence + 1
+            # colors and tag names repeat across notes, intern them so each is stored once
+            if tags:
+                tags = {sys.intern(tag) for tag in tags}
             # create note object and append it to collection
             note = Note(
                 # extracted attributes
-                highlight_color = highlight_tag,
+                highlight_color = sys.intern(highlight_tag),
                 page_number = page_number,
                 text = bm_text,
                 note = bm_note,
                 tags = tags,
                 # general attributes
-                note_path = note_path,
-                book_path = book_path,
-                book_name = book_name, 
-                book_id = book_id,
+                book = book,
+                date_created = date_created,
+                uid = get_note_uid(book_uid, page_number, bm_text, occurrence),
             )
             self.notes.append(note)
+            if self.index is not None:
+                self.index.add(note)
             book.add_note(note)
         
         # set if book is indexable by page number
         book.set_has_page_numbers(has_page_numbers)
+        # the table is rebuilt on demand
+        self.table = None
 
     
     def infer_tags(self, atext, anote):
-        found_tags = set()
         if not anote:
             anote = ''
         combine_text = ' '.join([atext, anote])
 
-        for el in self.tag_list:
-            if el in combine_text:
-                found_tags.add(el)
+        found_tags = self.tag_matcher.find_tags(combine_text)
         
         if not found_tags:
             return None
@@ -114,23 +336,80 @@ class NoteCollection:
 
     
 
+# process pool workers keep one parsing-only collection, so tags and mapping are only sent once per worker
+_worker_collection = None
+
+def init_parse_worker(tag_list, highlight_semantic_mapping, parser, tag_matching):
+    global _worker_collection
+    _worker_collection = NoteCollection(
+        [], tag_list, highlight_semantic_mapping, parser=parser, tag_matching=tag_matching,
+    )
+
+def parse_worker_batch(note_path):
+    return _worker_collection.read_note_batch(note_path)
+
+
 class Note:
     '''
     ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
     Description
     ~~~~~~~~~~~
         Stores an instance of a note. 
+        Book-level attributes (note_path, book_path, book_name, book_id) are read from the note's book
+        instead of being copied onto every note.
+        uid is stable across rebuilds of the collection, see CollectionSnapshot.
 
     ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
     '''
-    def __init__(self, **kwargs):
-        for attr, val in kwargs.items():
-            setattr(self, attr, val)
+    __slots__ = ('book', 'highlight_color', 'page_number', 'text', 'note', 'tags', 'date_created', 'uid')
+
+    def __init__(self, book=None, highlight_color=None, page_number=None, text=None, note=None, tags=None,
+        date_created=None, uid=None,
+    ):
+        self.book = book
+        self.highlight_color = highlight_color
+        self.page_number = page_number
+        self.text = text
+        self.note = note
+        self.tags = tags
         # set time note was created, used when updating collection
-        self.date_created = datetime.now()
+        self.date_created = date_created if date_created is not None else datetime.now()
+        self.uid = uid
+
+    def __getstate__(self):
+        # a plain tuple pickles smaller than the default {slot name: value} state
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # notes pickled before __slots__ kept their attributes in a dict and have no book
+            raise OutdatedPickleError('Note was pickled by an older version without __slots__')
+        # notes pickled before uids were added have no uid
+        self.uid = None
+        for attr, val in zip(self.__slots__, state):
+            setattr(self, attr, val)
+
+    @property
+    def note_path(self):
+        return self.book.note_path
+
+    @property
+    def book_path(self):
+        return self.book.book_path
+
+    @property
+    def book_name(self):
+        return self.book.book_name
+
+    @property
+    def book_id(self):
+        return self.book.book_id
     
     def print_attrs(self):
-        pprint(vars(self))
+        attrs = {attr: getattr(self, attr) for attr in self.__slots__ if attr != 'book'}
+        attrs.update(note_path=self.note_path, book_path=self.book_path, book_name=self.book_name, book_id=self.book_id)
+        from pprint import pprint
+        pprint(attrs)
 
     def __str__(self):
         return (
@@ -149,9 +428,9 @@ class Note:
             return_str += f'#{self.highlight_color} '
 
             
-            # add obsidian backlinks to tags
+            # add obsidian backlinks to tags, sorted so a note renders the same in every process
             if self.tags: 
-                for tag in self.tags:
+                for tag in sorted(self.tags):
                     return_str += f'[[{tag}]] '
             
             # add text and note
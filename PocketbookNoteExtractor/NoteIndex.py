@@ -0,0 +1,249 @@
+import re
+import math
+import shlex
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(s):
+    return TOKEN_RE.findall(s.lower()) if s else []
+
+
+def split_query(query):
+    ''' split a query on whitespace, keeping "quoted words" together. Apostrophes and backslashes are plain text '''
+    if query.count('"') % 2:
+        return query.split()
+    lexer = shlex.shlex(query, posix=True)
+    lexer.whitespace_split = True
+    lexer.commenters = ''
+    lexer.quotes = '"'
+    lexer.escape = ''
+    return list(lexer)
+
+
+class NoteIndex:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Inverted indexes over a set of notes, updated as notes are added.
+        Attribute indexes map book_id, highlight_color and tags to note ids, page numbers are kept sorted
+        for range queries, and the text and note of every highlight are tokenized into a positional
+        full-text index.
+
+        Queries (see search) support implicit AND, OR, NOT/-term, "phrase" and prefix* terms,
+        and text matches are ranked with BM25.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    ATTRIBUTES = ('book_id', 'highlight_color', 'tags')
+
+    def __init__(self, notes=()):
+        self.notes = []
+        self.attr_index = {attr: defaultdict(set) for attr in self.ATTRIBUTES}
+        # (page number, note id) pairs and sorted tokens, sorted lazily when a query needs them
+        self.pages = []
+        self.pages_sorted = True
+        # token -> {note id: [positions]}
+        self.postings = defaultdict(dict)
+        self.vocabulary = None
+        self.doc_lengths = []
+        self.total_length = 0
+        for note in notes:
+            self.add(note)
+
+    def __len__(self):
+        return len(self.notes)
+
+    def add(self, note):
+        doc_id = len(self.notes)
+        self.notes.append(note)
+
+        for attr in self.ATTRIBUTES:
+            val = getattr(note, attr, None)
+            if val is None:
+                continue
+            for v in (val if isinstance(val, (set, list, tuple)) else [val]):
+                self.attr_index[attr][v].add(doc_id)
+        self.pages.append((note.page_number, doc_id))
+        self.pages_sorted = False
+
+        # note tokens are shifted by one position so phrases do not span text and note
+        tokens = tokenize(note.text)
+        positions = list(enumerate(tokens))
+        positions += [(len(tokens) + 1 + i, tok) for i, tok in enumerate(tokenize(note.note))]
+        for pos, tok in positions:
+            docs = self.postings[tok]
+            if not docs:
+                self.vocabulary = None
+            docs.setdefault(doc_id, []).append(pos)
+        self.doc_lengths.append(len(positions))
+        self.total_length += len(positions)
+
+    ###################################################################################################
+    # query evaluation
+
+    def search(self, query='', book_id=None, highlight_color=None, tags=None, pages=None, limit=None):
+        '''
+        returns notes matching the text query and all given attribute filters, best match first.
+            query: words are ANDed, OR separates alternatives, NOT word or -word excludes,
+                   "quoted words" match a phrase, word* matches a prefix
+            book_id, highlight_color, tags: a value or list of values, notes matching any of them are kept
+            pages: (first, last) inclusive page range
+        '''
+        # attribute filters first, they bound the notes the text query has to consider
+        candidates = None
+        for attr, val in (('book_id', book_id), ('highlight_color', highlight_color), ('tags', tags)):
+            if val is not None:
+                matched = self.match_attribute(attr, val)
+                candidates = matched if candidates is None else candidates & matched
+        if pages is not None:
+            matched = self.match_pages(*pages)
+            candidates = matched if candidates is None else candidates & matched
+
+        scored_terms = []
+        if query and query.strip():
+            doc_ids, scored_terms = self.evaluate(query, candidates)
+        elif candidates is not None:
+            doc_ids = candidates
+        else:
+            doc_ids = range(len(self.notes))
+
+        if scored_terms:
+            scores = self.score(doc_ids, scored_terms)
+            key = lambda d: (-scores.get(d, 0.0), d)
+        else:
+            key = None
+        if limit is not None:
+            ranked = heapq.nsmallest(limit, doc_ids, key=key)
+        else:
+            ranked = sorted(doc_ids, key=key)
+        return [self.notes[d] for d in ranked]
+
+    def match_attribute(self, attr, val):
+        if isinstance(val, (str, int)):
+            val = [val]
+        result = set()
+        for v in val:
+            result |= self.attr_index[attr].get(v, set())
+        return result
+
+    def match_pages(self, first, last):
+        if not self.pages_sorted:
+            self.pages.sort()
+            self.pages_sorted = True
+        lo = bisect_left(self.pages, (first, -1))
+        hi = bisect_right(self.pages, (last, len(self.notes)))
+        return {doc_id for _, doc_id in self.pages[lo:hi]}
+
+    def evaluate(self, query, candidates):
+        ''' returns the note ids matching the query (within candidates, if given) and the terms used for ranking '''
+        result = set()
+        scored_terms = []
+        for clause in self.parse_query(query):
+            included = None
+            for negate, term in clause:
+                docs = self.match_term(term)
+                if negate:
+                    continue
+                scored_terms.append(term)
+                included = docs if included is None else included & docs
+            if included is None:
+                # a clause made only of exclusions matches every other note
+                included = candidates if candidates is not None else set(range(len(self.notes)))
+            elif candidates is not None:
+                included = included & candidates
+            for negate, term in clause:
+                if negate:
+                    included = included - self.match_term(term)
+            result |= included
+        return result, scored_terms
+
+    @staticmethod
+    def parse_query(query):
+        ''' split a query into OR-ed clauses of (negate, term) pairs, a term is a tuple of tokens or a prefix '''
+        clauses, clause = [], []
+        negate_next = False
+        for word in split_query(query):
+            if word == 'OR':
+                if clause:
+                    clauses.append(clause)
+                clause, negate_next = [], False
+                continue
+            if word == 'AND':
+                continue
+            if word == 'NOT':
+                negate_next = True
+                continue
+            negate = negate_next
+            if word.startswith('-') and len(word) > 1:
+                negate, word = True, word[1:]
+            negate_next = False
+            if word.endswith('*') and ' ' not in word:
+                term = ('prefix', word[:-1].lower())
+            else:
+                term = ('tokens', tuple(tokenize(word)))
+                if not term[1]:
+                    continue
+            clause.append((negate, term))
+        if clause:
+            clauses.append(clause)
+        return clauses
+
+    def match_term(self, term):
+        kind, val = term
+        if kind == 'prefix':
+            docs = set()
+            for tok in self.expand_prefix(val):
+                docs.update(self.postings[tok])
+            return docs
+        if len(val) == 1:
+            return set(self.postings.get(val[0], ()))
+        return self.match_phrase(val)
+
+    def expand_prefix(self, prefix):
+        if self.vocabulary is None:
+            self.vocabulary = sorted(self.postings)
+        lo = bisect_left(self.vocabulary, prefix)
+        hi = bisect_left(self.vocabulary, prefix + '\U0010ffff')
+        return self.vocabulary[lo:hi]
+
+    def match_phrase(self, tokens):
+        postings = [self.postings.get(tok, {}) for tok in tokens]
+        # start from the rarest token's documents
+        docs = set(min(postings, key=len))
+        for p in postings:
+            docs &= p.keys()
+        result = set()
+        for doc_id in docs:
+            starts = set(postings[0][doc_id])
+            for offset, p in enumerate(postings[1:], 1):
+                starts &= {pos - offset for pos in p[doc_id]}
+                if not starts:
+                    break
+            if starts:
+                result.add(doc_id)
+        return result
+
+    def score(self, doc_ids, terms, k1=1.2, b=0.75):
+        ''' BM25 score of every note in doc_ids over the tokens of the positive terms '''
+        n_docs = len(self.notes)
+        avg_length = self.total_length / n_docs if n_docs else 0.0
+        tokens = []
+        for kind, val in terms:
+            tokens.extend(self.expand_prefix(val) if kind == 'prefix' else val)
+        scores = defaultdict(float)
+        for tok in set(tokens):
+            docs = self.postings.get(tok)
+            if not docs:
+                continue
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id in docs.keys() & doc_ids:
+                tf = len(docs[doc_id])
+                norm = k1 * (1 - b + b * self.doc_lengths[doc_id] / avg_length) if avg_length else k1
+                scores[doc_id] += idf * tf * (k1 + 1) / (tf + norm)
+        return scores
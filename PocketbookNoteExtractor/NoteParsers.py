@@ -0,0 +1,159 @@
+from html import unescape
+from html.parser import HTMLParser
+from html.entities import html5
+
+
+# elements that never have content or an end tag
+VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+}
+# elements whose strings BeautifulSoup leaves out of .text
+HIDDEN_TEXT_ELEMENTS = {'script', 'style', 'template'}
+
+
+class StreamingNoteParser(HTMLParser):
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Walks a PocketBook note HTML file once as a stream of tag/data events, without building a tree.
+        Collects the same raw fields that NoteCollection.parse_note_file extracts with BeautifulSoup:
+        for every 'bookmark' div in <body>, its second class, and the text of its first 'bm-page' p,
+        first 'bm-text' div and first 'bm-note' div (None if there is no bm-note).
+
+        Text is gathered like BeautifulSoup's .text: all descendant strings and CDATA sections, without comments
+        and without the contents of <script>, <style> and <template>. Entities are resolved the way its
+        html.parser builder does. Both parsers were checked to give the same bookmarks for entities, charrefs,
+        <br>, comments, CDATA, script/style/template, nested and unclosed tags and extra whitespace in classes.
+        A file without <body> is rejected with a ValueError, as NoteCollection.soup_bookmarks does.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    # class of the element -> (tag, field it fills in the bookmark)
+    FIELDS = {
+        'bm-page': ('p', 'page'),
+        'bm-text': ('div', 'text'),
+        'bm-note': ('div', 'note'),
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.bookmarks = []
+        # open elements as [tag, opened_capture, opened], opened_capture holds the text buffers started by this
+        # element and opened is the bookmark it started (or True for <body>)
+        self.stack = []
+        self.captures = []
+        self.open_bookmarks = []
+        self.in_body = False
+        self.body_done = False
+        # number of open elements whose text is hidden
+        self.hidden_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_ELEMENTS:
+            return
+        if tag in HIDDEN_TEXT_ELEMENTS:
+            self.hidden_depth += 1
+        opened_capture = None
+        attrs = dict(attrs)
+
+        if tag == 'body' and not self.in_body and not self.body_done:
+            self.in_body = True
+            self.stack.append(['body', None, True])
+            return
+
+        classes = (attrs.get('class') or '').split()
+        if self.in_body and tag == 'div' and 'bookmark' in classes:
+            bookmark = dict(classes=classes, page=None, text=None, note=None)
+            self.bookmarks.append(bookmark)
+            self.open_bookmarks.append(bookmark)
+            self.stack.append([tag, None, bookmark])
+            return
+
+        for cls, (field_tag, field) in self.FIELDS.items():
+            if tag != field_tag or cls not in classes:
+                continue
+            # every open bookmark whose first match this is captures the element's text
+            for bookmark in self.open_bookmarks:
+                if bookmark[field] is None:
+                    bookmark[field] = []
+                    opened_capture = opened_capture or []
+                    opened_capture.append(bookmark[field])
+            break
+        if opened_capture:
+            self.captures.extend(opened_capture)
+        self.stack.append([tag, opened_capture, None])
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # close up to the most recent matching open element, ignore stray end tags
+        for i in range(len(self.stack)-1, -1, -1):
+            if self.stack[i][0] == tag:
+                break
+        else:
+            return
+        while len(self.stack) > i:
+            el_tag, opened_capture, opened = self.stack.pop()
+            if opened_capture:
+                del self.captures[-len(opened_capture):]
+            if el_tag in HIDDEN_TEXT_ELEMENTS:
+                self.hidden_depth -= 1
+            if el_tag == 'body' and opened is True:
+                self.in_body = False
+                self.body_done = True
+            elif isinstance(opened, dict):
+                self.open_bookmarks.remove(opened)
+
+    def handle_data(self, data):
+        if self.hidden_depth:
+            return
+        for buf in self.captures:
+            buf.append(data)
+
+    def unknown_decl(self, data):
+        # <![CDATA[...]]> sections are text, like BeautifulSoup's CData strings
+        if data.startswith('CDATA['):
+            self.handle_data(data[len('CDATA['):])
+
+    def handle_entityref(self, name):
+        character = html5.get(name + ';')
+        self.handle_data(character if character is not None else f'&{name}')
+
+    def handle_charref(self, name):
+        self.handle_data(unescape(f'&#{name};'))
+
+    def get_bookmarks(self, skip=0):
+        ''' returns (highlight color class, page text, bookmark text, note text) for every bookmark after skip '''
+        return [
+            (
+                b['classes'][1],
+                ''.join(b['page']) if b['page'] is not None else None,
+                ''.join(b['text']) if b['text'] is not None else None,
+                ''.join(b['note']) if b['note'] is not None else None,
+            )
+            for b in self.bookmarks[skip:]
+        ]
+
+
+def parse_bookmarks_streaming(contents):
+    ''' parse note html in one pass, first two bookmark divs are skipped as they hold the book name '''
+    parser = StreamingNoteParser()
+    parser.feed(contents)
+    parser.close()
+    if not parser.in_body and not parser.body_done:
+        raise ValueError('note file has no <body>')
+    return parser.get_bookmarks(skip=2)
+
+
+def parse_bookmarks_fragment(contents):
+    ''' parse the bookmark divs of a part of a note file's body, e.g. the bookmarks appended to it, none are skipped '''
+    parser = StreamingNoteParser()
+    parser.feed('<body>')
+    parser.feed(contents)
+    parser.feed('</body>')
+    parser.close()
+    return parser.get_bookmarks()
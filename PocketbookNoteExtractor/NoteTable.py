@@ -0,0 +1,332 @@
+import numpy as np
+
+
+'''
+columnar view of the notes of a collection, for summaries over many highlights without a python loop per note, e.g.
+    table = NoteTable(collection.NoteCollection)
+    table.groupby('highlight_color')                                    -> notes per color
+    table.groupby(['book', 'tag'], dict(notes='count', with_note=('has_note', 'sum')))
+    table.groupby('page', page_bin=25)                                  -> page density histogram
+    table.groupby('month', dict(notes='count', books=('book_id', 'nunique')))
+pandas is optional, to_dataframe() returns the same data as a DataFrame with categorical columns.
+'''
+
+GROUPERS = ('book', 'book_id', 'highlight_color', 'tag', 'page', 'year', 'month', 'day')
+AGGREGATIONS = ('count', 'sum', 'mean', 'min', 'max', 'nunique')
+# numpy datetime unit of the date groupers
+DATE_UNITS = dict(year='Y', month='M', day='D')
+# above this many possible groups, keys are grouped by sorting instead of counting
+MAX_DENSE_GROUPS = 1 << 22
+
+
+class NoteTable:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        The notes of a collection as numpy columns, one row per note in collection order.
+        Books, highlight colors and tags are stored as integer codes into their categories (book_names, colors, tags).
+        A note can have several tags, so tags are kept apart as (tag_rows, tag_codes) pairs: the row of the note
+        and the code of one of its tags. Grouping by tag counts a note once for each of its tags,
+        notes without tags are left out.
+        Columns that can be aggregated: book_id, page_number (-1 if the book has no page numbers), text_length,
+        note_length, has_note, n_tags and date_created (min, max and nunique only).
+        groupby(...) turns the groupers into one integer key per row and aggregates with np.bincount,
+        so a summary costs a few passes over the columns.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    COLUMNS = ('book_id', 'page_number', 'text_length', 'note_length', 'has_note', 'n_tags', 'date_created')
+
+    def __init__(self, notes=()):
+        # categories, kept in the order they are first seen
+        self.books = []
+        self.colors = []
+        self.tags = []
+        book_codes, color_codes = {}, {}
+        tag_codes = {}
+        # notes of a batch share their date_created, convert each date once
+        dates = {}
+        columns = dict(book=[], highlight_color=[], page_number=[], text_length=[], note_length=[], date_created=[], n_tags=[])
+        tag_rows, tag_values = [], []
+        row = -1
+        for row, note in enumerate(notes):
+            book = note.book
+            code = book_codes.get(id(book))
+            if code is None:
+                # the book is kept in self.books, so its id is not reused while building
+                code = book_codes[id(book)] = len(self.books)
+                self.books.append(book)
+            columns['book'].append(code)
+            color = note.highlight_color
+            code = color_codes.get(color)
+            if code is None:
+                code = color_codes[color] = len(self.colors)
+                self.colors.append(color)
+            columns['highlight_color'].append(code)
+            columns['page_number'].append(note.page_number if note.page_number is not None else -1)
+            columns['text_length'].append(len(note.text) if note.text else 0)
+            columns['note_length'].append(len(note.note) if note.note else 0)
+            date_created = note.date_created
+            if date_created not in dates:
+                dates[date_created] = np.datetime64(date_created, 's')
+            columns['date_created'].append(dates[date_created])
+            tags = note.tags
+            columns['n_tags'].append(len(tags) if tags else 0)
+            if tags:
+                for tag in tags:
+                    code = tag_codes.get(tag)
+                    if code is None:
+                        code = tag_codes[tag] = len(self.tags)
+                        self.tags.append(tag)
+                    tag_rows.append(row)
+                    tag_values.append(code)
+
+        self.n_rows = row + 1
+        self.book_names = np.array([book.book_name for book in self.books], dtype=object)
+        self.book_ids = np.array([book.book_id if book.book_id is not None else -1 for book in self.books], dtype=np.int64)
+        self.book = np.array(columns['book'], dtype=np.int32)
+        self.highlight_color = np.array(columns['highlight_color'], dtype=np.int32)
+        self.page_number = np.array(columns['page_number'], dtype=np.int32)
+        self.text_length = np.array(columns['text_length'], dtype=np.int32)
+        self.note_length = np.array(columns['note_length'], dtype=np.int32)
+        self.has_note = self.note_length > 0
+        self.n_tags = np.array(columns['n_tags'], dtype=np.int32)
+        self.date_created = np.array(columns['date_created'], dtype='datetime64[s]')
+        self.book_id = self.book_ids[self.book]
+        self.tag_rows = np.array(tag_rows, dtype=np.int32)
+        self.tag_codes = np.array(tag_values, dtype=np.int32)
+
+    def __len__(self):
+        return self.n_rows
+
+    ###################################################################################################
+    # groupby
+
+    def groupby(self, groupers, aggregations=None, page_bin=1):
+        '''
+        summary table with one row per combination of the groupers that occurs, ordered by the groupers
+        (books, colors and tags in the order they were first seen, pages and dates ascending).
+            groupers:     a name or list of names from GROUPERS, page is grouped in bins of page_bin pages
+            aggregations: {output column: 'count' or (column, aggregation)}, aggregations are in AGGREGATIONS,
+                          default dict(notes='count')
+        '''
+        if isinstance(groupers, str):
+            groupers = [groupers]
+        groupers = list(groupers)
+        if not groupers:
+            raise ValueError('groupby needs at least one grouper')
+        for grouper in groupers:
+            if grouper not in GROUPERS:
+                raise ValueError(f'grouper: \'{grouper}\' is not supported, use one of {GROUPERS}')
+        if page_bin < 1:
+            raise ValueError(f'page_bin must be at least 1, got {page_bin}')
+        aggregations = self.check_aggregations(aggregations or dict(notes='count'))
+
+        # rows of the notes being grouped, a note appears once per tag if grouping by tag
+        if 'tag' in groupers:
+            rows = self.tag_rows
+        else:
+            rows = None
+        keys, labels = [], []
+        for grouper in groupers:
+            codes, grouper_labels = self.group_codes(grouper, rows, page_bin)
+            keys.append(codes)
+            labels.append(grouper_labels)
+        inverse, groups = self.combine_keys(keys, [len(l) for l in labels])
+        n_groups = len(groups[0]) if groups else 0
+        counts = np.bincount(inverse, minlength=n_groups)
+
+        columns = {grouper: grouper_labels[group] for grouper, grouper_labels, group in zip(groupers, labels, groups)}
+        order = None
+        for name, (column, func) in aggregations.items():
+            if func == 'count':
+                columns[name] = counts
+                continue
+            values = getattr(self, column)
+            if rows is not None:
+                values = values[rows]
+            if func in ('min', 'max') and order is None:
+                # rows sorted by group, each group is a contiguous run of counts[g] rows
+                order = np.argsort(inverse, kind='stable')
+            columns[name] = aggregate(func, values, inverse, counts, order)
+        return SummaryTable(columns)
+
+    def check_aggregations(self, aggregations):
+        ''' aggregations as {output column: (column, aggregation)} '''
+        checked = {}
+        for name, spec in aggregations.items():
+            column, func = (None, spec) if isinstance(spec, str) else spec
+            if func not in AGGREGATIONS:
+                raise ValueError(f'aggregation: \'{func}\' is not supported, use one of {AGGREGATIONS}')
+            if func != 'count':
+                if column not in self.COLUMNS:
+                    raise ValueError(f'column: \'{column}\' can not be aggregated, use one of {self.COLUMNS}')
+                if column == 'date_created' and func in ('sum', 'mean'):
+                    raise ValueError(f'date_created can not be aggregated with \'{func}\'')
+            checked[name] = (column, func)
+        return checked
+
+    def group_codes(self, grouper, rows, page_bin):
+        ''' (codes, labels) of a grouper for the given rows (all notes if None), codes are indices into labels '''
+        if grouper == 'tag':
+            return self.tag_codes, np.array(self.tags, dtype=object)
+        if grouper == 'book':
+            codes, labels = self.book, self.book_names
+        elif grouper == 'book_id':
+            codes, labels = self.book, self.book_ids
+        elif grouper == 'highlight_color':
+            codes, labels = self.highlight_color, np.array(self.colors, dtype=object)
+        else:
+            if grouper == 'page':
+                # -1 (no page numbers) stays in a bin of its own
+                values = np.where(self.page_number < 0, -1, self.page_number // page_bin)
+            else:
+                values = self.date_created.astype(f'datetime64[{DATE_UNITS[grouper]}]').view(np.int64)
+            if rows is not None:
+                values = values[rows]
+            if not len(values):
+                return values, values
+            # ranges of pages and dates are small, offset them to codes instead of sorting
+            low, high = int(values.min()), int(values.max())
+            labels = np.arange(low, high + 1, dtype=np.int64)
+            if grouper == 'page':
+                labels = np.where(labels < 0, -1, labels * page_bin)
+            else:
+                labels = labels.astype(f'datetime64[{DATE_UNITS[grouper]}]')
+            return values - low, labels
+        if rows is not None:
+            codes = codes[rows]
+        return codes, labels
+
+    @staticmethod
+    def combine_keys(keys, sizes):
+        ''' (group of each row, [code of each group for each key]), groups sorted by their codes '''
+        n_keys = int(np.prod(sizes, dtype=np.int64)) if keys else 0
+        if len(keys) == 1:
+            key = keys[0].astype(np.int64)
+        else:
+            key = np.ravel_multi_index([k.astype(np.int64) for k in keys], sizes)
+        if n_keys <= MAX_DENSE_GROUPS:
+            # count every possible key and keep those that occur, O(rows + possible keys)
+            present = np.flatnonzero(np.bincount(key, minlength=n_keys))
+            remap = np.empty(n_keys, dtype=np.int64)
+            remap[present] = np.arange(len(present))
+            inverse = remap[key]
+        else:
+            present, inverse = np.unique(key, return_inverse=True)
+        return inverse, list(np.unravel_index(present, sizes)) if len(keys) > 1 else [present]
+
+    ###################################################################################################
+    # pandas
+
+    def to_dataframe(self, explode_tags=False):
+        '''
+        the table as a pandas DataFrame with categorical book, highlight_color (and tag) columns,
+        one row per note and tag of the note if explode_tags (tag is missing for notes without tags)
+        '''
+        import pandas as pd
+        data = dict(
+            book=pd.Categorical.from_codes(self.book, categories=pd.Index(self.book_names, dtype=object)),
+            book_id=self.book_id,
+            highlight_color=pd.Categorical.from_codes(self.highlight_color, categories=pd.Index(self.colors, dtype=object)),
+            page_number=self.page_number,
+            text_length=self.text_length,
+            note_length=self.note_length,
+            has_note=self.has_note,
+            n_tags=self.n_tags,
+            date_created=self.date_created,
+        )
+        frame = pd.DataFrame(data)
+        if not explode_tags:
+            return frame
+        tags = pd.DataFrame(dict(
+            row=self.tag_rows, tag=pd.Categorical.from_codes(self.tag_codes, categories=pd.Index(self.tags, dtype=object)),
+        ))
+        return frame.join(tags.set_index('row'), how='left')
+
+
+def aggregate(func, values, inverse, counts, order=None):
+    ''' aggregate values by group, inverse is the group of each value, order the values sorted by group (min, max) '''
+    n_groups = len(counts)
+    if func == 'sum' or func == 'mean':
+        sums = np.bincount(inverse, weights=values.astype(np.float64), minlength=n_groups)
+        if func == 'mean':
+            return sums / np.maximum(counts, 1)
+        return sums if values.dtype.kind == 'f' else np.rint(sums).astype(np.int64)
+    is_date = values.dtype.kind == 'M'
+    as_int = values.view(np.int64) if is_date else values.astype(np.int64)
+    if func == 'nunique':
+        # count distinct (group, value) pairs
+        low = as_int.min() if len(as_int) else 0
+        span = int(as_int.max() - low + 1) if len(as_int) else 1
+        pairs = np.unique(inverse.astype(np.int64) * span + (as_int - low))
+        return np.bincount(pairs // span, minlength=n_groups)
+    if not n_groups:
+        return values[:0]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    reduce = np.minimum if func == 'min' else np.maximum
+    result = reduce.reduceat(as_int[order], starts)
+    return result.view(values.dtype) if is_date else result.astype(values.dtype)
+
+
+class SummaryTable:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Result of NoteTable.groupby: equal length numpy columns by name, the groupers first and then the aggregations.
+        Rows can be iterated as dicts, sorted, printed or converted to a pandas DataFrame.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __iter__(self):
+        ''' rows as {column: value} dicts '''
+        names = list(self.columns)
+        for values in zip(*(self.columns[name].tolist() for name in names)):
+            yield dict(zip(names, values))
+
+    def sort(self, column, descending=False):
+        values = self.columns[column]
+        if descending:
+            # sort the negated ranks of the values, so ties stay in their order like an ascending sort
+            # (reversing an ascending sort would reverse them too). Ranks also work for strings and dates
+            ranks = np.unique(values, return_inverse=True)[1].reshape(-1)
+            order = np.argsort(-ranks, kind='stable')
+        else:
+            order = np.argsort(values, kind='stable')
+        return SummaryTable({name: values[order] for name, values in self.columns.items()})
+
+    def head(self, n=10):
+        return SummaryTable({name: values[:n] for name, values in self.columns.items()})
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame(self.columns)
+
+    def __str__(self):
+        names = list(self.columns)
+        cells = [format_column(self.columns[name]) for name in names]
+        widths = [max([len(name)] + [len(cell) for cell in column]) for name, column in zip(names, cells)]
+        lines = ['  '.join(name.rjust(width) for name, width in zip(names, widths))]
+        for row in zip(*cells):
+            lines.append('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+        return '\n'.join(lines)
+
+
+def format_column(values):
+    if values.dtype.kind == 'M':
+        # e.g. 2024-05 for a month rather than the date of its first day
+        return values.astype(str).tolist()
+    if values.dtype.kind == 'f':
+        return [f'{value:.2f}' for value in values.tolist()]
+    return [str(value) for value in values.tolist()]
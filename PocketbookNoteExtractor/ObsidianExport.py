@@ -0,0 +1,209 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from Instrumentation import log, get_instrumentation
+
+
+class ExportManifest:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Stores the sha1 of every file exported to a vault, in a hidden json file in the vault directory.
+        Used to skip writing files whose rendered content did not change, and to find exported files
+        whose book is no longer in the collection (orphans).
+        Files are kept by the exporter that wrote them (see Exporters, markdown files are 'obsidian'),
+        so the orphans of an export are only looked for among the files of the exporters it ran.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    MANIFEST_FN = '.PocketBookExportManifest.json'
+    WRITE_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, export_dir):
+        self.export_dir = export_dir
+        self.manifest_path = os.path.join(export_dir, self.MANIFEST_FN)
+        # exporter -> {file name: sha1}
+        self.files = {}
+        self.lock = threading.Lock()
+        self.load()
+        self.reset_report()
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (ValueError, OSError):
+            return
+        if 'exporters' in data:
+            self.files = data['exporters']
+        else:
+            # manifests before exporters were kept apart, their markdown files are the obsidian export's
+            self.files = {'obsidian': {k: v for k, v in data.get('files', {}).items() if k.endswith('.md')}}
+
+    def save(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'exporters': self.files}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def reset_report(self):
+        self.report = dict(written=[], unchanged=[], orphaned=[])
+
+    def write_if_changed(self, file_name, fragments, newline=os.linesep, exporter='obsidian'):
+        '''
+        write the text fragments of an exporter to file_name in the vault unless the file already holds them.
+        Newlines are written as newline, by default like a text mode file, so output is the same as writing
+        with open(..., 'w').
+        '''
+        if isinstance(fragments, str):
+            fragments = [fragments]
+        # encode and hash fragment by fragment, the document is never joined into one string
+        hasher = hashlib.sha1()
+        chunks = []
+        for fragment in fragments:
+            if newline != '\n':
+                fragment = fragment.replace('\n', newline)
+            chunk = fragment.encode('utf-8')
+            hasher.update(chunk)
+            chunks.append(chunk)
+        content_hash = hasher.hexdigest()
+        path = os.path.join(self.export_dir, file_name)
+
+        with self.lock:
+            known_hash = self.files.get(exporter, {}).get(file_name)
+        if known_hash is None and os.path.exists(path):
+            # exported before the manifest existed, compare with the file itself
+            known_hash = hash_file(path)
+        changed = known_hash != content_hash or not os.path.exists(path)
+        if changed:
+            write_atomic(path, chunks, self.WRITE_BUFFER_SIZE)
+
+        with self.lock:
+            self.files.setdefault(exporter, {})[file_name] = content_hash
+            self.report['written' if changed else 'unchanged'].append(file_name)
+        return changed
+
+    def finish(self, exported_file_names):
+        '''
+        record orphaned files (exported before by an exporter, but not this time), save and print the report.
+        exported_file_names: {exporter: file names} of the exporters that ran, a list is the obsidian export's
+        '''
+        if not isinstance(exported_file_names, dict):
+            exported_file_names = {'obsidian': exported_file_names}
+        for files in self.report.values():
+            files.sort()
+        for exporter, file_names in exported_file_names.items():
+            file_names = set(file_names)
+            for file_name in sorted(self.files.get(exporter, ())):
+                if file_name not in file_names and os.path.exists(os.path.join(self.export_dir, file_name)):
+                    self.report['orphaned'].append(file_name)
+        self.save()
+        r = self.report
+        counts = {f'files_{k}': len(v) for k, v in r.items()}
+        instrumentation = get_instrumentation()
+        for k, v in counts.items():
+            instrumentation.count(k, v)
+        log.info(f'{len(r["written"])} files written, {len(r["unchanged"])} unchanged, {len(r["orphaned"])} orphaned', extra=dict(stage='export', **counts))
+        for file_name in r['orphaned']:
+            log.info(f'\torphaned: {file_name}')
+        return r
+
+
+def write_atomic(path, chunks, buffer_size=-1):
+    ''' write byte chunks to a temp file of its own next to path and rename it into place '''
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb', buffering=buffer_size) as f:
+            f.writelines(chunks)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_md_file_name(book_name):
+    ''' file name MdUtils would use for a book '''
+    return book_name if book_name.endswith('.md') else book_name + '.md'
+
+
+def get_md_file_names(books):
+    '''
+    {id(book): markdown file name} of books. Books sharing a name, e.g. X.epub and X.pdf, would share a file,
+    so each of them gets its file type added (X (epub).md, X (pdf).md), and its book id if that is shared too
+    '''
+    by_name = {}
+    for book in books:
+        by_name.setdefault(book.book_name, []).append(book)
+    file_names = {}
+    for book_name, same_name in by_name.items():
+        if len(same_name) == 1:
+            file_names[id(same_name[0])] = get_md_file_name(book_name)
+            continue
+        log.info(f'{len(same_name)} books are named {book_name}, their files are told apart by file type')
+        file_types = [book.file_type.lstrip('.') for book in same_name]
+        for book, file_type in zip(same_name, file_types):
+            suffix = file_type if file_types.count(file_type) == 1 else f'{file_type} {book.book_id}'
+            file_names[id(book)] = get_md_file_name(f'{book_name} ({suffix})')
+    return file_names
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def iter_book_markdown(book, note_fragments=None):
+    '''
+    yields the text fragments of a book's markdown file, laid out exactly as the MdUtils
+    export did (empty setext title, Book info header, book info paragraph, Notes header, one paragraph per note).
+    note_fragments: the notes already rendered in page order, e.g. by Exporters.ObsidianExporter
+    '''
+    yield '\n\n\n'
+    yield '\n# Book info\n'
+    yield '\n\n'
+    yield book.get_book_info_as_export_str(export_to='obsidian')
+    yield '\n\n'
+    yield '\n# Notes\n'
+    if note_fragments is None:
+        note_fragments = (n.export_str(export_to='obsidian') for n in book.get_notes_in_page_order())
+    for fragment in note_fragments:
+        yield '\n\n'
+        yield fragment
+
+
+def export_books(books, export_dir, workers=4, skipped_books=()):
+    '''
+    export each book to its own markdown file in export_dir, on a pool of worker threads.
+    Only changed files are written, returns the report of the ExportManifest.
+    skipped_books: books not exported this time, whose files should not be reported as orphans
+    '''
+    manifest = ExportManifest(export_dir)
+    instrumentation = get_instrumentation()
+    books, skipped_books = list(books), list(skipped_books)
+    # names are decided for all books before any is written, so no two tasks write the same file
+    file_names = get_md_file_names(books + skipped_books)
+
+    def export_book(book):
+        file_name = file_names[id(book)]
+        with instrumentation.stage('export_book', book=book.book_name):
+            manifest.write_if_changed(file_name, iter_book_markdown(book))
+        return file_name
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            exported = list(pool.map(export_book, books))
+    else:
+        exported = [export_book(book) for book in books]
+
+    return manifest.finish(exported + [file_names[id(book)] for book in skipped_books])
@@ -0,0 +1,173 @@
+import os
+import json
+import mmap
+import pickle
+import hashlib
+
+from Instrumentation import log
+
+
+# bookmarks are appended to a note file before its closing body tag
+BODY_END = b'</body>'
+
+class ParseCache:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Persistent cache of parsed note batches, keyed by the sha1 of each note file's contents.
+        The tag list, tag matching options and highlight mapping change how notes are parsed, so the whole
+        cache is invalidated when any of them changes. Entries that were not used during a load are evicted on save.
+
+        PocketBook appends new bookmarks to the end of a note file. For every note file the cache also remembers
+        where its body ended (the offset of </body>), the hash of the contents before it and the number of notes
+        parsed from it. If a file changed but still starts with those contents, get_tail returns the cached batch
+        and the offset, so only the bookmarks after the offset need to be parsed (see NoteCollection.get_cached_batch).
+        Any other change, e.g. a deleted or edited highlight, changes that prefix and the file is parsed again.
+        Files are hashed in one pass over a memory map, computing the hash of the whole contents, of the
+        contents before </body> and of the contents before the previous offset together.
+
+        stats counts hits, misses, tail hits (misses of files that were only appended to) and evicted (stale)
+        entries for the last load.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, cache_path, tag_list, highlight_semantic_mapping, tag_matching=None):
+        self.cache_path = cache_path
+        self.config_key = self.get_config_key(tag_list, highlight_semantic_mapping, tag_matching)
+        self.entries = {}
+        # note path -> dict(offset, prefix_hash, n_notes, content_hash) of the last version of the file that was parsed
+        self.tails = {}
+        self.used = set()
+        # hash of each note file looked up this load, so it is only computed once
+        self.file_hashes = {}
+        # note path -> (offset of </body>, hash of the contents before it) and whether it starts like its last version
+        self.file_ends = {}
+        self.file_grew = {}
+        self.stats = dict(hits=0, tail_hits=0, misses=0, evicted=0)
+        self.load()
+
+    @staticmethod
+    def get_config_key(tag_list, highlight_semantic_mapping, tag_matching=None):
+        config = json.dumps([
+            list(tag_list), sorted(highlight_semantic_mapping.items()), sorted((tag_matching or {}).items()),
+        ])
+        return hashlib.sha1(config.encode('utf-8')).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'rb') as p:
+                cached = pickle.load(p)
+        except (pickle.UnpicklingError, EOFError, OSError):
+            return
+        if cached.get('config_key') != self.config_key:
+            # tags or highlight mapping changed, every entry is stale
+            self.stats['evicted'] += len(cached.get('entries', {}))
+            return
+        self.entries = cached['entries']
+        # caches saved before tails were kept have none
+        self.tails = cached.get('tails', {})
+
+    def save(self, evict=True):
+        ''' save the cache, evicting entries unused since it was opened unless only some note files were reloaded '''
+        if evict:
+            stale = [k for k in self.entries if k not in self.used]
+            for k in stale:
+                del self.entries[k]
+            self.stats['evicted'] += len(stale)
+        self.tails = {k: tail for k, tail in self.tails.items() if tail['content_hash'] in self.entries}
+
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as p:
+            pickle.dump({'config_key': self.config_key, 'entries': self.entries, 'tails': self.tails}, p)
+        os.replace(tmp_path, self.cache_path)
+
+    def hash_note_file(self, note_path):
+        key = str(note_path)
+        if key not in self.file_hashes:
+            self.scan_note_file(note_path)
+        return self.file_hashes[key]
+
+    def scan_note_file(self, note_path):
+        ''' hash the contents of a note file, the contents before </body> and before the offset of its last version '''
+        key = str(note_path)
+        tail = self.tails.get(key)
+        with open(note_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # an empty file can not be memory mapped
+            contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            try:
+                end = contents.rfind(BODY_END)
+                cuts = {end} if end != -1 else set()
+                if tail is not None and tail['offset'] <= size:
+                    cuts.add(tail['offset'])
+                digests = {}
+                h = hashlib.sha1()
+                with memoryview(contents) as view:
+                    pos = 0
+                    for cut in sorted(cuts):
+                        h.update(view[pos:cut])
+                        digests[cut] = h.hexdigest()
+                        pos = cut
+                    h.update(view[pos:])
+            finally:
+                if size:
+                    contents.close()
+        self.file_hashes[key] = h.hexdigest()
+        self.file_ends[key] = (end, digests[end]) if end != -1 else None
+        self.file_grew[key] = tail is not None and digests.get(tail['offset']) == tail['prefix_hash']
+
+    def forget_file(self, note_path):
+        ''' drop the remembered hash of a note file that changed '''
+        key = str(note_path)
+        self.file_hashes.pop(key, None)
+        self.file_ends.pop(key, None)
+        self.file_grew.pop(key, None)
+
+    def get(self, note_path):
+        ''' returns the cached batch for the current contents of note_path, or None '''
+        content_hash = self.hash_note_file(note_path)
+        batch = self.entries.get(content_hash)
+        if batch is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self.used.add(content_hash)
+        return batch
+
+    def get_tail(self, note_path):
+        '''
+        (batch, offset) if note_path changed only after the offset its last parsed version ended at, e.g. bookmarks
+        were appended, where batch holds the notes parsed from before the offset. None otherwise
+        '''
+        key = str(note_path)
+        self.hash_note_file(note_path)
+        tail = self.tails.get(key)
+        if not self.file_grew.get(key):
+            return None
+        batch = self.entries.get(tail['content_hash'])
+        if batch is None or len(batch[1]) != tail['n_notes']:
+            return None
+        self.stats['tail_hits'] += 1
+        return batch, tail['offset']
+
+    def put(self, note_path, batch):
+        content_hash = self.hash_note_file(note_path)
+        self.entries[content_hash] = batch
+        self.used.add(content_hash)
+        key = str(note_path)
+        end = self.file_ends.get(key)
+        if end is None:
+            self.tails.pop(key, None)
+        else:
+            offset, prefix_hash = end
+            self.tails[key] = dict(offset=offset, prefix_hash=prefix_hash, n_notes=len(batch[1]), content_hash=content_hash)
+
+    def print_stats(self):
+        s = self.stats
+        log.info(
+            f'parse cache: {s["hits"]} hits, {s["misses"]} misses ({s["tail_hits"]} only appended to), {s["evicted"]} stale entries evicted',
+            extra=dict(parse_cache=dict(s)),
+        )
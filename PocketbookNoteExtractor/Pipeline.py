@@ -0,0 +1,296 @@
+import os
+import time
+import queue
+import threading
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import get_dir_contents
+from BookCollections import BookCollection
+from NoteCollections import NoteCollection, init_parse_worker, parse_worker_batch
+from Instrumentation import log, get_instrumentation
+
+
+# put on a queue by a stage when it has no more items
+DONE = object()
+
+
+class PipelineAborted(Exception):
+    ''' raised in a stage when another stage failed, so every thread stops '''
+
+
+class LoadPipeline:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Loads a MyCollection with overlapping stages instead of copying, matching, parsing and exporting one after the other:
+            match:  books and notes are matched from the device listings before anything is copied
+            copy:   note files are copied first, each one is queued for parsing as soon as it is in place,
+                    then the books are copied while notes are being parsed
+            parse:  note files are parsed (or taken from the parse cache) as they arrive, in a process pool if workers > 1
+            export: optionally, each book is exported to the vault as soon as its notes are parsed
+        With sync=False only the local files are matched, parsed and exported.
+        Stages run in their own threads and are connected by bounded queues (queue_size items),
+        so a fast stage waits for a slow one instead of piling up work. Wall time approaches the slowest stage
+        rather than the sum of the stages. The resulting collection is the same as the one a staged load builds.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, collection, export_dir=None, queue_size=8, export_workers=1, sync=True):
+        self.collection = collection
+        self.sync = sync
+        self.export_dir = export_dir
+        self.queue_size = queue_size
+        self.export_workers = export_workers
+        self.parse_queue = queue.Queue(maxsize=queue_size)
+        self.export_queue = queue.Queue(maxsize=queue_size)
+        self.failed = threading.Event()
+        self.errors = []
+        self.export_report = None
+
+    def run(self):
+        ''' sync, match, parse and optionally export, sets the BookCollection and NoteCollection of the collection '''
+        c = self.collection
+        instrumentation = get_instrumentation()
+        start = time.perf_counter()
+        syncer, jobs = self.plan_sync()
+        with instrumentation.stage('match_books'):
+            c.BookCollection = self.match(jobs)
+        c.NoteCollection = self.new_note_collection()
+        books = list(c.BookCollection)
+        by_note_path = {str(book.note_path): book for book in books}
+
+        # notes that do not need to be copied can be parsed right away
+        copied_notes = {dst_file for _, _, _, dst_file in jobs.get('notes', ())}
+        ready = [book for book in books if str(book.note_path) not in copied_notes]
+        stages = [
+            threading.Thread(target=self.run_stage, args=('copy', self.copy_stage, syncer, jobs, by_note_path), daemon=True),
+            threading.Thread(target=self.run_stage, args=('parse', self.parse_stage, ready), daemon=True),
+        ]
+        if self.export_dir is not None:
+            stages.append(threading.Thread(target=self.run_stage, args=('export', self.export_stage), daemon=True))
+        for thread in stages:
+            thread.start()
+        for thread in stages:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+        if syncer is not None:
+            c.sync_report = syncer.finish()
+        note_collection = c.NoteCollection
+        # books were parsed in the order their files arrived, keep notes in book order like a staged load
+        note_collection.notes = [note for book in books for note in book.notes]
+        if note_collection.cache is not None:
+            note_collection.cache.save()
+            note_collection.cache.print_stats()
+        seconds = time.perf_counter() - start
+        log.info(
+            f'loaded {len(books)} books and {len(note_collection)} notes in {seconds:.2f}s (pipelined)',
+            extra=dict(stage='pipeline', books=len(books), notes=len(note_collection), seconds=seconds),
+        )
+        return self.export_report
+
+    def run_stage(self, name, target, *args):
+        try:
+            with get_instrumentation().stage(f'pipeline_{name}'):
+                target(*args)
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            self.errors.append(e)
+            self.failed.set()
+
+    def put(self, q, item):
+        ''' put an item on a bounded queue, waiting while it is full (backpressure) unless another stage failed '''
+        while True:
+            if self.failed.is_set():
+                raise PipelineAborted()
+            try:
+                return q.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+
+    def get(self, q):
+        while True:
+            if self.failed.is_set():
+                raise PipelineAborted()
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    ###################################################################################################
+    # match
+
+    def plan_sync(self):
+        ''' the DeviceSync and its transfer jobs by content type, (None, {}) if not syncing or the device is not connected '''
+        c = self.collection
+        if not self.sync or not c.check_is_device_connected():
+            return None, {}
+        log.info('device is connected, copying over all books and notes')
+        syncer = c.get_syncer()
+        syncer.reset_report()
+        jobs = syncer.plan(c.get_sync_content())
+        return syncer, jobs
+
+    def match(self, jobs):
+        ''' match books and notes from the local files and the files that are about to be copied '''
+        c = self.collection
+        paths = {}
+        for ctype, local_dir in (('notes', c.note_dir), ('books', c.book_dir)):
+            local = set(get_dir_contents(local_dir))
+            local.update(Path(dst_file) for _, _, _, dst_file in jobs.get(ctype, ()))
+            paths[ctype] = sorted(local)
+        book_collection = BookCollection(
+            c.note_dir, c.book_dir, note_paths=paths['notes'], book_paths=paths['books'], **c.book_matching,
+        )
+        # books are not copied yet, read their metadata on the device
+        c.apply_book_metadata(book_collection, {dst_file: src_file for _, _, src_file, dst_file in jobs.get('books', ())})
+        return book_collection
+
+    def new_note_collection(self):
+        ''' an empty NoteCollection configured like the collection's, filled by the parse stage '''
+        c = self.collection
+        note_collection = NoteCollection(
+            [], c.tags_list, c.highlight_semantic_mapping,
+            parser=c.note_parser, workers=c.parse_workers, cache=c.get_parse_cache(), tag_matching=c.tag_matching,
+        )
+        # books arrive out of order, the index is built on demand from the notes in book order
+        note_collection.index = None
+        return note_collection
+
+    ###################################################################################################
+    # copy
+
+    def copy_stage(self, syncer, jobs, by_note_path):
+        ''' copy notes then books, queueing each copied note file for parsing '''
+        if syncer is not None:
+            # notes are small and needed by the parse stage, books are copied while notes are parsed
+            ordered = list(jobs.get('notes', ()))
+            for ctype, ctype_jobs in jobs.items():
+                if ctype != 'notes':
+                    ordered.extend(ctype_jobs)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=syncer.pool.workers) as executor:
+                futures = {}
+                for job in ordered:
+                    _, _, src_file, dst_file = job
+                    futures[executor.submit(syncer.pool.transfer, src_file, dst_file)] = job
+                try:
+                    for future in as_completed(futures):
+                        key, st, _, dst_file = futures[future]
+                        syncer.record_copy(key, st, dst_file, future.result())
+                        book = by_note_path.get(str(dst_file))
+                        if book is not None:
+                            self.put(self.parse_queue, book)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+            n_bytes = syncer.report['bytes_transferred']
+            elapsed = time.perf_counter() - start
+            syncer.report['throughput'] = dict(
+                files=len(ordered), bytes=n_bytes, seconds=elapsed, mb_per_s=syncer.pool.throughput(n_bytes, elapsed),
+            )
+        self.put(self.parse_queue, DONE)
+
+    ###################################################################################################
+    # parse
+
+    def iter_arrived_books(self, ready):
+        ''' books whose note file is in place: those that were not copied, then the others as they are copied '''
+        yield from ready
+        while True:
+            book = self.get(self.parse_queue)
+            if book is DONE:
+                return
+            yield book
+
+    def parse_stage(self, ready):
+        note_collection = self.collection.NoteCollection
+        cache = note_collection.cache
+        instrumentation = get_instrumentation()
+        n_parsed = 0
+        if note_collection.workers > 1:
+            batches = self.parse_in_processes(note_collection, self.iter_arrived_books(ready))
+        else:
+            batches = self.parse_in_thread(note_collection, self.iter_arrived_books(ready))
+        for book, batch, parsed in batches:
+            if parsed:
+                n_parsed += 1
+                if cache is not None:
+                    cache.put(book.note_path, batch)
+            with instrumentation.stage('add_notes', book=book.book_name):
+                note_collection.add_note_batch(batch, book)
+            if instrumentation.enabled:
+                rows = batch[1]
+                instrumentation.count('notes_parsed', len(rows), book=book.book_name)
+                instrumentation.count('tags_matched', sum(len(row[4]) for row in rows if row[4]), book=book.book_name)
+            if self.export_dir is not None:
+                self.put(self.export_queue, book)
+        instrumentation.count('note_files_parsed', n_parsed)
+        if self.export_dir is not None:
+            self.put(self.export_queue, DONE)
+
+    def parse_in_thread(self, note_collection, books):
+        ''' (book, batch, parsed) as each book arrives, from the parse cache if its note file did not change (or grew) '''
+        for book in books:
+            batch = note_collection.get_cached_batch(book)
+            if batch is not None:
+                yield book, batch, False
+            else:
+                yield book, note_collection.read_book_note_batch(book), True
+
+    def parse_in_processes(self, note_collection, books):
+        ''' like parse_in_thread, with at most 2 x workers note files being parsed in a process pool at a time '''
+        from concurrent.futures import ProcessPoolExecutor
+        pending = deque()
+        with ProcessPoolExecutor(
+            max_workers=note_collection.workers,
+            initializer=init_parse_worker,
+            initargs=(note_collection.tag_list, note_collection.highlight_semantic_mapping, note_collection.parser, note_collection.tag_matching),
+        ) as executor:
+            for book in books:
+                batch = note_collection.get_cached_batch(book)
+                if batch is not None:
+                    yield book, batch, False
+                    continue
+                pending.append((book, executor.submit(parse_worker_batch, book.note_path)))
+                while len(pending) >= 2 * note_collection.workers:
+                    book, future = pending.popleft()
+                    yield book, future.result(), True
+            while pending:
+                book, future = pending.popleft()
+                yield book, future.result(), True
+
+    ###################################################################################################
+    # export
+
+    def export_stage(self):
+        ''' write each book to the vault as soon as its notes are parsed '''
+        from ObsidianExport import ExportManifest, get_md_file_names, iter_book_markdown
+        os.makedirs(self.export_dir, exist_ok=True)
+        manifest = ExportManifest(self.export_dir)
+        # the books are matched before the stages start, name their files before any is written
+        file_names = get_md_file_names(self.collection.BookCollection)
+        instrumentation = get_instrumentation()
+        exported = []
+
+        def export_book(book):
+            file_name = file_names[id(book)]
+            with instrumentation.stage('export_book', book=book.book_name):
+                manifest.write_if_changed(file_name, iter_book_markdown(book))
+            return file_name
+
+        with ThreadPoolExecutor(max_workers=max(1, self.export_workers)) as executor:
+            futures = []
+            while True:
+                book = self.get(self.export_queue)
+                if book is DONE:
+                    break
+                futures.append(executor.submit(export_book, book))
+            exported = [future.result() for future in futures]
+        self.export_report = manifest.finish(exported)
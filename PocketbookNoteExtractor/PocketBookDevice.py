@@ -1,27 +1,157 @@
-import os 
-import win32com.client
+import os
+import sys
+
+
+class WMIBackend:
+    ''' finds a volume by label with a WMI query of the logical disks, Windows only '''
+    name = 'wmi'
+
+    def find_volume(self, label):
+        import win32com.client
+        strComputer = "."
+        objWMIService = win32com.client.Dispatch("WbemScripting.SWbemLocator")
+        objSWbemServices = objWMIService.ConnectServer(strComputer, r"root\cimv2")
+        colItems = objSWbemServices.ExecQuery("Select * from Win32_LogicalDisk")
+        for objItem in colItems:
+            if objItem.VolumeName == label:
+                return objItem.name + '\\'
+        return None
+
+
+class LinuxBackend:
+    '''
+    finds a mounted volume by label: the block device is resolved through /dev/disk/by-label and looked up
+    in /proc/self/mounts. Without udev labels, falls back to mount points named after the label
+    (e.g. /media/<user>/<label>, as mounted by desktop automounters, or /Volumes/<label> on macOS)
+    '''
+    name = 'linux'
+    BY_LABEL_DIR = '/dev/disk/by-label'
+    MOUNTS_FILE = '/proc/self/mounts'
+
+    def find_volume(self, label):
+        mounts = self.read_mounts()
+        device = self.resolve_label(label)
+        if device is not None:
+            for mount_device, mount_point in mounts:
+                if os.path.realpath(mount_device) == device:
+                    return mount_point
+        for _, mount_point in mounts:
+            if os.path.basename(mount_point) == label:
+                return mount_point
+        mount_point = os.path.join('/Volumes', label)
+        if os.path.isdir(mount_point):
+            return mount_point
+        return None
+
+    def resolve_label(self, label):
+        ''' the block device with this label, udev escapes characters such as spaces as \\xNN in link names '''
+        escaped = ''.join(c if c.isalnum() or c in '#+-.:=@_' else f'\\x{ord(c):02x}' for c in label)
+        for name in (escaped, label):
+            path = os.path.join(self.BY_LABEL_DIR, name)
+            if os.path.exists(path):
+                return os.path.realpath(path)
+        return None
+
+    def read_mounts(self):
+        ''' (device, mount point) pairs, fields of the mounts file escape spaces etc. as octal \\NNN '''
+        try:
+            with open(self.MOUNTS_FILE, 'r', encoding='utf-8', errors='replace') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return []
+        mounts = []
+        for line in lines:
+            fields = line.split()
+            if len(fields) >= 2:
+                mounts.append((self.unescape(fields[0]), self.unescape(fields[1])))
+        return mounts
+
+    @staticmethod
+    def unescape(field):
+        if '\\' not in field:
+            return field
+        return field.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+
+
+class DirectoryBackend:
+    ''' treats a plain directory as the device, e.g. a copy of the device's files for testing '''
+    name = 'directory'
+
+    def __init__(self, path):
+        self.path = path
+
+    def find_volume(self, label):
+        return self.path if os.path.isdir(self.path) else None
+
+
+DEVICE_BACKENDS = {backend.name: backend for backend in (WMIBackend, LinuxBackend, DirectoryBackend)}
+
+# (backend, label) -> mount path or None, kept for the lifetime of the process
+_detected_volumes = {}
+
+
+def get_default_backend():
+    return WMIBackend() if sys.platform == 'win32' else LinuxBackend()
+
+
+def find_volume(backend, label, refresh=False):
+    ''' cached lookup of a volume, a cached mount path is only dropped if it no longer exists '''
+    key = (backend.name, getattr(backend, 'path', None), label)
+    if not refresh and key in _detected_volumes:
+        path = _detected_volumes[key]
+        if path is None or os.path.isdir(path):
+            return path
+    _detected_volumes[key] = backend.find_volume(label)
+    return _detected_volumes[key]
+
+
+def clear_device_cache():
+    _detected_volumes.clear()
+
 
 class Device:
-    def __init__(self, device_name='PB741'):
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        A PocketBook device found by its volume label, and the paths of its books and notes.
+        backend: 'wmi', 'linux' or 'directory' (or a backend object), by default the backend of the platform.
+        device_path: with the 'directory' backend, the directory used as the device.
+        Detection results are cached for the lifetime of the process, pass refresh=True to look again.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, device_name='PB741', backend=None, device_path=None, refresh=False):
         self.device_name = device_name
         self.book_dir = 'Downloads'
         self.note_dir = 'Notes'
+        self.backend = self.get_backend(backend, device_path)
+        self.refresh = refresh
         self.is_device_connected = self.check_is_device_connected()
-    
+
+    @staticmethod
+    def get_backend(backend, device_path=None):
+        if backend is None:
+            return DirectoryBackend(device_path) if device_path is not None else get_default_backend()
+        if not isinstance(backend, str):
+            return backend
+        if backend not in DEVICE_BACKENDS:
+            raise ValueError(f'device backend: \'{backend}\' is not supported')
+        if backend == 'directory':
+            if device_path is None:
+                raise ValueError('the directory device backend needs a device_path')
+            return DirectoryBackend(device_path)
+        return DEVICE_BACKENDS[backend]()
+
     def check_is_device_connected(self):
-        strComputer = "." 
-        objWMIService = win32com.client.Dispatch("WbemScripting.SWbemLocator") 
-        objSWbemServices = objWMIService.ConnectServer(strComputer,"root\cimv2") 
-        colItems = objSWbemServices.ExecQuery("Select * from Win32_LogicalDisk") 
-        for objItem in colItems: 
-            if objItem.VolumeName == self.device_name:
-                self.device_path = objItem.name + '\\'
-                self.get_device_data()
-                return True
-        return False
-
-        
+        device_path = find_volume(self.backend, self.device_name, refresh=self.refresh)
+        if device_path is None:
+            return False
+        self.device_path = device_path
+        self.get_device_data()
+        return True
+
+
     def get_device_data(self):
         self.books = os.path.join(self.device_path, self.book_dir)
         self.notes = os.path.join(self.device_path, self.note_dir)
-
@@ -1,17 +1,16 @@
 
 import os
+import gc
 from pathlib import Path
-import shutil
-import itertools
 import pickle
-from mdutils.mdutils import MdUtils
-from pprint import pprint
+from datetime import datetime
 
 
-from utils import get_dir_contents, clean_text
-from PocketBookDevice import Device
+from utils import get_dir_contents, clean_text, OutdatedPickleError
 from BookCollections import BookCollection
 from NoteCollections import NoteCollection
+from ParseCache import ParseCache
+from Instrumentation import log, setup_logging, Instrumentation, get_instrumentation, set_instrumentation, PROFILE_MODES
 
 
 class MyCollection:
@@ -19,6 +18,8 @@ class MyCollection:
         base_dir=None,
         to_update=True,
         device_name = 'PB741',
+        device_backend = None,
+        device_path = None,
         tags_list = ['machine learning', 'AI'],
         highlight_semantic_mapping = {
             'bm-color-magenta' : 'key_idea',
@@ -29,23 +30,88 @@ class MyCollection:
             'bm-color-blue': 'summary',
             'bm-color-note': 'none',
         },
-
+        verify_hash = False,
+        sync_workers = 4,
+        note_parser = 'bs4',
+        parse_workers = 1,
+        use_parse_cache = True,
+        tag_case_insensitive = False,
+        tag_whole_word = False,
+        book_match_threshold = 0.8,
+        book_suggest_threshold = 0.5,
+        store = 'pickle',
+        read_book_metadata = False,
+        streaming = False,
+        pipelined = False,
+        pipeline_queue_size = 8,
+        profile = None,
+        autoload = True,
     ):
         self.base_dir = base_dir
         self.to_update = to_update
         # define name of device so it can be recognized
         self.device_name = device_name
+        # how the device is found, see PocketBookDevice.Device ('wmi', 'linux', or 'directory' with a device_path)
+        self.device_backend = device_backend
+        self.device_path = device_path
         # define list of strings that will be searched for in notes and added tags
         self.tags_list = tags_list
+        # match tags regardless of case and/or only as whole words
+        self.tag_matching = dict(case_insensitive=tag_case_insensitive, whole_word=tag_whole_word)
+        # books and notes whose names are not contained in one another are paired if their names are this similar,
+        # see BookCollection.match_similar
+        self.book_matching = dict(match_threshold=book_match_threshold, suggest_threshold=book_suggest_threshold)
         # define what highlight colors mean and add as tags to each note
         self.highlight_semantic_mapping = highlight_semantic_mapping
+        # hash files whose size/mtime changed on the device before re-copying them
+        self.verify_hash = verify_hash
+        # number of files copied from the device concurrently
+        self.sync_workers = sync_workers
+        # backend used to parse note html, 'bs4' or 'stream' (faster, no tree is built)
+        self.note_parser = note_parser
+        # number of processes used to parse note files, 1 parses serially
+        self.parse_workers = parse_workers
+        # reuse parsed notes of note files that did not change since the last load
+        self.use_parse_cache = use_parse_cache
+        # read title, authors, publisher and year from epub/pdf metadata instead of only parsing file names
+        self.read_book_metadata = read_book_metadata
+        # parse, store (and export) one book at a time, so memory does not grow with the library (needs store='sqlite')
+        if streaming and store != 'sqlite':
+            raise ValueError('streaming needs store=\'sqlite\', the collection is never held in memory to be pickled')
+        self.streaming = streaming
+        # overlap copying, parsing (and exporting) note files instead of running each step on all files in turn
+        self.pipelined = pipelined
+        # max number of note files waiting between two stages of the pipeline
+        self.pipeline_queue_size = pipeline_queue_size
 
         
         # default name of the pickled collection 
         self.pickle_fn = 'PocketBookCollection'
+        # name of the manifest used to only copy new or changed files from the device
+        self.sync_manifest_fn = 'PocketBookSyncManifest.json'
+        # name of the cache of parsed note files
+        self.parse_cache_fn = 'PocketBookParseCache'
+        # name of the cache of metadata read from book files
+        self.book_metadata_fn = 'PocketBookMetadataCache.json'
+        # name of the snapshot of note uids used to find the notes that changed since the last load
+        self.snapshot_fn = 'PocketBookSnapshot.json'
+        
+        # how the collection is saved, 'pickle' or 'sqlite' (loaded lazily, with a full text index)
+        if store not in ('pickle', 'sqlite'):
+            raise ValueError(f'store: \'{store}\' is not supported')
+        self.store = store
+        self.store_fn = 'PocketBookCollection.sqlite'
+
+        # opt-in stage timers and counters, saved to base_dir as 'json', or 'cprofile' to also dump cProfile stats
+        if profile not in PROFILE_MODES:
+            raise ValueError(f'profile: \'{profile}\' is not supported')
+        self.profile = profile
+        self.start_profile()
         
         # load the collection either by unpickling or from raw text and notes
-        self.load()
+        if autoload:
+            self.load()
+            self.save_profile()
         
 
     ###################################################################################################
@@ -54,32 +120,240 @@ class MyCollection:
     def load(self):
         ''' decide whether to update the collection from raw files or open from pickle '''
         # check if pickle file is in base dir, if not will update automatically
-        if (self.pickle_fn in os.listdir(self.base_dir)) and  \
+        if self.store == 'sqlite':
+            if os.path.exists(os.path.join(self.base_dir, self.store_fn)) and not self.to_update:
+                return self.open_store()
+        elif (self.pickle_fn in os.listdir(self.base_dir)) and  \
            (not self.to_update): # if not updating just open the previous pickle file
             return self.open()
              
         # initialize the local directories where books and notes extracted from device will be saved
         self.init_note_directories()
-        # detect if a pocketbook device is connected and copy over the data
-        self.update_collection_from_device()
-        # organize the collected data mapping books to notes 
-        self.BookCollection = BookCollection(self.note_dir, self.book_dir)
-        self.NoteCollection = NoteCollection(self.BookCollection, self.tags_list, self.highlight_semantic_mapping)
+        if self.streaming:
+            self.update_collection_from_device()
+            self.stream_collection()
+            return 1
+        if self.pipelined:
+            self.run_pipeline()
+        else:
+            # detect if a pocketbook device is connected and copy over the data
+            self.update_collection_from_device()
+            self.build_collections()
+        self.update_snapshot()
         # pickle self
+        return self.save()
+
+    def build_collections(self):
+        ''' map books to notes and parse the note files, only note files that changed are parsed if the parse cache is used '''
+        # organize the collected data mapping books to notes 
+        self.BookCollection = BookCollection(self.note_dir, self.book_dir, **self.book_matching)
+        self.apply_book_metadata(self.BookCollection)
+        self.NoteCollection = NoteCollection(
+            self.BookCollection, self.tags_list, self.highlight_semantic_mapping,
+            parser=self.note_parser, workers=self.parse_workers, cache=self.get_parse_cache(),
+            tag_matching=self.tag_matching,
+        )
+
+    def run_pipeline(self, export_dir=None, export_workers=4, sync=True):
+        '''
+        copy from the device (if sync), match, parse and optionally export to export_dir with overlapping stages,
+        see Pipeline.LoadPipeline. Builds the same collections as update_collection_from_device and build_collections.
+        Returns the export report if exporting.
+        '''
+        from Pipeline import LoadPipeline
+        self.init_note_directories()
+        pipeline = LoadPipeline(
+            self, export_dir=export_dir, queue_size=self.pipeline_queue_size, export_workers=export_workers, sync=sync,
+        )
+        return pipeline.run()
+
+    def apply_book_metadata(self, book_collection, source_paths=None):
+        '''
+        if read_book_metadata, set the info of each book from its file's metadata, read once per file version.
+        source_paths: {local book path: path to read instead}, e.g. books not yet copied from the device
+        '''
+        if not self.read_book_metadata:
+            return
+        from BookMetadata import BookMetadataCache
+        source_paths = source_paths or {}
+        cache = BookMetadataCache(os.path.join(self.base_dir, self.book_metadata_fn))
+        with get_instrumentation().stage('book_metadata'):
+            for book in book_collection:
+                book.set_metadata(cache.get(book.book_path, read_path=source_paths.get(str(book.book_path))))
+        cache.save()
+        log.info(f'book metadata: {cache.stats["hits"]} cached, {cache.stats["misses"]} read', extra=dict(book_metadata=dict(cache.stats)))
+
+    def stream_collection(self, export_dir=None):
+        '''
+        parse the note file of each book, export the book to export_dir (if given) and write its rows to the sqlite store,
+        then release its notes before the next book, so peak memory is bounded by the largest book.
+        The parse cache, the in-memory index and the snapshot hold every note, they are not used.
+        Afterwards the collection is read from the store, like open_store. Returns the export report if exporting.
+        '''
+        book_collection = BookCollection(self.note_dir, self.book_dir, **self.book_matching)
+        self.apply_book_metadata(book_collection)
+        note_collection = NoteCollection(
+            [], self.tags_list, self.highlight_semantic_mapping, parser=self.note_parser, tag_matching=self.tag_matching,
+        )
+        note_collection.index = None
+        manifest, exported = None, []
+        if export_dir is not None:
+            from ObsidianExport import ExportManifest, get_md_file_names, iter_book_markdown
+            manifest = ExportManifest(export_dir)
+            file_names = get_md_file_names(book_collection)
+        instrumentation = get_instrumentation()
+
+        def parsed_books():
+            for book in book_collection:
+                batch = note_collection.read_book_note_batch(book)
+                note_collection.add_note_batch(batch, book)
+                instrumentation.count('notes_parsed', len(batch[1]), book=book.book_name)
+                del batch
+                note_collection.notes.clear()
+                if manifest is not None:
+                    file_name = file_names[id(book)]
+                    with instrumentation.stage('export_book', book=book.book_name):
+                        manifest.write_if_changed(file_name, iter_book_markdown(book))
+                    exported.append(file_name)
+                # the store writes the book's rows before asking for the next book
+                yield book
+                book.clear_notes()
+                if self.note_parser == 'bs4':
+                    # a soup is full of reference cycles, free it before the next book instead of at some later collection
+                    gc.collect()
+
+        log.info('parsing and storing one book at a time')
+        store = self.get_store()
+        with instrumentation.stage('stream'):
+            store.save_collection(parsed_books())
+        store.close()
+        report = manifest.finish(exported) if manifest is not None else None
+        self.open_store()
+        return report
+
+    def get_parse_cache(self):
+        if not self.use_parse_cache:
+            return None
+        return ParseCache(
+            os.path.join(self.base_dir, self.parse_cache_fn), self.tags_list, self.highlight_semantic_mapping, self.tag_matching,
+        )
+
+    def save(self):
+        ''' save the collection to the configured store '''
+        if self.store == 'sqlite':
+            return self.save_store()
         return self.cache()
+
+    def update_books(self, changed_paths):
+        '''
+        update the collection after some book or note files in the local directories changed,
+        re-parsing only their note files. Returns the books whose notes may have changed.
+        '''
+        changed_names = {Path(p).name for p in changed_paths}
+        by_note_name = {}
+        if isinstance(self.NoteCollection, NoteCollection):
+            by_note_name = {Path(book.note_path).name: book for book in self.BookCollection}
+        if all(name in by_note_name and os.path.exists(by_note_name[name].note_path) for name in changed_names):
+            # only known note files changed, replace the notes of their books
+            books = [by_note_name[name] for name in sorted(changed_names)]
+            for book in books:
+                self.NoteCollection.reload_book(book)
+            if self.NoteCollection.cache is not None:
+                self.NoteCollection.cache.save(evict=False)
+        else:
+            # files were added or removed, match books and notes again (unchanged note files are parse cache hits)
+            self.init_note_directories()
+            self.build_collections()
+            books = [
+                book for book in self.BookCollection
+                if Path(book.note_path).name in changed_names or Path(book.book_path).name in changed_names
+            ]
+        self.update_snapshot()
+        self.save()
+        return books
+
+    def update_snapshot(self):
+        '''
+        compare the notes with the snapshot saved by the previous load, then save a snapshot of the current notes.
+        Notes seen before keep the date they were first seen as date_created.
+        Returns (and keeps in self.changes) the notes added and edited since the previous snapshot,
+        and the book name, page and text of the notes removed, see CollectionSnapshot
+        '''
+        from CollectionSnapshot import CollectionSnapshot, assign_note_uids
+        path = os.path.join(self.base_dir, self.snapshot_fn)
+        instrumentation = get_instrumentation()
+        with instrumentation.stage('snapshot'):
+            previous = CollectionSnapshot.load(path)
+            notes_by_uid, dates = {}, {}
+            for book in self.BookCollection:
+                if any(note.uid is None for note in book.notes):
+                    assign_note_uids(book)
+                for note in book.notes:
+                    notes_by_uid[note.uid] = note
+                    first_seen = previous.first_seen(note.uid)
+                    if first_seen is not None:
+                        if first_seen not in dates:
+                            dates[first_seen] = datetime.fromisoformat(first_seen)
+                        note.date_created = dates[first_seen]
+            current = CollectionSnapshot.from_books(self.BookCollection)
+            diff = current.diff(previous)
+            if any(diff.values()) or current.books != previous.books or not os.path.exists(path):
+                current.save(path)
+        self.changes = dict(
+            added=[notes_by_uid[uid] for uid in diff['added']],
+            edited=[notes_by_uid[uid] for uid in diff['edited']],
+            removed=[previous.describe(uid) for uid in diff['removed']],
+        )
+        counts = {f'notes_{k}': len(v) for k, v in self.changes.items()}
+        for k, v in counts.items():
+            instrumentation.count(k, v)
+        log.info(
+            f'{counts["notes_added"]} notes added, {counts["notes_edited"]} edited, {counts["notes_removed"]} removed since the last load',
+            extra=dict(stage='snapshot', **counts),
+        )
+        return self.changes
+
+    def get_store(self):
+        from CollectionStore import CollectionStore
+        return CollectionStore(os.path.join(self.base_dir, self.store_fn))
+
+    def save_store(self):
+        ''' upsert the collection into the sqlite store '''
+        store = self.get_store()
+        store.save_collection(self.BookCollection)
+        store.close()
+        return 1
+
+    def open_store(self):
+        ''' open the sqlite store, books and notes are only read when they are used '''
+        from CollectionStore import StoredBookCollection, StoredNoteCollection
+        log.info('loading collection')
+        self.collection_store = self.get_store()
+        self.BookCollection = StoredBookCollection(self.collection_store)
+        self.NoteCollection = StoredNoteCollection(self.collection_store)
+        return 1
         
     def cache(self):
         ''' pickle the collection '''
-        with open(self.pickle_fn, 'wb') as p:
+        with open(os.path.join(self.base_dir, self.pickle_fn), 'wb') as p:
             pickle.dump(self, p)
         return 1
         
     def open(self):
         ''' read the pickle file '''
-        print('loading collection')
-        with open(self.pickle_fn, 'rb') as p:
-            temp_dict =  pickle.load(p)
-            self.__dict__.update(temp_dict.__dict__)
+        log.info('loading collection')
+        pickle_path = os.path.join(self.base_dir, self.pickle_fn)
+        with open(pickle_path, 'rb') as p:
+            try:
+                temp_dict =  pickle.load(p)
+            except OutdatedPickleError as e:
+                raise OutdatedPickleError(
+                    f'{pickle_path} was saved by an older version ({e}), rebuild the collection with to_update=True '
+                    '(or cli.py parse)'
+                ) from None
+            # keep the options of this run, e.g. profile and how the device is found
+            run_options = ('profile', 'profile_fn', 'device_backend', 'device_path')
+            self.__dict__.update({k: v for k, v in temp_dict.__dict__.items() if k not in run_options})
         return 1
         
     def init_note_directories(self):
@@ -88,6 +362,26 @@ class MyCollection:
         for adir in [self.note_dir, self.book_dir]:
             if not os.path.exists(adir):
                 os.mkdir(adir)
+
+    def start_profile(self):
+        ''' enable instrumentation for this run if profiling, otherwise instrumentation calls do nothing '''
+        if self.profile is None:
+            set_instrumentation(None)
+            return
+        self.profile_fn = f'PocketBookProfile_{datetime.now():%Y%m%d_%H%M%S}'
+        instrumentation = set_instrumentation(Instrumentation())
+        if self.profile == 'cprofile':
+            instrumentation.start_profiler()
+
+    def save_profile(self):
+        ''' write the stage timers and counters collected so far to base_dir (and the cProfile stats if profiling with cProfile) '''
+        instrumentation = get_instrumentation()
+        if not instrumentation.enabled:
+            return
+        instrumentation.log_summary()
+        path = os.path.join(self.base_dir, self.profile_fn)
+        instrumentation.save(json_path=path + '.json', cprofile_path=path + '.prof' if self.profile == 'cprofile' else None)
+        log.info(f'profile saved to {path}', extra=dict(profile_path=path))
     
 
     ###############################################################################################################
@@ -96,37 +390,36 @@ class MyCollection:
     def update_collection_from_device(self):
         ''' callable function to copy over all books and notes '''
         if self.check_is_device_connected():
-            print('device is connected, copying over all books and notes')
+            log.info('device is connected, copying over all books and notes')
             self.copy_device_collection()
 
 
-    def check_is_device_connected(self):
-        ''' look in removable drives for pocketbook device '''
-        self.device = Device(device_name=self.device_name)
+    def check_is_device_connected(self, refresh=False, quiet=False):
+        ''' look in removable drives for pocketbook device, refresh ignores the cached detection '''
+        from PocketBookDevice import Device
+        self.device = Device(
+            device_name=self.device_name, backend=self.device_backend, device_path=self.device_path, refresh=refresh,
+        )
         if not self.device.is_device_connected:
-            print('device is not connected')
+            if not quiet:
+                log.info('device is not connected')
             return False
         return True
         
     def copy_device_collection(self):
-        ''' copy over all files from device to local data '''
-        content_dict = {
+        ''' copy new or changed files from device to local data, using a manifest stored in base_dir '''
+        self.sync_report = self.get_syncer().sync(self.get_sync_content())
+        log.info('collection updated')
+
+    def get_sync_content(self):
+        return {
             'books': {'device_dir':self.device.books, 'local_dir':self.book_dir},
             'notes': {'device_dir':self.device.notes, 'local_dir':self.note_dir}
         }
-        for ctype, dir_dict in content_dict.items():
-            device_dir = dir_dict['device_dir']
-            device_paths = self.get_dir_contents(device_dir)
-            local_dir = dir_dict['local_dir']
-
-            for src_file in device_paths:
-                dst_file = os.path.join(local_dir, src_file.name)
-                if os.path.exists(dst_file):
-                    if os.path.samefile(src_file, dst_file): # in case src and dst are same file
-                        continue
-                    os.remove(dst_file)
-                shutil.copy2(src_file, dst_file)
-        print('collection updated')
+
+    def get_syncer(self):
+        from DeviceSync import DeviceSync
+        return DeviceSync(os.path.join(self.base_dir, self.sync_manifest_fn), verify_hash=self.verify_hash, workers=self.sync_workers)
     
 
 
@@ -135,11 +428,43 @@ class MyCollection:
 
     ###################################################################################################
     # querying functions
-    def groupby(self, groupers):
-        # handle single groupers
-        if isinstance(groupers, str):
-            groupers = [groupers]
-        
+    def get_note_table(self):
+        ''' columnar NoteTable of the notes, built once and rebuilt after the notes change '''
+        return self.NoteCollection.get_table()
+
+    def groupby(self, groupers, aggregations=None, page_bin=1, as_dataframe=False):
+        '''
+        summary of the notes grouped by book, book_id, highlight_color, tag, page, year, month or day, e.g.
+            groupby('highlight_color')
+            groupby(['book', 'tag'], dict(notes='count', with_note=('has_note', 'sum')))
+            groupby('page', page_bin=25)
+        returns a NoteTable.SummaryTable, or a pandas DataFrame if as_dataframe. See NoteTable.groupby
+        '''
+        with get_instrumentation().stage('groupby'):
+            summary = self.get_note_table().groupby(groupers, aggregations, page_bin=page_bin)
+        return summary.to_dataframe() if as_dataframe else summary
+
+
+    def query(self, query='', book_id=None, highlight_color=None, tags=None, pages=None, limit=None):
+        '''
+        search notes using the collection's inverted index, best matches first
+            query: text search over highlight text and notes, words are ANDed, use OR, NOT word or -word,
+                   "exact phrase" and prefix* e.g. 'extinction -dinosaur* OR "snowball earth"'
+            book_id, highlight_color, tags: a value or list of values, notes matching any of them are kept
+            pages: (first, last) inclusive page range
+            limit: max number of notes returned
+        '''
+        store = getattr(self.NoteCollection, 'store', None)
+        if store is not None and tags is None and pages is None:
+            # opened from the sqlite store, answer from its full text index instead of loading every note
+            fts_query = store.to_fts_query(query)
+            if fts_query is not None:
+                return store.search(
+                    fts_query, book_id=book_id, highlight_color=highlight_color, limit=limit, query=query,
+                )
+        return self.NoteCollection.get_index().search(
+            query, book_id=book_id, highlight_color=highlight_color, tags=tags, pages=pages, limit=limit,
+        )
 
     def get_notes_where(self, **kwargs):
         result = set()
@@ -169,38 +494,49 @@ class MyCollection:
 
 
 
-    def export_to_obsidian(self, export_dir):
-        ''' export the notes to an existing obsidian vault '''
+    def export_to_obsidian(self, export_dir, book_names=None, workers=4):
+        '''
+        export the notes to an existing obsidian vault, optionally only the books in book_names.
+        Books are exported concurrently on workers threads, and only files whose content changed are rewritten,
+        see ObsidianExport.export_books
+        '''
+        from ObsidianExport import export_books
 
-        print('exporting collection to obsidian...')
+        log.info('exporting collection to obsidian...')
+        books, skipped = [], []
         for book in self.BookCollection:
-            # init md file
-            mdFile = MdUtils(file_name=os.path.join(export_dir, book.book_name))
-
-            # get header
-            mdFile.new_header(level = 1, title='Book info')
-            header = book.get_book_info_as_export_str(export_to='obsidian')
-            mdFile.new_paragraph(header)
-            mdFile.new_paragraph()
-
-            # get note as export type strings
-            mdFile.new_header(level = 1, title='Notes')
-            # sort by page number if they were extracted
-            book_notes = [n for n in book.notes]
-            if book.has_page_numbers:
-                book_notes = sorted(book_notes, key=lambda x: int(x.page_number)) 
-            # create a new paragraph for each note
-            for n in book_notes:
-                mdFile.new_paragraph(n.export_str(export_to='obsidian'))
-
-            # write to vault
-            mdFile.create_md_file()
+            if book_names is not None and book.book_name not in book_names:
+                # not exported this time, but its file is not an orphan
+                skipped.append(book)
+                continue
+            books.append(book)
+        with get_instrumentation().stage('export'):
+            report = export_books(books, export_dir, workers=workers, skipped_books=skipped)
+        self.save_profile()
+        return report
+
+    def export(self, export_dir, formats=('obsidian',), book_names=None, workers=4):
+        '''
+        export the notes to export_dir in each of formats (obsidian, jsonl, csv, anki) in one walk over the books,
+        optionally only the books in book_names (formats with one file for all books, like jsonl, still get every
+        book). Notes that did not change since the last export are not
+        rendered again and only files whose content changed are rewritten, see Exporters.export_collection
+        '''
+        from Exporters import export_collection
+
+        log.info(f'exporting collection to {", ".join(formats)}...')
+        with get_instrumentation().stage('export'):
+            report = export_collection(list(self.BookCollection), export_dir, formats=formats, workers=workers, book_names=book_names)
+        self.save_profile()
+        return report
 
 
 
 from PocketBookNoteExtractor import MyCollection
 
 if __name__ == '__main__':
+    # log progress to stdout
+    setup_logging()
     # create a collection object that manages imports and exports of pocketbook files
     mycollection = MyCollection(
 
@@ -229,7 +565,7 @@ if __name__ == '__main__':
     mycollection.export_to_obsidian(
         
         # existing obsidian vault where notes will be stored
-        vault_dir = r'E:\python\PocketbookNoteExtractor\test_md\bookNotes'
+        export_dir = r'E:\python\PocketbookNoteExtractor\test_md\bookNotes'
     )
 
 
@@ -0,0 +1,196 @@
+import math
+from collections import deque, defaultdict
+
+
+class AhoCorasick:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Multi-pattern substring matcher. Patterns are compiled once into a trie with failure links,
+        then every pattern occurring in a text is found in a single pass over the text.
+        Patterns are identified by their index in the list passed in.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        # trie transitions, pattern ids ending at each state, failure and output links
+        self.goto = [{}]
+        self.out = [[]]
+        self.fail = [0]
+        self.out_link = [0]
+        for pattern_id, pattern in enumerate(self.patterns):
+            self.add_pattern(pattern_id, pattern)
+        self.build_links()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add_pattern(self, pattern_id, pattern):
+        state = 0
+        for ch in pattern:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.out.append([])
+                self.fail.append(0)
+                self.out_link.append(0)
+            state = nxt
+        self.out[state].append(pattern_id)
+
+    def build_links(self):
+        ''' breadth first pass setting the failure link and nearest matching suffix of every state '''
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0)
+                self.fail[nxt] = f if f != nxt else 0
+                self.out_link[nxt] = f if self.out[f] else self.out_link[f]
+
+    def iter_matches(self, text):
+        ''' yields (end index, pattern id) for every occurrence of every pattern in text '''
+        goto, fail, out, out_link = self.goto, self.fail, self.out, self.out_link
+        # empty patterns match everywhere, report them once at the start
+        for pattern_id in out[0]:
+            yield 0, pattern_id
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            s = state if out[state] else out_link[state]
+            while s:
+                for pattern_id in out[s]:
+                    yield i + 1, pattern_id
+                s = out_link[s]
+
+    def find_all(self, text):
+        ''' returns the set of ids of all patterns that occur in text '''
+        return {pattern_id for _, pattern_id in self.iter_matches(text)}
+
+
+class TagMatcher:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Finds which tags of a tag list occur in a text in one pass, using an AhoCorasick automaton
+        compiled once from the tag list. By default matching is case-sensitive substring search,
+        the same as `tag in text`.
+
+        case_insensitive: match tags regardless of case (the original tag string is returned).
+        whole_word: only match tags that are not part of a longer word.
+
+        For a handful of tags, separate `in` scans run in C and beat a pure Python automaton walk,
+        so tag lists up to SMALL_TAG_LIST are scanned directly.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    SMALL_TAG_LIST = 200
+
+    def __init__(self, tags, case_insensitive=False, whole_word=False):
+        self.tags = list(tags)
+        self.case_insensitive = case_insensitive
+        self.whole_word = whole_word
+        self.prepared = [self.prepare(tag) for tag in self.tags]
+        self.automaton = AhoCorasick(self.prepared)
+
+    def prepare(self, text):
+        return text.lower() if self.case_insensitive else text
+
+    def find_tags(self, text):
+        ''' returns the set of tags found in text '''
+        text = self.prepare(text)
+        if not self.whole_word and len(self.tags) <= self.SMALL_TAG_LIST:
+            return {tag for tag, prepared in zip(self.tags, self.prepared) if prepared in text}
+        if not self.whole_word:
+            return {self.tags[pattern_id] for pattern_id in self.automaton.find_all(text)}
+
+        found = set()
+        for end, pattern_id in self.automaton.iter_matches(text):
+            start = end - len(self.automaton.patterns[pattern_id])
+            if self.is_word_boundary(text, start - 1) and self.is_word_boundary(text, end):
+                found.add(self.tags[pattern_id])
+        return found
+
+    @staticmethod
+    def is_word_boundary(text, i):
+        return i < 0 or i >= len(text) or not (text[i].isalnum() or text[i] == '_')
+
+
+def get_ngrams(text, n=3):
+    ''' set of character n-grams of text, a text shorter than n is its own n-gram '''
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def dice_similarity(a, b):
+    ''' 2|a & b| / (|a| + |b|) of two n-gram sets, 1.0 if they are equal '''
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class NgramIndex:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Finds the texts of a list that are similar to a query text, scored by the dice coefficient of their
+        character n-gram sets. Texts are identified by their index in the list passed in.
+
+        Candidates are found with prefix filtering on an inverted index (n-gram -> text ids) instead of scoring
+        every text: a text with similarity >= min_score must share at least min_overlap of the query's n-grams,
+        so it shares at least one of the query's (n_grams - min_overlap + 1) rarest n-grams. Only the postings
+        of those rare n-grams are read, counting how many of them each text shares, and texts that can not
+        reach min_score with the remaining n-grams are dropped before being scored. No match above min_score
+        is missed.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, texts, n=3):
+        self.n = n
+        self.grams = [get_ngrams(text, n) for text in texts]
+        self.postings = defaultdict(list)
+        for text_id, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings[gram].append(text_id)
+
+    def __len__(self):
+        return len(self.grams)
+
+    def search(self, text, min_score=0.5):
+        ''' (score, text id) of the texts with a similarity of at least min_score, best first '''
+        grams = get_ngrams(text, self.n)
+        if not grams or min_score <= 0:
+            return []
+        # dice >= s with |a| query n-grams needs an overlap of at least s|a| / (2 - s)
+        min_overlap = max(1, math.ceil(min_score * len(grams) / (2 - min_score) - 1e-9))
+        postings = self.postings
+        rare_first = sorted(grams, key=lambda gram: len(postings.get(gram, ())))
+        n_prefix = len(grams) - min_overlap + 1
+        shared = defaultdict(int)
+        for gram in rare_first[:n_prefix]:
+            for text_id in postings.get(gram, ()):
+                shared[text_id] += 1
+        # at most the n-grams after the prefix can be shared too
+        n_rest = len(grams) - n_prefix
+        matches = []
+        for text_id, count in shared.items():
+            other = self.grams[text_id]
+            if 2 * (count + min(n_rest, len(other))) < min_score * (len(grams) + len(other)):
+                continue
+            score = dice_similarity(grams, other)
+            if score >= min_score:
+                matches.append((score, text_id))
+        matches.sort(key=lambda match: (-match[0], match[1]))
+        return matches
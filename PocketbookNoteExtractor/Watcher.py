@@ -0,0 +1,230 @@
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from DeviceSync import TransferPool
+from Instrumentation import log, get_instrumentation
+
+
+class InotifyWatcher:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Reports files written, moved or deleted in a set of directories, using Linux inotify through ctypes.
+        Only completed writes (IN_CLOSE_WRITE) and renames are reported, so a file being copied is reported once.
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, dirs):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+        for adir in dirs:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(adir), self.MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(err, f'inotify_add_watch failed for {adir}')
+            self.dirs[wd] = adir
+
+    def close(self):
+        os.close(self.fd)
+
+    def wait(self, timeout):
+        ''' returns the set of paths that changed, waiting at most timeout seconds for the first event '''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if wd in self.dirs and name:
+                    changed.add(os.path.join(self.dirs[wd], os.fsdecode(name)))
+        return changed
+
+
+class PollingWatcher:
+    ''' reports files whose size or mtime changed in a set of directories, by listing them every interval seconds '''
+
+    def __init__(self, dirs, interval=1.0):
+        self.dirs = list(dirs)
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def close(self):
+        pass
+
+    def scan(self):
+        snapshot = {}
+        for adir in self.dirs:
+            try:
+                entries = list(os.scandir(adir))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                snapshot[entry.path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout):
+        time.sleep(min(self.interval, timeout))
+        snapshot = self.scan()
+        changed = {p for p in snapshot.keys() | self.snapshot.keys() if snapshot.get(p) != self.snapshot.get(p)}
+        self.snapshot = snapshot
+        return changed
+
+
+def get_file_watcher(dirs, poll_interval=1.0):
+    ''' inotify on Linux, otherwise (or if inotify is unavailable) polling '''
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(dirs)
+        except (OSError, AttributeError) as e:
+            log.info(f'inotify unavailable ({e}), polling for changes every {poll_interval}s')
+    return PollingWatcher(dirs, poll_interval)
+
+
+class CollectionWatcher:
+    '''
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    Description
+    ~~~~~~~~~~~
+        Keeps a MyCollection and an obsidian vault up to date while running.
+        Waits for the device to be connected or for files in the local book and note directories to change,
+        waits until changes settle for debounce seconds, then runs only what the changes need:
+        new or changed files are copied from the device, their note files re-parsed and their books re-exported.
+
+        collection: a MyCollection, usually loaded with to_update=True
+        export_dir: obsidian vault to export changed books to, or None to only update the collection
+        device_poll_interval: seconds between looks for a device that is not connected (a WMI query on Windows),
+                              a connected device's mount path is checked on every poll
+
+    ```````````````````````````````````````````````````````````````````````````````````````````````````````````````````
+    '''
+    def __init__(self, collection, export_dir=None, debounce=2.0, poll_interval=1.0, export_workers=4, device_poll_interval=10.0):
+        self.collection = collection
+        self.export_dir = export_dir
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.export_workers = export_workers
+        self.device_poll_interval = device_poll_interval
+        self.device_connected = False
+        self.last_device_scan = None
+        collection.init_note_directories()
+        self.files = get_file_watcher([collection.note_dir, collection.book_dir], poll_interval)
+        # (size, mtime) of each file when it was last processed, so our own writes are not processed twice
+        self.processed = {}
+        for adir in (collection.note_dir, collection.book_dir):
+            for entry in os.scandir(adir):
+                self.processed[entry.path] = self.get_signature(entry.path)
+
+    def run(self, timeout=None):
+        ''' watch for changes until interrupted, or for timeout seconds '''
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        log.info(f'watching {self.collection.note_dir} and {self.collection.book_dir} for changes')
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                changed = self.wait_for_changes(deadline)
+                if changed:
+                    self.update(changed)
+        except KeyboardInterrupt:
+            log.info('stopped watching')
+        finally:
+            self.files.close()
+
+    def wait_for_changes(self, deadline=None):
+        ''' collect changed paths until no more changes arrive for debounce seconds '''
+        changed = set()
+        last_change = None
+        while True:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                return changed
+            if last_change is not None and now - last_change >= self.debounce:
+                return changed
+            new = self.files.wait(self.poll_interval)
+            new |= self.check_device()
+            if new:
+                changed |= new
+                last_change = time.monotonic()
+
+    def check_device(self):
+        ''' copies new and changed files when the device is connected, returns the local paths that were copied '''
+        # the cached detection checks a known mount path still exists, it is only refreshed to look for
+        # a device that was not connected, every device_poll_interval seconds
+        now = time.monotonic()
+        refresh = not self.device_connected and (
+            self.last_device_scan is None or now - self.last_device_scan >= self.device_poll_interval
+        )
+        if refresh:
+            self.last_device_scan = now
+        connected = self.collection.check_is_device_connected(refresh=refresh, quiet=True)
+        was_connected, self.device_connected = self.device_connected, connected
+        if not connected or was_connected:
+            return set()
+        log.info('device is connected, copying new and changed books and notes')
+        self.collection.copy_device_collection()
+        return set(self.collection.sync_report['copied'])
+
+    @staticmethod
+    def get_signature(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def is_relevant(self, path):
+        name = os.path.basename(path)
+        return not name.startswith('.') and not name.endswith(TransferPool.TEMP_SUFFIX) and not name.endswith('.tmp')
+
+    def update(self, changed):
+        ''' re-parse and re-export the books of changed files '''
+        start = time.perf_counter()
+        paths = set()
+        for path in changed:
+            signature = self.get_signature(path)
+            if self.is_relevant(path) and self.processed.get(path) != signature:
+                paths.add(path)
+                self.processed[path] = signature
+        if not paths:
+            return []
+
+        instrumentation = get_instrumentation()
+        with instrumentation.stage('watch_update'):
+            books = self.collection.update_books(paths)
+            if books and self.export_dir is not None:
+                self.collection.export_to_obsidian(
+                    self.export_dir, book_names={book.book_name for book in books}, workers=self.export_workers,
+                )
+        instrumentation.count('watch_updates')
+        log.info(
+            f'updated {len(books)} book(s) from {len(paths)} changed file(s) in {time.perf_counter() - start:.2f}s',
+            extra=dict(stage='watch_update', books=[book.book_name for book in books]),
+        )
+        return books
@@ -0,0 +1,218 @@
+'''
+command line interface, e.g.
+    python cli.py sync --base-dir ~/pocketbook
+    python cli.py parse --base-dir ~/pocketbook --tags "Snowball Earth,Cretaceous extinction"
+    python cli.py query --base-dir ~/pocketbook '"snowball earth" OR cretaceous'
+    python cli.py export --base-dir ~/pocketbook ~/vault/bookNotes
+    python cli.py export --base-dir ~/pocketbook ~/exports --format jsonl --format csv --format anki
+    python cli.py stats --base-dir ~/pocketbook
+    python cli.py stats --base-dir ~/pocketbook --by book --by tag
+
+modules are imported by the subcommands that need them, so e.g. a query does not import the parsers or device code.
+'''
+import os
+import sys
+import argparse
+
+
+def get_collection(args, **kwargs):
+    ''' a MyCollection configured from the common arguments '''
+    from PocketBookNoteExtractor import MyCollection
+    options = dict(
+        base_dir=args.base_dir,
+        store=args.store,
+        device_name=args.device_name,
+        device_backend=args.device_backend,
+        device_path=args.device_path,
+        read_book_metadata=args.book_metadata,
+        book_match_threshold=args.match_threshold,
+        profile=args.profile,
+    )
+    if args.tags is not None:
+        options['tags_list'] = [tag.strip() for tag in args.tags.split(',') if tag.strip()]
+    options.update(kwargs)
+    return MyCollection(**options)
+
+
+def open_collection(args):
+    ''' the collection saved by the last parse, without syncing or parsing '''
+    collection = get_collection(args, to_update=False, autoload=False)
+    saved_fn = collection.store_fn if args.store == 'sqlite' else collection.pickle_fn
+    if not os.path.exists(os.path.join(args.base_dir, saved_fn)):
+        sys.exit(f'no {args.store} collection in {args.base_dir}, run the parse command first')
+    collection.load()
+    return collection
+
+
+def cmd_sync(args):
+    ''' copy new and changed books and notes from the device '''
+    collection = get_collection(args, autoload=False)
+    collection.init_note_directories()
+    if not collection.check_is_device_connected():
+        return 1
+    collection.copy_device_collection()
+    return 0
+
+
+def cmd_parse(args):
+    ''' parse the local books and notes (after syncing, unless --no-sync) and save the collection '''
+    if args.streaming and args.store != 'sqlite':
+        sys.exit('--streaming needs --store sqlite')
+    collection = get_collection(
+        args, autoload=False, note_parser=args.parser, parse_workers=args.workers, streaming=args.streaming,
+    )
+    collection.init_note_directories()
+    if args.export_dir is not None:
+        os.makedirs(args.export_dir, exist_ok=True)
+    if args.streaming:
+        if not args.no_sync:
+            collection.update_collection_from_device()
+        collection.stream_collection(export_dir=args.export_dir)
+    else:
+        if args.pipelined or args.export_dir is not None:
+            collection.run_pipeline(export_dir=args.export_dir, sync=not args.no_sync)
+        else:
+            if not args.no_sync:
+                collection.update_collection_from_device()
+            collection.build_collections()
+        collection.update_snapshot()
+        collection.save()
+    collection.save_profile()
+    return 0
+
+
+def cmd_query(args):
+    collection = open_collection(args)
+    tags = args.tag or None
+    pages = tuple(args.pages) if args.pages else None
+    notes = collection.query(
+        ' '.join(args.query), book_id=args.book_id, highlight_color=args.color or None,
+        tags=tags, pages=pages, limit=args.limit,
+    )
+    for note in notes:
+        print(f'{note.book_name} (pg. {note.page_number}) [{note.highlight_color}]')
+        print(f'\t{note.text}')
+        if note.note:
+            print(f'\tnote: {note.note}')
+    return 0 if notes else 1
+
+
+def cmd_export(args):
+    collection = open_collection(args)
+    os.makedirs(args.export_dir, exist_ok=True)
+    collection.export(args.export_dir, formats=args.format or ['obsidian'], book_names=args.book or None, workers=args.workers)
+    return 0
+
+
+def cmd_stats(args):
+    from collections import Counter
+    collection = open_collection(args)
+    if args.by:
+        summary = collection.groupby(args.by, page_bin=args.page_bin)
+        print(summary.sort('notes', descending=True).head(args.top) if args.top else summary)
+        return 0
+    colors, tags = Counter(), Counter()
+    n_books = n_notes = 0
+    for book in collection.BookCollection:
+        n_books += 1
+    for note in collection.NoteCollection:
+        n_notes += 1
+        colors[note.highlight_color] += 1
+        tags.update(note.tags or ())
+    print(f'{n_books} books, {n_notes} notes')
+    for name, counter in (('highlight colors', colors), ('tags', tags)):
+        if counter:
+            print(f'{name}:')
+            for k, v in counter.most_common(args.top or None):
+                print(f'\t{k}: {v}')
+    book_collection = collection.BookCollection
+    if hasattr(book_collection, 'no_book_notes'):
+        similar_matches = getattr(book_collection, 'similar_matches', ())
+        if similar_matches:
+            print(f'{len(similar_matches)} books were matched to notes with similar names')
+        print(f'{len(book_collection.no_book_notes)} notes and {len(book_collection.no_note_books)} books were not matched')
+    return 0
+
+
+def cmd_watch(args):
+    from Watcher import CollectionWatcher
+    collection = get_collection(args, note_parser=args.parser)
+    if args.export_dir is not None:
+        os.makedirs(args.export_dir, exist_ok=True)
+    CollectionWatcher(
+        collection, args.export_dir, debounce=args.debounce, poll_interval=args.poll_interval,
+        device_poll_interval=args.device_poll_interval,
+    ).run()
+    return 0
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='pocketbook', description='extract PocketBook notes and export them to obsidian')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--base-dir', default=os.getcwd(), help='directory where the collection is stored (default: current directory)')
+    common.add_argument('--store', choices=('pickle', 'sqlite'), default='pickle', help='how the collection is saved')
+    common.add_argument('--tags', help='comma separated strings searched for in notes and added as tags')
+    common.add_argument('--device-name', default='PB741', help='volume label of the device')
+    common.add_argument('--device-backend', choices=('wmi', 'linux', 'directory'), help='how the device is found')
+    common.add_argument('--device-path', help='directory used as the device, e.g. a mount point')
+    common.add_argument('--book-metadata', action='store_true', help='read title, authors, publisher and year from epub/pdf files')
+    common.add_argument('--match-threshold', type=float, default=0.8, help='pair books and notes whose names are at least this similar (0-1)')
+    common.add_argument('--profile', choices=('json', 'cprofile'), help='save stage timings (and cProfile stats) to base-dir')
+    common.add_argument('--log-json', action='store_true', help='log json records')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('sync', parents=[common], help=cmd_sync.__doc__)
+    p.set_defaults(func=cmd_sync)
+
+    p = subparsers.add_parser('parse', parents=[common], help=cmd_parse.__doc__)
+    p.add_argument('--no-sync', action='store_true', help='only parse the local files')
+    p.add_argument('--parser', choices=('bs4', 'stream'), default='bs4')
+    p.add_argument('--workers', type=int, default=1, help='processes used to parse note files')
+    p.add_argument('--pipelined', action='store_true', help='parse note files while books and notes are being copied')
+    p.add_argument('--streaming', action='store_true', help='parse, store and export one book at a time to bound memory (needs --store sqlite)')
+    p.add_argument('--export-dir', help='also export each book to this obsidian vault as soon as it is parsed (pipelined or streaming)')
+    p.set_defaults(func=cmd_parse)
+
+    p = subparsers.add_parser('query', parents=[common], help='search the notes of the collection')
+    p.add_argument('query', nargs='*', help='words, OR, NOT word/-word, "phrase", prefix*')
+    p.add_argument('--book-id', type=int)
+    p.add_argument('--color', action='append', help='highlight tag, e.g. key_idea (repeatable)')
+    p.add_argument('--tag', action='append', help='repeatable')
+    p.add_argument('--pages', type=int, nargs=2, metavar=('FIRST', 'LAST'))
+    p.add_argument('--limit', type=int, default=20)
+    p.set_defaults(func=cmd_query)
+
+    p = subparsers.add_parser('export', parents=[common], help='export the collection to an obsidian vault')
+    p.add_argument('export_dir')
+    p.add_argument('--book', action='append', help='only export this book name (repeatable), jsonl, csv and anki files still hold every book')
+    p.add_argument('--workers', type=int, default=4, help='books exported concurrently')
+    p.add_argument('--format', action='append', choices=('obsidian', 'jsonl', 'csv', 'anki'), help='default obsidian (repeatable)')
+    p.set_defaults(func=cmd_export)
+
+    p = subparsers.add_parser('stats', parents=[common], help='count books, notes, highlight colors and tags')
+    p.add_argument('--top', type=int, default=10, help='number of colors and tags (or groups) listed, 0 for all')
+    p.add_argument('--by', action='append', help='count notes by book, book_id, highlight_color, tag, page, year, month or day (repeatable)')
+    p.add_argument('--page-bin', type=int, default=1, help='pages per group with --by page')
+    p.set_defaults(func=cmd_stats)
+
+    p = subparsers.add_parser('watch', parents=[common], help='keep the collection and a vault up to date, see Watcher')
+    p.add_argument('export_dir', nargs='?')
+    p.add_argument('--parser', choices=('bs4', 'stream'), default='bs4')
+    p.add_argument('--debounce', type=float, default=2.0)
+    p.add_argument('--poll-interval', type=float, default=1.0)
+    p.add_argument('--device-poll-interval', type=float, default=10.0, help='seconds between looks for the device while it is not connected')
+    p.set_defaults(func=cmd_watch)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    from Instrumentation import setup_logging
+    # progress goes to stderr, stdout is left to the results of a command
+    setup_logging(json_format=args.log_json, stream=sys.stderr)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,4 +7,7 @@ def get_dir_contents(base_dir, base_dir_filter=''):
 
 def clean_text(s):
     new_s = s.replace('\n', ' ')
-    return new_s
\ No newline at end of file
+    return new_s
+
+class OutdatedPickleError(Exception):
+    ''' an object was pickled by an older version of its class that can not be loaded, the collection has to be rebuilt '''
\ No newline at end of file